@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+
+from synthetic_data import write_pagexml_pages, write_scans, write_text_corpus
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The tools are scripts rather than packages, their helper modules are imported from the script directory
+for tool_dir in ('text', 'conversion', 'image-analysis', 'scan'):
+    if os.path.join(REPO_ROOT, tool_dir) not in sys.path:
+        sys.path.append(os.path.join(REPO_ROOT, tool_dir))
+from file_manifest import scan_files  # noqa: E402
+
+# Number of files of every dataset at scale 1, and how to generate them
+DATASETS = {
+    'text': (write_text_corpus, '.txt', 500),
+    'pagexml': (write_pagexml_pages, '.xml', 100),
+    'images': (write_scans, '.jpg', 20),
+}
+PAGEXML_OPTIONS = dict(separate_single_words=True, merge_dashes=True, split_periods=True, merge_quotes=False,
+                       separate_colons=True)
+COMPLETE_MARKER = '.complete'
+
+
+def load_script(relative_path, module_name):
+    """Import a script like text/find-ngrams.py, whose name is not a valid module name."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_find_ngrams(data_dir, files, work_dir, minhash=False):
+    find_ngrams = load_script('text/find-ngrams.py', 'find_ngrams')
+    common_ngrams, ngram_files, file_paths = find_ngrams.find_ngrams(data_dir, None, set(), n=5, top_k=100000,
+                                                                     tokens_to_ignore=10, minhash=minhash)
+    processed_ngrams = find_ngrams.process_ngrams(common_ngrams, ngram_files, top_k=1000, num_files=len(file_paths))
+    find_ngrams.save_ngrams_to_json(processed_ngrams, output_dir=os.path.join(work_dir, 'clusters'), n=5,
+                                    file_paths=file_paths, output_format='jsonl')
+
+
+def run_find_ngrams_minhash(data_dir, files, work_dir):
+    run_find_ngrams(data_dir, files, work_dir, minhash=True)
+
+
+def run_read_pagexml_file(data_dir, files, work_dir):
+    converter = load_script('conversion/pagexml-to-text.py', 'pagexml_to_text')
+    for file_path in files:
+        converter.read_pagexml_file(file_path, **PAGEXML_OPTIONS)
+
+
+def run_read_pagexml_stream(data_dir, files, work_dir):
+    converter = load_script('conversion/pagexml-to-text.py', 'pagexml_to_text')
+    for file_path in files:
+        converter.read_pagexml_stream(file_path, **PAGEXML_OPTIONS)
+
+
+def run_extract_bounding_box(data_dir, files, work_dir):
+    import extract_main_bounding_box
+    for file_path in files:
+        extract_main_bounding_box.process_image(file_path)
+
+
+def run_image_pipeline(data_dir, files, work_dir):
+    import image_pipeline
+    for file_path in files:
+        image_pipeline.process_image(file_path, image_pipeline.thumbnail_path(file_path, data_dir, work_dir))
+
+
+def run_check_images(data_dir, files, work_dir):
+    checker = load_script('check/find-corrupted-jpg.py', 'find_corrupted_jpg')
+    for file_path in files:
+        checker.check_image(file_path)
+
+
+# Every stage runs one tool over all files of a dataset
+STAGES = {
+    'text.find_ngrams': ('text', run_find_ngrams),
+    'text.find_ngrams_minhash': ('text', run_find_ngrams_minhash),
+    'conversion.read_pagexml_file': ('pagexml', run_read_pagexml_file),
+    'conversion.read_pagexml_stream': ('pagexml', run_read_pagexml_stream),
+    'image.process_image': ('images', run_extract_bounding_box),
+    'image.pipeline': ('images', run_image_pipeline),
+    'check.check_image': ('images', run_check_images),
+}
+
+
+def dataset_files(dataset, num_files, data_dir, seed=0):
+    """
+    The files of a synthetic dataset of num_files files in data_dir, as (path, size), generated
+    unless an earlier run already did. The generators are deterministic, so the same seed always
+    benchmarks the same data.
+    """
+    write, extension, _ = DATASETS[dataset]
+    directory = os.path.join(data_dir, f"{dataset}-{num_files}-seed{seed}")
+    if not os.path.exists(os.path.join(directory, COMPLETE_MARKER)):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        write(directory, num_files, seed=seed)
+        open(os.path.join(directory, COMPLETE_MARKER), 'w').close()
+    return directory, [(path, size) for path, size, _ in scan_files(directory, extension)]
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process in MB, ru_maxrss is in KB on Linux and in bytes on macOS."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1 << 20) if sys.platform == 'darwin' else maxrss / 1024
+
+
+def measure_stage(stage, data_dir, files, repeat=3):
+    """
+    Run a stage repeat times in this process with its output silenced. Returns the fastest time,
+    and the peak RSS before and after the runs. Run it in a fresh process, so the peak is the stage's.
+    """
+    run = STAGES[stage][1]
+    seconds = []
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, 'w') as devnull, \
+            redirect_stdout(devnull), redirect_stderr(devnull):
+        rss_before = peak_rss_mb()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(data_dir, files, work_dir)
+            seconds.append(time.perf_counter() - start)
+            shutil.rmtree(work_dir)
+            os.makedirs(work_dir)
+    return min(seconds), rss_before, peak_rss_mb()
+
+
+def run_benchmarks(stages, scales, data_dir, repeat=3, seed=0):
+    """
+    Measure every stage at every scale, each in its own process. Returns a result per stage and
+    scale: the number of files and bytes, the fastest time, the throughput and the peak RSS.
+    """
+    results = []
+    for scale in scales:
+        for stage in stages:
+            dataset = STAGES[stage][0]
+            directory, files = dataset_files(dataset, DATASETS[dataset][2] * scale, data_dir, seed)
+            paths = [path for path, _ in files]
+            num_bytes = sum(size for _, size in files)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, rss_before, rss_peak = executor.submit(measure_stage, stage, directory, paths, repeat).result()
+            result = dict(stage=stage, scale=scale, items=len(files), bytes=num_bytes, seconds=round(seconds, 4),
+                          items_per_second=round(len(files) / seconds, 2),
+                          megabytes_per_second=round(num_bytes / seconds / (1 << 20), 3),
+                          peak_rss_mb=round(rss_peak, 1), rss_increase_mb=round(rss_peak - rss_before, 1))
+            print(f"{stage:32s} {scale:>5d} {len(files):>7d} {result['items_per_second']:>10.1f} "
+                  f"{result['megabytes_per_second']:>8.2f} {result['peak_rss_mb']:>9.1f}", flush=True)
+            results.append(result)
+    return results
+
+
+def environment():
+    return dict(python=platform.python_version(), platform=platform.platform(), machine=platform.machine(),
+                cpu_count=os.cpu_count())
+
+
+def compare_results(results, baseline, tolerance=0.2, memory_slack_mb=16):
+    """
+    The regressions of results against the results of a baseline: a stage and scale whose
+    throughput dropped by more than tolerance, or whose peak RSS grew by more than tolerance and
+    memory_slack_mb, so small absolute changes are not flagged. Stages or scales the baseline does
+    not have are skipped.
+    """
+    baseline_results = {(result['stage'], result['scale']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result['stage'], result['scale']))
+        if previous is None:
+            continue
+        name = f"{result['stage']} at scale {result['scale']}"
+        if result['items_per_second'] < previous['items_per_second'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['items_per_second']} items/s, "
+                               f"baseline {previous['items_per_second']} items/s")
+        memory_limit = max(previous['peak_rss_mb'] * (1 + tolerance), previous['peak_rss_mb'] + memory_slack_mb)
+        if result['peak_rss_mb'] > memory_limit:
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']} MB, baseline {previous['peak_rss_mb']} MB")
+    return regressions
+
+
+def write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def main(stages, scales, data_dir=None, repeat=3, seed=0, output=None, baseline=None, update_baseline=False,
+         tolerance=0.2):
+    """
+    Benchmark the stages at the scales on synthetic data and compare them to baseline, a JSON file
+    of an earlier run, or with update_baseline, make this run the baseline. Returns the regressions.
+    """
+    temporary_data_dir = None
+    if data_dir is None:
+        data_dir = temporary_data_dir = tempfile.mkdtemp(prefix='benchmark-data-')
+    try:
+        print(f"{'stage':32s} {'scale':>5s} {'files':>7s} {'files/s':>10s} {'MB/s':>8s} {'peak MB':>9s}")
+        results = run_benchmarks(stages, scales, data_dir, repeat, seed)
+    finally:
+        if temporary_data_dir is not None:
+            shutil.rmtree(temporary_data_dir, ignore_errors=True)
+    report = dict(created=datetime.now(timezone.utc).isoformat(timespec='seconds'), environment=environment(),
+                  repeat=repeat, seed=seed, results=results)
+    if output is not None:
+        write_json(output, report)
+
+    regressions = []
+    if baseline is not None and update_baseline:
+        write_json(baseline, report)
+        print(f"Saved the baseline to {baseline}")
+    elif baseline is not None:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            baseline_report = json.load(f)
+        if baseline_report['environment'] != report['environment']:
+            print(f"Warning: the baseline was measured on {baseline_report['environment']}")
+        regressions = compare_results(results, baseline_report, tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"No regressions against {baseline}")
+    return regressions
+
+
+def parse_list(value):
+    return [item for item in value.split(',') if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and peak memory of the tools on deterministic synthetic data, and compare them to a baseline.")
+    parser.add_argument('--stages', type=parse_list, default=list(STAGES),
+                        help=f"Comma separated stages to run (default: all of {', '.join(STAGES)})")
+    parser.add_argument('--scales', type=parse_list, default=['1', '4'],
+                        help="Comma separated data sizes, as multiples of 500 text files, 100 PageXML pages and 20 scans (default: 1,4)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per stage, the fastest one is reported (default: 3)")
+    parser.add_argument('--data_dir', default=None, help="Directory to generate the synthetic data in and reuse it from later runs (default: a temporary directory)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data (default: 0)")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to flag regressions against")
+    parser.add_argument('--update_baseline', action='store_true', help="Save the results of this run as --baseline instead of comparing to it")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction of throughput lost, or peak memory gained, that counts as a regression (default: 0.2)")
+    args = parser.parse_args()
+    unknown_stages = [stage for stage in args.stages if stage not in STAGES]
+    if unknown_stages:
+        parser.error(f"unknown stages: {', '.join(unknown_stages)}")
+    if args.update_baseline and args.baseline is None:
+        parser.error("--update_baseline needs --baseline")
+    sys.exit(1 if main(args.stages, [int(scale) for scale in args.scales], args.data_dir, args.repeat, args.seed,
+                       args.output, args.baseline, args.update_baseline, args.tolerance) else 0)
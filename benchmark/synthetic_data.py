@@ -0,0 +1,141 @@
+import os
+import random
+
+import cv2
+import numpy as np
+
+PAGE_NAMESPACES = {
+    2013: 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15',
+    2019: 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15',
+}
+WORDS = ["de", "het", "een", "Amsterdam", "verklaring", "burgemeester", "woonachtig", "te", "Den", "Haag", "geboren",
+         "op", "1921", "maart", "inwoner", "gemeente", "straat", "ondergetekende", "Ik", "verklaar", "hierbij", "dat"]
+# The ways scans break, cycled over the corrupted images. Garbled data keeps every marker intact,
+# so like in practice it passes find-corrupted-jpg.py, the other two do not
+CORRUPTIONS = ('truncated', 'garbled', 'not_an_image')
+
+
+def zipf_words(rng, vocabulary_size=5000):
+    """A vocabulary of WORDS and made up words, with Zipf weights like running text."""
+    vocabulary = WORDS + [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 11)))
+                          for _ in range(vocabulary_size - len(WORDS))]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    return vocabulary, weights
+
+
+def synthetic_text(rng, vocabulary, weights, forms, num_words=400):
+    """
+    The text of a page: running text, and on some pages the boilerplate of one of forms, so
+    n-gram counts and near duplicate clusters find something.
+    """
+    words = rng.choices(vocabulary, weights, k=num_words)
+    if rng.random() < 0.3:
+        form = rng.choice(forms)
+        start = rng.randint(0, num_words)
+        words[start:start] = form
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    return '\n'.join(lines) + '\n'
+
+
+def write_text_corpus(directory, num_files, seed=0, num_words=400):
+    """
+    Write num_files synthetic .txt pages to directory, spread over subdirectories of 100 like the
+    output of pagexml-to-text.py. The same seed always writes the same files.
+    """
+    rng = random.Random(seed)
+    vocabulary, weights = zipf_words(rng)
+    forms = [rng.choices(vocabulary, k=40) for _ in range(5)]
+    for i in range(num_files):
+        subdir = os.path.join(directory, f"inv{i // 100:04d}")
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"NL-test_{i:06d}.txt"), 'w', encoding='utf-8') as f:
+            f.write(synthetic_text(rng, vocabulary, weights, forms, num_words))
+
+
+def synthetic_pagexml(rng, num_regions=30, num_lines=20, num_points=40, version=2019):
+    """A PageXML page about the size of a dense handwritten scan, in the 2013 or 2019 namespace."""
+    regions = []
+    for r in range(num_regions):
+        lines = []
+        for i in range(rng.randint(1, num_lines)):
+            x = rng.randint(0, 2000)
+            points = ' '.join(f"{x + rng.randint(-20, 1000)},{10 * i + rng.randint(0, 8)}" for _ in range(num_points))
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 10)))
+            lines.append(f'<TextLine id="r{r}l{i}"><Coords points="{points}"/><Baseline points="{points}"/>'
+                         f'<TextEquiv><PlainText>{text}</PlainText><Unicode>{text}</Unicode></TextEquiv></TextLine>')
+        regions.append(f'<TextRegion id="r{r}"><Coords points="0,0 10,10"/>{"".join(lines)}</TextRegion>')
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n<PcGts xmlns="{PAGE_NAMESPACES[version]}"><Metadata/>'
+            f'<Page imageFilename="scan.jpg" imageWidth="3000" imageHeight="4000">{"".join(regions)}</Page></PcGts>')
+
+
+def write_pagexml_pages(directory, num_pages, seed=0, versions=(2013, 2019)):
+    """Write num_pages synthetic PageXML pages to directory/page, alternating over the namespaces of versions."""
+    rng = random.Random(seed)
+    page_dir = os.path.join(directory, 'page')
+    os.makedirs(page_dir, exist_ok=True)
+    for i in range(num_pages):
+        with open(os.path.join(page_dir, f"NL-test_{i:06d}.xml"), 'w', encoding='utf-8') as f:
+            f.write(synthetic_pagexml(rng, version=versions[i % len(versions)]))
+
+
+def synthetic_scan(rng, width=1500, height=2000):
+    """
+    A photographed page on a dark, noisy background with bright specks, like a scan with dust on
+    the glass, so Otsu thresholding leaves many small contours. Returns the grayscale image and
+    the true width and height of the page.
+    """
+    image = np.full((height, width), 40, np.uint8)
+    page_width, page_height = width * rng.uniform(0.6, 0.85), height * rng.uniform(0.65, 0.9)
+    angle = rng.uniform(-5, 5)
+    center = (width / 2 + rng.uniform(-50, 50), height / 2 + rng.uniform(-50, 50))
+    page = cv2.boxPoints((center, (page_width, page_height), angle)).astype(np.int32)
+    cv2.fillPoly(image, [page], 215)
+    # Lines of text on the page
+    for y in np.arange(center[1] - page_height * 0.4, center[1] + page_height * 0.4, 30):
+        for x in np.arange(center[0] - page_width * 0.4, center[0] + page_width * 0.4, rng.integers(20, 60)):
+            cv2.rectangle(image, (int(x), int(y)), (int(x) + int(rng.integers(5, 18)), int(y) + 12), 60, -1)
+    image = np.clip(image.astype(np.int16) + rng.integers(-25, 25, image.shape), 0, 255).astype(np.uint8)
+    specks = rng.random(image.shape) < 0.01
+    image[specks] = 230
+    return image, (page_width, page_height)
+
+
+def corrupt_jpeg(data, corruption, rng):
+    """A broken copy of the bytes of a JPEG image."""
+    if corruption == 'truncated':
+        # Cut off halfway through the scan, like an interrupted copy
+        return data[:int(len(data) * rng.uniform(0.3, 0.9))]
+    if corruption == 'garbled':
+        # Random bytes over part of the entropy coded data, the markers stay intact
+        garbled = bytearray(data)
+        start = int(len(data) * 0.6)
+        length = min(4096, len(data) - start - 2)
+        garbled[start:start + length] = rng.integers(0, 255, length, dtype=np.uint8).tobytes().replace(b'\xff', b'\x00')
+        return bytes(garbled)
+    return rng.integers(0, 256, 2048, dtype=np.uint8).tobytes()
+
+
+def write_scans(directory, num_images, seed=0, width=1500, height=2000, corrupted_fraction=0.2):
+    """
+    Write num_images synthetic scans as .jpg to directory, of which about corrupted_fraction are
+    corrupted in one of the CORRUPTIONS ways. Returns the true page size of every valid image and
+    the corruption of every corrupted one, by path.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    truth = {}
+    num_corrupted = 0
+    for i in range(num_images):
+        image, page_size = synthetic_scan(rng, width, height)
+        data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+        path = os.path.join(directory, f"NL-test_{i:06d}.jpg")
+        if rng.random() < corrupted_fraction:
+            corruption = CORRUPTIONS[num_corrupted % len(CORRUPTIONS)]
+            num_corrupted += 1
+            data = corrupt_jpeg(data, corruption, rng)
+            truth[path] = corruption
+        else:
+            truth[path] = page_size
+        with open(path, 'wb') as f:
+            f.write(data)
+    return truth
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# find-corrupted-jpg.py
+# Description: checks all jpg images in the given directory and its subdirectories for corruption on a pool of processes,
+#              without starting a process per image
+# Usage: python3 find-corrupted-jpg.py /PATH/TO/IMAGES [--processes N] [--mode structure|decode] [--output OUTPUT_FILE]
+#                                       [--manifest MANIFEST_FILE] [--metrics REPORT_FILE]
+# Expected output: "path exitcode" per image, as find-corrupted-jpg.sh: 0 for valid images, 1 for corrupted ones,
+#                  2 for images that could not be read
+# Dependencies: Pillow, only for --mode decode
+import argparse
+import os
+import sys
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# The directory scanner shared by all tools
+SCAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scan')
+if SCAN_DIR not in sys.path:
+    sys.path.append(SCAN_DIR)
+from file_manifest import FileManifest, scan_files  # noqa: E402
+
+# The opt-in metrics shared by all tools
+METRICS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metrics')
+if METRICS_DIR not in sys.path:
+    sys.path.append(METRICS_DIR)
+import run_metrics  # noqa: E402
+
+VALID = 0
+CORRUPTED = 1
+UNREADABLE = 2
+
+MODES = ('structure', 'decode')
+
+# Markers without a length: TEM and the restart markers
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+# Start of frame markers, all but DHT (C4), JPG (C8) and DAC (CC)
+FRAME_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+SOI, EOI, SOS = 0xD8, 0xD9, 0xDA
+
+
+def skip_entropy_coded_data(data, position):
+    """The position of the first marker after the entropy coded data of a scan, or None when there is none."""
+    while True:
+        position = data.find(b'\xff', position)
+        if position == -1 or position + 1 >= len(data):
+            return None
+        following = data[position + 1]
+        # Stuffed zero bytes, restart markers and fill bytes belong to the scan
+        if following == 0x00 or following in STANDALONE_MARKERS or following == 0xFF:
+            position += 1 if following == 0xFF else 2
+            continue
+        return position
+
+
+def check_jpeg_structure(data):
+    """
+    Whether data is a structurally complete JPEG: it starts with SOI, every segment fits in the
+    file, there is a frame header before the first scan and the entropy coded data ends in EOI.
+    A file that was cut off, the most common corruption, never reaches EOI.
+    """
+    if data[:2] != b'\xff\xd8':
+        return False
+    position = 2
+    seen_frame = False
+    seen_scan = False
+    while True:
+        if position + 1 >= len(data) or data[position] != 0xFF:
+            return False
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        position += 2
+        if marker == EOI:
+            return seen_scan
+        if marker == SOI:
+            return False
+        if marker in STANDALONE_MARKERS:
+            continue
+        if position + 2 > len(data):
+            return False
+        length = int.from_bytes(data[position:position + 2], 'big')
+        if length < 2 or position + length > len(data):
+            return False
+        if marker in FRAME_MARKERS:
+            seen_frame = True
+        position += length
+        if marker == SOS:
+            if not seen_frame:
+                return False
+            seen_scan = True
+            position = skip_entropy_coded_data(data, position)
+            if position is None:
+                return False
+
+
+def check_jpeg_decode(image_path):
+    """Whether Pillow decodes the whole image without errors or warnings."""
+    from PIL import Image
+    try:
+        with warnings.catch_warnings():
+            # Like identify -regard-warnings, a warning while decoding means the image is corrupted
+            warnings.simplefilter('error')
+            with Image.open(image_path) as image:
+                image.load()
+    except Exception:
+        return False
+    return True
+
+
+def check_image(image_path, mode='structure'):
+    """The exit code of an image: VALID, CORRUPTED or UNREADABLE."""
+    try:
+        with open(image_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return UNREADABLE
+    if not check_jpeg_structure(data):
+        return CORRUPTED
+    if mode == 'decode' and not check_jpeg_decode(image_path):
+        return CORRUPTED
+    return VALID
+
+
+def check_images(image_paths, mode='structure'):
+    """The "path exitcode" lines of a chunk of images, one task for the process pool."""
+    return [f"{image_path} {check_image(image_path, mode)}\n" for image_path in image_paths]
+
+
+def find_images(input_dir, extension='.jpg', manifest=None):
+    """
+    The files with extension in input_dir and its subdirectories, as find -L would list them,
+    following symbolic links but entering every directory only once. With a FileManifest, only
+    those that changed since it was saved.
+    """
+    with run_metrics.stage('walk') as stage:
+        files = scan_files(input_dir, extension, follow_links=True)
+        if manifest is not None:
+            files, _ = manifest.changes(files)
+        stage.add(len(files), sum(size for _, size, _ in files))
+    return [image_path for image_path, _, _ in files]
+
+
+def chunked(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main(input_dir, output, num_processes=None, mode='structure', chunk_size=64, manifest=None):
+    """
+    Check all jpg images under input_dir and write a "path exitcode" line per image to output as
+    the results come in. The directory tree is scanned once, while the images are checked in chunks
+    on a pool of processes, with a bounded number of chunks submitted at a time. With manifest, the
+    path of a FileManifest, only the images that changed since the last run with it are checked,
+    and the manifest is updated once all are.
+    Returns the number of images that are not valid.
+    """
+    num_processes = num_processes or os.cpu_count()
+    max_in_flight = 2 * num_processes
+    num_invalid = 0
+    file_manifest = FileManifest(manifest) if manifest else None
+    image_paths = find_images(input_dir, manifest=file_manifest)
+    with run_metrics.stage('check', workers=num_processes) as stage, ProcessPoolExecutor(max_workers=num_processes) as executor:
+        in_flight = set()
+
+        def write(futures):
+            nonlocal num_invalid
+            for future in futures:
+                lines = future.result()
+                output.writelines(lines)
+                num_invalid += sum(not line.endswith(f" {VALID}\n") for line in lines)
+                stage.add(len(lines))
+            output.flush()
+
+        for chunk in chunked(image_paths, chunk_size):
+            in_flight.add(executor.submit(check_images, chunk, mode))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                write(done)
+        write(wait(in_flight).done)
+    if file_manifest is not None:
+        file_manifest.save()
+    return num_invalid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check all jpg images in a directory and its subdirectories for corruption.")
+    parser.add_argument('input_dir', help="Directory with the images to check")
+    parser.add_argument('--processes', type=int, default=None, help="Number of processes to check images on (default: one per CPU)")
+    parser.add_argument('--mode', choices=MODES, default='structure',
+                        help="Check the markers and segments of every image, or also decode it completely (default: structure)")
+    parser.add_argument('--output', default=None, help="Append the results to this file instead of writing them to standard output")
+    parser.add_argument('--manifest', default=None, help="Only check the images that changed since the last run with this manifest file, which is updated at the end")
+    parser.add_argument('--chunk_size', type=int, default=64, help="Number of images per task for the process pool (default: 64)")
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if not os.path.isdir(args.input_dir):
+        print("please provide path to images to be checked")
+        sys.exit(1)
+    if args.metrics:
+        run_metrics.start('find-corrupted-jpg', profile_stage=args.profile_stage)
+    if args.output is None:
+        main(args.input_dir, sys.stdout, args.processes, args.mode, args.chunk_size, args.manifest)
+    else:
+        with open(args.output, 'a') as f:
+            main(args.input_dir, f, args.processes, args.mode, args.chunk_size, args.manifest)
+    if args.metrics:
+        run_metrics.current().write(args.metrics)
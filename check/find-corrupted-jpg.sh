@@ -1,18 +1,32 @@
 #!/bin/bash
 # find-corrupted-jpg.sh
 # Description: checks all jpg images in the given directory for corruption single-threadedly
-# Usage: ./find-corrupted-jpg.sh /PATH/TO/IMAGES
+# Usage: ./find-corrupted-jpg.sh /PATH/TO/IMAGES [MANIFEST_FILE]
 # Expected output: 0 for valid images, 1 for corrupted ones, other numbers for errors
-# Dependencies: ImageMagick
+# With MANIFEST_FILE, only the images that changed since the last run with that manifest are checked
+# Dependencies: ImageMagick, python3 for MANIFEST_FILE
 
 if [ -z "$1" ]; then 
     echo "please provide path to images to be checked"
     exit 1
 fi
 
+list_images() {
+    if [ -n "$2" ]; then
+        python3 "$(dirname "$0")/../scan/file_manifest.py" "$1" --extension .jpg --follow_links --manifest "$2" --changed
+    else
+        find -L "$1" -name '*.jpg' -type f
+    fi
+}
+
 # check jpg images for corruption. Only use one process at a time to avoid race conditions in the output
-find -L "$1" -name '*.jpg' -type f |
+list_images "$1" "$2" |
     xargs -P 1 -I % sh -c '
         identify -regard-warnings -verbose % > /dev/null 2>&1
         echo % $?
     '
+
+# the checked images count as seen for the next run
+if [ -n "$2" ]; then
+    python3 "$(dirname "$0")/../scan/file_manifest.py" "$1" --manifest "$2" --commit
+fi
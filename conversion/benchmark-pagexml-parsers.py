@@ -0,0 +1,60 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+
+# pagexml-to-text.py is a script, not a module, so it is loaded from its path
+spec = importlib.util.spec_from_file_location('pagexml_to_text', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pagexml-to-text.py'))
+pagexml_to_text = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pagexml_to_text)
+
+# The synthetic data generators shared by all benchmarks
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark')
+if BENCHMARK_DIR not in sys.path:
+    sys.path.append(BENCHMARK_DIR)
+from synthetic_data import synthetic_pagexml  # noqa: E402
+
+
+def pages_per_second(read_pagexml, pagexml_files, options, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_path in pagexml_files:
+            read_pagexml(file_path, **options)
+        best = min(best, time.perf_counter() - start)
+    return len(pagexml_files) / best
+
+
+def main(input_dir, num_pages, repeat):
+    options = dict(separate_single_words=True, merge_dashes=True, split_periods=True, merge_quotes=False, separate_colons=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if input_dir is None:
+            rng = random.Random(0)
+            input_dir = tmp_dir
+            for i in range(num_pages):
+                with open(os.path.join(tmp_dir, f"page-{i:05d}.xml"), 'w', encoding='utf-8') as f:
+                    f.write(synthetic_pagexml(rng))
+        pagexml_files = [input_path for input_path, _ in pagexml_to_text.list_pagexml_files(input_dir, '', recursive=True)]
+
+        parsers = [('tree (ElementTree)', pagexml_to_text.read_pagexml_file),
+                   ('stream (ElementTree)', lambda file_path, **kwargs: pagexml_to_text.read_pagexml_stream(file_path, use_lxml=False, **kwargs))]
+        if pagexml_to_text.lxml_etree is not None:
+            parsers.append(('stream (lxml)', lambda file_path, **kwargs: pagexml_to_text.read_pagexml_stream(file_path, use_lxml=True, **kwargs)))
+        else:
+            print("lxml is not installed, skipping the lxml fast path")
+
+        print(f"{len(pagexml_files)} pages, best of {repeat} runs")
+        for name, read_pagexml in parsers:
+            print(f"{name:22s} {pages_per_second(read_pagexml, pagexml_files, options, repeat):10.1f} pages/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the pages per second of the PageXML parsers of pagexml-to-text.py.")
+    parser.add_argument('--input_dir', default=None, help="Directory with PageXML files to parse, by default synthetic pages are generated")
+    parser.add_argument('--pages', type=int, default=200, help="Number of synthetic pages to generate (default: 200)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, the fastest one is reported (default: 3)")
+    args = parser.parse_args()
+    main(args.input_dir, args.pages, args.repeat)
@@ -0,0 +1,109 @@
+import glob
+import json
+import os
+
+SHARD_FORMATS = {'jsonl': '.jsonl', 'packed': '.txt'}
+INDEX_SUFFIX = '.idx'
+
+
+def page_text(lines):
+    """The text of a page as pagexml-to-text.py writes it to a .txt file."""
+    return ''.join(line + '\n' for line in lines)
+
+
+class PageShardWriter:
+    """
+    Write the text of many pages to one shard file instead of one .txt file per page.
+
+    In the jsonl format every page is one line {"id": ..., "lines": [...]}, in the packed format the
+    pages are stored back to back, each exactly as its .txt file would be. Next to the shard,
+    shard + '.idx' lists the page id, byte offset and byte length of every page, one JSON array per line.
+    Both are written under temporary names and renamed on close, the index last, so a shard with
+    an index is always complete.
+    """
+
+    def __init__(self, path, shard_format='jsonl'):
+        self.path = path
+        self.shard_format = shard_format
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+        self._index = []
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def write(self, page_id, lines):
+        if self.shard_format == 'jsonl':
+            record = json.dumps({'id': page_id, 'lines': lines}, ensure_ascii=False).encode('utf-8') + b'\n'
+        else:
+            record = page_text(lines).encode('utf-8')
+        self._file.write(record)
+        self._index.append(json.dumps([page_id, self._offset, len(record)], ensure_ascii=False) + '\n')
+        self._offset += len(record)
+
+    def close(self, complete=True):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if not complete:
+            os.remove(self._tmp_path)
+            return
+        os.replace(self._tmp_path, self.path)
+        index_tmp_path = f"{self.path}{INDEX_SUFFIX}.{os.getpid()}.tmp"
+        with open(index_tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(self._index)
+        os.replace(index_tmp_path, self.path + INDEX_SUFFIX)
+
+
+def shard_paths(directory):
+    """The complete shards in directory, those with an index."""
+    return sorted(index_path[:-len(INDEX_SUFFIX)] for index_path in glob.glob(os.path.join(glob.escape(directory), '*' + INDEX_SUFFIX)))
+
+
+class PageStore:
+    """
+    Read single pages by id from the shards that pagexml-to-text.py wrote to a directory, without
+    reading the shards themselves. Only the indexes are loaded.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pages = {}
+        for path in shard_paths(directory):
+            with open(path + INDEX_SUFFIX, 'r', encoding='utf-8') as f:
+                for entry in f:
+                    page_id, offset, length = json.loads(entry)
+                    self.pages[page_id] = (path, offset, length)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, page_id):
+        return page_id in self.pages
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def read(self, page_id):
+        """The stored bytes of a page."""
+        path, offset, length = self.pages[page_id]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def lines(self, page_id):
+        """The text lines of a page."""
+        if self.pages[page_id][0].endswith(SHARD_FORMATS['jsonl']):
+            return json.loads(self.read(page_id))['lines']
+        return self.text(page_id).split('\n')[:-1]
+
+    def text(self, page_id):
+        """The text of a page, as its .txt file would hold it."""
+        if self.pages[page_id][0].endswith(SHARD_FORMATS['jsonl']):
+            return page_text(self.lines(page_id))
+        return self.read(page_id).decode('utf-8')
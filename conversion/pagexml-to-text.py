@@ -1,13 +1,101 @@
 import xml.etree.ElementTree as ET
 import os
 import argparse
+import glob
+import json
+import sys
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 import tqdm
 
+from page_shards import SHARD_FORMATS, PageShardWriter
+
+# The directory scanner shared by all tools
+SCAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scan')
+if SCAN_DIR not in sys.path:
+    sys.path.append(SCAN_DIR)
+from file_manifest import FileManifest, scan_files  # noqa: E402
+
+# The opt-in metrics shared by all tools
+METRICS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metrics')
+if METRICS_DIR not in sys.path:
+    sys.path.append(METRICS_DIR)
+import run_metrics  # noqa: E402
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml is optional, without it the streaming parser runs on xml.etree.ElementTree
+    lxml_etree = None
+
 
 # this tool only supports PageXML 2013 and 2019 formats for now, we will add more later
+PAGE_NAMESPACE_2019 = 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15'
+PAGE_NAMESPACE_2013 = 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15'
+PARSERS = ('stream', 'tree')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def merge_region_lines(region_lines, merged_lines, separate_single_words, merge_dashes, split_periods, separate_colons):
+    """Apply the text merging rules of read_pagexml_file to the lines of one TextRegion, appending the results to merged_lines."""
+    # Skip empty regions
+    if not region_lines:
+        return
 
+    i = 0
+    while i < len(region_lines):
+        # Get current line
+        current = region_lines[i]
+        i += 1
 
-def read_pagexml_file(file_path, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons):
+        # Skip empty lines
+        if not current:
+            continue
+
+        # Rule 1: If line is a single word, it's separate
+        if separate_single_words and len(current.split()) == 1:
+            # if both lines have similar x coordinate, merge them
+            # TODO
+
+
+            merged_lines.append(current)
+            continue
+
+        # Collect lines to merge
+        while i < len(region_lines):
+            next_line = region_lines[i]
+
+            # Skip empty lines
+            if not next_line:
+                i += 1
+                continue
+
+            # Rule 2: If current ends with period and next starts with capital,
+            # don't merge them
+            if split_periods and current.endswith('.') and next_line and next_line[0].isupper():
+                break
+
+            # Rule 3: If next line is single word, don't merge with it
+            if separate_single_words and len(next_line.split()) == 1:
+                break
+
+            # Rule 4: Handle hyphenation
+            if merge_dashes and current.endswith('-') :
+                current = current[:-1] + next_line
+            elif separate_colons and current.endswith(':'):
+                break
+            else:
+                # Default case: merge with space
+                current += " " + next_line
+
+            i += 1
+
+        # Add the processed line
+        merged_lines.append(current)
+
+
+def read_pagexml_file(file_path, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons, raise_errors=False):
     """
     Parse PageXML file and extract text from PlainText elements.
     Apply text merging rules:
@@ -17,6 +105,8 @@ def read_pagexml_file(file_path, separate_single_words, merge_dashes, split_peri
     4. Hyphenated words at line breaks are joined
     5. Lines starting/ending with quotes are merged, typical for early modern handwritten text
     6. Otherwise, consecutive lines are merged with spaces
+
+    A file that cannot be parsed gives no lines, or raises the error with raise_errors.
     """
     try:
         # Register the namespace
@@ -65,91 +155,385 @@ def read_pagexml_file(file_path, separate_single_words, merge_dashes, split_peri
 
 
 
-            # Skip empty regions
-            if not region_lines:
+            merge_region_lines(region_lines, merged_lines, separate_single_words, merge_dashes, split_periods, separate_colons)
+
+        return merged_lines
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Error reading PageXML file {file_path}: {e}")
+        return []
+
+def leftmost_x(points):
+    """The lowest x of a Coords points string "x1,y1 x2,y2 ...", in one pass without a list of all of them."""
+    return min((int(point.partition(',')[0]) for point in points.split()), default=float('inf'))
+
+
+def _iter_text_regions(file_path, use_lxml):
+    """
+    Yield the namespace, event and element of the start and end of every TextRegion in the namespace of
+    the root element, in document order. Everything outside the regions is dropped once it ended.
+    """
+    open_regions = 0
+    if use_lxml:
+        # lxml only reports the regions, and comments and processing instructions are dropped like
+        # ElementTree does, so .text is the same
+        region_tags = [f'{{{ns}}}TextRegion' for ns in (PAGE_NAMESPACE_2019, PAGE_NAMESPACE_2013)]
+        region_tag = None
+        for event, element in lxml_etree.iterparse(file_path, events=('start', 'end'), tag=region_tags, remove_comments=True,
+                                                   remove_pis=True, resolve_entities=False):
+            if region_tag is None:
+                ns = PAGE_NAMESPACE_2019 if 'pagecontent/2019-07-15' in element.getroottree().getroot().tag else PAGE_NAMESPACE_2013
+                region_tag = f'{{{ns}}}TextRegion'
+            # Like findall, the root element itself is not one of the regions
+            if element.tag != region_tag or element.getparent() is None:
                 continue
+            yield ns, event, element
+            open_regions += 1 if event == 'start' else -1
+            if event == 'end' and not open_regions:
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        return
+
+    events = ET.iterparse(file_path, events=('start', 'end'))
+    _, root = next(events)
+    ns = PAGE_NAMESPACE_2019 if 'pagecontent/2019-07-15' in root.tag else PAGE_NAMESPACE_2013
+    region_tag = f'{{{ns}}}TextRegion'
+    for event, element in events:
+        if element.tag == region_tag and element is not root:
+            yield ns, event, element
+            open_regions += 1 if event == 'start' else -1
+        elif event == 'end' and not open_regions:
+            element.clear()
+
+
+def read_pagexml_stream(file_path, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons,
+                        raise_errors=False, use_lxml=None):
+    """
+    Give the same lines as read_pagexml_file, from iterparse events instead of a full tree.
 
-            i = 0
-            while i < len(region_lines):
-                # Get current line
-                current = region_lines[i]
-                i += 1
+    Every TextRegion is handled when it ends and then cleared, as is everything outside the
+    regions, so memory stays at about one region. The lines of nested regions are kept in the
+    order in which the regions start, like the document order of findall. With use_lxml, or by
+    default when lxml is installed, lxml's iterparse is used, which only reports the regions.
+    """
+    if use_lxml is None:
+        use_lxml = lxml_etree is not None
+    try:
+        region_merged_lines = []  # Merged lines of every TextRegion, in the order in which they start
+        open_regions = []  # Index in region_merged_lines of every TextRegion that has not ended yet
+        for ns, event, element in _iter_text_regions(file_path, use_lxml):
+            if event == 'start':
+                open_regions.append(len(region_merged_lines))
+                region_merged_lines.append(None)
+                continue
+            line_tag = f'{{{ns}}}TextLine'
+            equiv_tag = f'{{{ns}}}TextEquiv'
+            plain_text_tag = f'{{{ns}}}PlainText'
+            coords_tag = f'{{{ns}}}Coords'
 
-                # Skip empty lines
-                if not current:
+            region_lines = []
+            region_lines_start = []
+            for text_line in element:
+                if text_line.tag != line_tag:
                     continue
+                coords = None
+                for text_equiv in text_line:
+                    if text_equiv.tag != equiv_tag:
+                        continue
+                    plain_text = next((child for child in text_equiv if child.tag == plain_text_tag), None)
+                    if plain_text is not None and plain_text.text:
+                        region_lines.append(plain_text.text.strip())
+                        # add left most x coordinate of the line
+                        if coords is None:
+                            coords = next((child for child in text_line if child.tag == coords_tag), False)
+                        if coords is not False and 'points' in coords.attrib:
+                            region_lines_start.append(leftmost_x(coords.attrib['points']))
+                        else:
+                            region_lines_start.append(float('inf'))
 
-                # Rule 1: If line is a single word, it's separate
-                if separate_single_words and len(current.split()) == 1:
-                    # if both lines have similar x coordinate, merge them
-                    # TODO
+            merged_lines = []
+            merge_region_lines(region_lines, merged_lines, separate_single_words, merge_dashes, split_periods, separate_colons)
+            region_merged_lines[open_regions.pop()] = merged_lines
+            element.clear()
 
+        return [line for merged_lines in region_merged_lines for line in merged_lines]
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Error reading PageXML file {file_path}: {e}")
+        return []
 
-                    merged_lines.append(current)
-                    continue
 
-                # Collect lines to merge
-                while i < len(region_lines):
-                    next_line = region_lines[i]
+def list_pagexml_files(input_dir, output_dir, recursive=False, manifest=None):
+    """
+    Pair every .xml file in input_dir with its .txt output path in output_dir. With recursive, the
+    .xml files in all subdirectories are included too, and their outputs keep the same relative path.
+    With a FileManifest, only the files that changed since it was saved are listed, and the scan is
+    staged in it.
+    """
+    files = scan_files(input_dir, '.xml', recursive)
+    if manifest is not None:
+        files, _ = manifest.changes(files)
+    pagexml_files = []
+    for input_path, _, _ in files:
+        subdir, f = os.path.split(input_path)
+        if not recursive:
+            pagexml_files.append((input_path, os.path.join(output_dir, f.replace('.xml', '.txt'))))
+            continue
+        relative_dir = os.path.relpath(subdir, input_dir)
+        pagexml_files.append((input_path, os.path.normpath(os.path.join(output_dir, relative_dir, f.replace('.xml', '.txt')))))
+    return pagexml_files
+
+
+def is_up_to_date(input_path, output_path):
+    """Whether output_path exists and was written after input_path was last changed."""
+    try:
+        return os.stat(output_path).st_mtime_ns >= os.stat(input_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
 
-                    # Skip empty lines
-                    if not next_line:
-                        i += 1
-                        continue
 
-                    # Rule 2: If current ends with period and next starts with capital,
-                    # don't merge them
-                    if split_periods and current.endswith('.') and next_line and next_line[0].isupper():
-                        break
+def write_lines_atomic(output_path, lines):
+    """Write lines to output_path through a temporary file in the same directory, so a reader never sees half a file."""
+    tmp_path = os.path.join(os.path.dirname(output_path), f".{os.path.basename(output_path)}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as out_f:
+            for line in lines:
+                out_f.write(line + '\n')
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-                    # Rule 3: If next line is single word, don't merge with it
-                    if separate_single_words and len(next_line.split()) == 1:
-                        break
 
-                    # Rule 4: Handle hyphenation
-                    if merge_dashes and current.endswith('-') :
-                        current = current[:-1] + next_line
-                    elif separate_colons and current.endswith(':'):
-                        break
-                    else:
-                        # Default case: merge with space
-                        current += " " + next_line
+def list_archives(input_dir, recursive=False):
+    """The zip and tar archives in input_dir, or in all its subdirectories with recursive. input_dir can be a single archive too."""
+    if os.path.isfile(input_dir):
+        return [input_dir]
+    if not recursive:
+        return sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(ARCHIVE_EXTENSIONS))
+    return sorted(os.path.join(subdir, f) for subdir, _, files in os.walk(input_dir) for f in files if f.endswith(ARCHIVE_EXTENSIONS))
 
-                    i += 1
 
-                # Add the processed line
-                merged_lines.append(current)
+def archive_output_prefix(archive_path, input_dir, output_dir):
+    """The directory in output_dir for the pages of an archive, named after the archive without its extension."""
+    relative_path = os.path.basename(archive_path) if os.path.isfile(input_dir) else os.path.relpath(archive_path, input_dir)
+    for extension in ARCHIVE_EXTENSIONS:
+        if relative_path.endswith(extension):
+            return os.path.join(output_dir, relative_path[:-len(extension)])
 
-        return merged_lines
-    except Exception as e:
-        print(f"Error reading PageXML file {file_path}: {e}")
-        return []
 
-def main(input_dir, output_dir, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons):
-    os.makedirs(output_dir, exist_ok=True)
-    pagexml_files = [f for f in os.listdir(input_dir) if f.endswith('.xml')]
-    for xml_file in tqdm.tqdm(pagexml_files, desc="Processing PageXML files"):
-        input_path = os.path.join(input_dir, xml_file)
-        output_path = os.path.join(output_dir, xml_file.replace('.xml', '.txt'))
+def iter_archive_members(archive_path):
+    """
+    Yield the name and a readable file of every .xml member of a zip or tar archive, without
+    extracting it. Tar archives, compressed or not, are read once from start to end.
+    """
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.endswith('.xml'):
+                    with archive.open(info) as f:
+                        yield info.filename, f
+    else:
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.xml'):
+                    yield member.name, archive.extractfile(member)
+
+
+def iter_task_pages(task):
+    """Yield the input name, output path and the path or open file to parse, of every page of a task."""
+    if 'archive' in task:
+        for name, f in iter_archive_members(task['archive']):
+            yield f"{task['archive']}:{name}", os.path.normpath(os.path.join(task['output_prefix'], name.replace('.xml', '.txt'))), f
+    else:
+        for input_path, output_path in task['files']:
+            yield input_path, output_path, input_path
+
+
+def list_tasks(input_dir, output_dir, recursive=False, archives=False, files_per_task=64, manifest=None):
+    """
+    Split the conversion of input_dir into tasks for iter_task_pages: lists of up to files_per_task
+    PageXML files, and with archives, or when input_dir is an archive, one task per archive. With a
+    manifest, see list_pagexml_files, only changed PageXML files are listed, archives always are.
+    """
+    tasks = []
+    if not os.path.isfile(input_dir):
+        pagexml_files = list_pagexml_files(input_dir, output_dir, recursive, manifest)
+        tasks += [{'files': pagexml_files[i:i + files_per_task]} for i in range(0, len(pagexml_files), files_per_task)]
+    if archives or os.path.isfile(input_dir):
+        tasks += [{'archive': archive_path, 'output_prefix': archive_output_prefix(archive_path, input_dir, output_dir)}
+                  for archive_path in list_archives(input_dir, recursive)]
+    return tasks
 
-        lines = read_pagexml_file(input_path, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons)
 
-        with open(output_path, 'w', encoding='utf-8') as out_f:
-            for line in lines:
-                out_f.write(line + '\n')
+def page_id(output_path, output_dir):
+    """The identifier of a page, its output path relative to output_dir without .txt."""
+    return os.path.splitext(os.path.relpath(output_path, output_dir))[0]
 
-    print(f"Processed {len(pagexml_files)} files. Output written to {output_dir}")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert PageXML files to plain text with merging rules.")
-    parser.add_argument('--input_dir', required=True, help="Directory containing PageXML files")
-    parser.add_argument('--output_dir', required=True, help="Directory to save output text files")
+def convert_task(task, output_dir, options, parser='stream', output_format='txt', incremental=False, shard_path=None):
+    """
+    Convert the pages of one task: a list of PageXML files, or one archive. Pages are written to
+    their .txt output path, or with another output_format all to the shard at shard_path.
+    Returns the number of pages, the number of pages skipped by incremental and the failed pages.
+    """
+    read_pagexml = read_pagexml_stream if parser == 'stream' else read_pagexml_file
+    num_pages = 0
+    num_skipped = 0
+    failed = []
+    writer = PageShardWriter(shard_path, output_format) if output_format != 'txt' else nullcontext()
+    with writer:
+        try:
+            for input_name, output_path, source in iter_task_pages(task):
+                num_pages += 1
+                # Archive members are untrusted paths, they are kept in the directory of their archive
+                relative_path = os.path.relpath(output_path, task.get('output_prefix', output_dir))
+                if relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+                    failed.append({'input': input_name, 'error': "ValueError: the page would be written outside the directory of its archive"})
+                    continue
+                if incremental and output_format == 'txt' and is_up_to_date(task.get('archive', input_name), output_path):
+                    num_skipped += 1
+                    continue
+                try:
+                    lines = read_pagexml(source, raise_errors=True, **options)
+                except Exception as e:
+                    failed.append({'input': input_name, 'error': f"{type(e).__name__}: {e}"})
+                    continue
+                if output_format != 'txt':
+                    writer.write(page_id(output_path, output_dir), lines)
+                    continue
+                os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+                write_lines_atomic(output_path, lines)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            if 'archive' not in task:
+                raise
+            # A broken archive, the pages read before it broke are kept
+            failed.append({'input': task['archive'], 'error': f"{type(e).__name__}: {e}"})
+    return num_pages, num_skipped, failed
+
+
+def _convert_task(args):
+    return convert_task(*args)
+
+
+def main(input_dir, output_dir, separate_single_words, merge_dashes, split_periods, merge_quotes, separate_colons,
+         recursive=False, num_processes=0, incremental=False, failed_list=None, parser='stream', archives=False,
+         output_format='txt', pages_per_shard=10000, manifest=None):
+    """
+    Convert the PageXML files in input_dir to text files in output_dir.
+
+    With num_processes, files are converted on a process pool. With incremental, files whose output
+    is newer than the file itself are skipped. Outputs are written atomically, and files that fail
+    to parse get no output. They are printed, and with failed_list written to that path as a JSON
+    list of {"input": ..., "error": ...}, so they can be looked at or retried.
+
+    parser is 'stream' for read_pagexml_stream or 'tree' for read_pagexml_file, both give the same text.
+
+    With archives, or when input_dir is an archive, the .xml members of the zip and tar archives are
+    read without extracting them, one archive per task. Their pages go to a directory named after
+    the archive. With output_format 'jsonl' or 'packed', pages are written to shards instead of .txt
+    files, one per archive or per pages_per_shard files, see PageShardWriter and PageStore.
+
+    With manifest, the path of a FileManifest, only the PageXML files that changed since the last
+    run with the same manifest are converted, without looking at their outputs. The manifest is
+    saved at the end, without the files that failed, so they are tried again next time.
+    """
+    if (incremental or manifest) and output_format != 'txt':
+        raise ValueError("incremental and manifest are only supported for the txt output format")
+    os.makedirs(output_dir, exist_ok=True)
+    file_manifest = FileManifest(manifest) if manifest else None
+    with run_metrics.stage('walk') as stage:
+        tasks = list_tasks(input_dir, output_dir, recursive, archives, 64 if output_format == 'txt' else pages_per_shard,
+                           file_manifest)
+        num_files = sum(len(task.get('files', ())) for task in tasks)
+        num_bytes = 0
+        if run_metrics.current().enabled:
+            # The size of every file is only looked up for the metrics
+            num_bytes = sum(os.path.getsize(task['archive']) if 'archive' in task else
+                            sum(os.path.getsize(input_path) for input_path, _ in task['files']) for task in tasks)
+        stage.add(num_files, num_bytes)
+
+    shard_paths = [None] * len(tasks)
+    if output_format != 'txt':
+        # Shards of an earlier run would be read together with the new ones
+        for old_shard in glob.glob(os.path.join(glob.escape(output_dir), 'pages-[0-9][0-9][0-9][0-9][0-9]*')):
+            os.remove(old_shard)
+        shard_paths = [os.path.join(output_dir, f"pages-{i:05d}{SHARD_FORMATS[output_format]}") for i in range(len(tasks))]
+
+    options = dict(separate_single_words=separate_single_words, merge_dashes=merge_dashes, split_periods=split_periods,
+                   merge_quotes=merge_quotes, separate_colons=separate_colons)
+    task_args = [(task, output_dir, options, parser, output_format, incremental, shard_path) for task, shard_path in zip(tasks, shard_paths)]
+    num_pages = 0
+    num_skipped = 0
+    failed = []
+    pbar = tqdm.tqdm(total=None if any('archive' in task for task in tasks) else num_files, desc="Processing PageXML files", unit='pages')
+    with run_metrics.stage('convert', workers=num_processes or 1) as stage:
+        if num_processes:
+            with ProcessPoolExecutor(max_workers=num_processes) as executor:
+                results = executor.map(_convert_task, task_args)
+                for task_pages, task_skipped, task_failed in results:
+                    num_pages += task_pages
+                    num_skipped += task_skipped
+                    failed += task_failed
+                    pbar.update(task_pages)
+        else:
+            for args in task_args:
+                task_pages, task_skipped, task_failed = _convert_task(args)
+                num_pages += task_pages
+                num_skipped += task_skipped
+                failed += task_failed
+                pbar.update(task_pages)
+        stage.add(num_pages - num_skipped, num_bytes)
+    pbar.close()
+
+    if incremental:
+        print(f"Skipped {num_skipped} files that were already up to date")
+    if file_manifest is not None and file_manifest.staged is not None:
+        print(f"Skipped {len(file_manifest.staged) - num_files} files that did not change since the last run")
+        with run_metrics.stage('manifest'):
+            file_manifest.save(exclude=[failure['input'] for failure in failed])
+    for failure in failed:
+        print(f"Error reading PageXML file {failure['input']}: {failure['error']}")
+    if failed_list is not None:
+        with open(failed_list, 'w', encoding='utf-8') as f:
+            json.dump(failed, f, ensure_ascii=False, indent=4)
+    print(f"Processed {num_pages - num_skipped} files, {len(failed)} failed. Output written to {output_dir}")
+    return failed
+
+def add_conversion_arguments(parser):
+    """Options shared by this script and the pagexml subcommand of find-ngrams.py."""
     parser.add_argument('--merge_dashes', action='store_true', help="Enable merging of hyphenated words at line breaks")
     parser.add_argument('--split_periods', action='store_true', help="Enable splitting lines ending with periods before capital letters. This should result in each text line being a full sentence. If disabled, there should be a full paragraph per outputted text line.")
     parser.add_argument('--merge_quotes', action='store_true', help="Enable merging lines starting/ending with quotes, typical for early modern handwritten text")
     parser.add_argument('--separate_single_words', action='store_true', help="Keep single-word lines separate, typical for headings and question forms")
     parser.add_argument('--separate_colons', action='store_true', help="Keep lines ending with colon separate, typical for lists and definitions")
+    parser.add_argument('--recursive', action='store_true', help="Also convert PageXML files in subdirectories, keeping the directory structure in the output")
+    parser.add_argument('--parser', choices=PARSERS, default='stream', help="Parse files streaming with iterparse (and lxml when installed), or as a full ElementTree (default: stream)")
+    parser.add_argument('--archives', action='store_true', help="Also read the PageXML files in the zip and tar archives in the input directory, without extracting them")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert PageXML files to plain text with merging rules.")
+    parser.add_argument('--input_dir', required=True, help="Directory containing PageXML files, or a zip or tar archive of them")
+    parser.add_argument('--output_dir', required=True, help="Directory to save output text files")
+    parser.add_argument('--processes', type=int, default=0, help="Convert files on a pool of this many processes (default: 0, in this process)")
+    add_conversion_arguments(parser)
+    parser.add_argument('--incremental', action='store_true', help="Skip files whose output is newer than the PageXML file")
+    parser.add_argument('--manifest', default=None, help="Only convert the PageXML files that changed since the last run with this manifest file, which is updated at the end")
+    parser.add_argument('--output_format', choices=('txt',) + tuple(SHARD_FORMATS), default='txt', help="Write a .txt file per page, or shards of pages in JSONL or packed text with an offset index (default: txt)")
+    parser.add_argument('--pages_per_shard', type=int, default=10000, help="Number of PageXML files per shard, archives get a shard each (default: 10000)")
+    parser.add_argument('--failed_list', default=None, help="Write the files that could not be converted to this JSON file")
+    run_metrics.add_metrics_arguments(parser)
 
 
     args = parser.parse_args()
-    main(args.input_dir, args.output_dir, args.separate_single_words, args.merge_dashes, args.split_periods, args.merge_quotes, args.separate_colons)
+    if args.metrics:
+        run_metrics.start('pagexml-to-text', profile_stage=args.profile_stage)
+    main(args.input_dir, args.output_dir, args.separate_single_words, args.merge_dashes, args.split_periods, args.merge_quotes, args.separate_colons,
+         recursive=args.recursive, num_processes=args.processes, incremental=args.incremental, failed_list=args.failed_list, parser=args.parser,
+         archives=args.archives, output_format=args.output_format, pages_per_shard=args.pages_per_shard, manifest=args.manifest)
+    if args.metrics:
+        run_metrics.current().write(args.metrics)
@@ -0,0 +1,46 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import extract_main_bounding_box
+
+# The synthetic data generators shared by all benchmarks
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark')
+if BENCHMARK_DIR not in sys.path:
+    sys.path.append(BENCHMARK_DIR)
+from synthetic_data import synthetic_scan  # noqa: E402
+
+
+def relative_error(rect, size):
+    return max(abs(found - true) / true for found, true in zip(sorted(rect[1]), sorted(size)))
+
+
+def main(num_images, width, height, repeat):
+    rng = np.random.default_rng(0)
+    scans = [synthetic_scan(rng, width, height) for _ in range(num_images)]
+    binary_images = [extract_main_bounding_box.binarize_image(image) for image, _ in scans]
+    contours = [len(cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]) for binary_image in binary_images]
+    print(f"{num_images} images of {width}x{height}, {np.mean(contours):.0f} contours per image, best of {repeat} runs")
+    print(f"{'method':16s} {'images/s':>10s} {'mean error':>11s} {'max error':>10s}")
+    for method in extract_main_bounding_box.METHODS:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rects = [extract_main_bounding_box.extract_main_rect(binary_image, method) for binary_image in binary_images]
+            best = min(best, time.perf_counter() - start)
+        errors = [relative_error(rect, size) for rect, (_, size) in zip(rects, scans)]
+        print(f"{method:16s} {num_images / best:10.1f} {100 * np.mean(errors):10.2f}% {100 * np.max(errors):9.2f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the speed and accuracy of the methods of extract_main_bounding_box.py on synthetic scans.")
+    parser.add_argument('--images', type=int, default=20, help="Number of synthetic scans (default: 20)")
+    parser.add_argument('--width', type=int, default=1500, help="Width of the scans in pixels (default: 1500)")
+    parser.add_argument('--height', type=int, default=2000, help="Height of the scans in pixels (default: 2000)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs, the fastest one is reported (default: 3)")
+    args = parser.parse_args()
+    main(args.images, args.width, args.height, args.repeat)
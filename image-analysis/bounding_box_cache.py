@@ -0,0 +1,95 @@
+import os
+import sqlite3
+
+CACHE_VERSION = 1
+
+
+class BoundingBoxCache:
+    """
+    The bounding box of every image processed before, in an SQLite database. Entries are keyed by
+    identifier and by the method and max_size of extract_main_bounding_box.py they were made with,
+    as those change the rectangle found, and this cache only reads and writes the entries of its own
+    method and max_size. An entry is only valid for the image with the size and modification time
+    it was made for: a changed image is a cache miss, and its new result replaces the old entry, so
+    the cache holds one entry per identifier and settings. Lookups go through the primary key
+    index, nothing is loaded up front. Width and height are stored as the text of the output file,
+    so export_tsv writes the same lines as extract_main_bounding_box.py.
+    """
+
+    def __init__(self, path, method='contour', max_size=None):
+        self.path = path
+        self.method = method
+        # Full resolution is stored as 0, NULL would make every entry distinct in the primary key
+        self.max_size = max_size or 0
+        self.connection = sqlite3.connect(path)
+        # WAL keeps readers working while results are committed chunk by chunk
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, CACHE_VERSION):
+            raise ValueError(f"{path} is a bounding box cache of version {version}, expected {CACHE_VERSION}")
+        self.connection.execute('CREATE TABLE IF NOT EXISTS boxes (identifier TEXT NOT NULL, method TEXT NOT NULL, '
+                                'max_size INTEGER NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                                'width TEXT NOT NULL, height TEXT NOT NULL, PRIMARY KEY (identifier, method, max_size))')
+        self.connection.execute(f'PRAGMA user_version={CACHE_VERSION}')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        """The number of entries made with the method and max_size of this cache."""
+        return self.connection.execute('SELECT COUNT(*) FROM boxes WHERE method = ? AND max_size = ?',
+                                       (self.method, self.max_size)).fetchone()[0]
+
+    def get(self, identifier, size, mtime_ns):
+        """
+        The output line of an image, or None when it is not cached with the method and max_size of
+        this cache or has changed since.
+        """
+        row = self.connection.execute('SELECT width, height FROM boxes WHERE identifier = ? AND method = ? AND max_size = ? '
+                                      'AND size = ? AND mtime_ns = ?',
+                                      (identifier, self.method, self.max_size, size, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        return f"{identifier}\t{row[0]}\t{row[1]}\n"
+
+    def put_lines(self, image_stats, lines):
+        """
+        Store the output lines of images, with the (path, size, mtime_ns) of every image in
+        image_stats, in the same order, in one transaction, as made with the method and max_size of
+        this cache.
+        """
+        rows = []
+        for (path, size, mtime_ns), line in zip(image_stats, lines):
+            identifier, width, height = line.rstrip('\n').split('\t')
+            rows.append((identifier, self.method, self.max_size, path, size, mtime_ns, width, height))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO boxes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def export_tsv(self, output_file):
+        """
+        Write all entries made with the method and max_size of this cache as an output file of
+        extract_main_bounding_box.py. Returns the number written.
+        """
+        count = 0
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            for identifier, width, height in self.connection.execute(
+                    'SELECT identifier, width, height FROM boxes WHERE method = ? AND max_size = ? ORDER BY identifier',
+                    (self.method, self.max_size)):
+                f.write(f"{identifier}\t{width}\t{height}\n")
+                count += 1
+        os.replace(tmp_file, output_file)
+        return count
+
+
+def image_stat(image_path):
+    """The path, size and modification time that a cache entry is valid for."""
+    stat = os.stat(image_path)
+    return image_path, stat.st_size, stat.st_mtime_ns
@@ -4,9 +4,23 @@ import sys
 import os
 from tqdm import tqdm
 from PIL import Image
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 import argparse
 
+from bounding_box_cache import BoundingBoxCache, image_stat
+
+# The directory scanner shared by all tools
+SCAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scan')
+if SCAN_DIR not in sys.path:
+    sys.path.append(SCAN_DIR)
+from file_manifest import scan_files  # noqa: E402
+
+# The opt-in metrics shared by all tools
+METRICS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metrics')
+if METRICS_DIR not in sys.path:
+    sys.path.append(METRICS_DIR)
+import run_metrics  # noqa: E402
+
 
 def binarize_image(image):
     if image is None:
@@ -19,15 +33,85 @@ def extract_bounding_rect(binary_image):
     contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
         raise ValueError("No contours found in the image")
-    largest_contour = max(contours, key=cv2.contourArea)
-    for contour in contours:
-        if cv2.contourArea(contour) > cv2.contourArea(largest_contour):
-            largest_contour = contour
+    # The area of every contour once, argmax keeps the first of equally large contours
+    areas = np.fromiter((cv2.contourArea(contour) for contour in contours), dtype=np.float64, count=len(contours))
+    largest_contour = contours[int(np.argmax(areas))]
     # print("largest_contour shape", largest_contour.shape)
     rect = cv2.minAreaRect(largest_contour)
     return rect
 
 
+METHODS = ('contour', 'projection', 'projection-pca')
+
+
+def profile_extent(profile, fraction=0.5):
+    """
+    The start and end of the main region along one axis: where the projection profile, smoothed,
+    first and last reaches fraction of its maximum.
+    """
+    profile = profile.astype(np.float64)
+    window = max(1, len(profile) // 100)
+    if window > 1:
+        profile = np.convolve(profile, np.ones(window) / window, mode='same')
+    above = np.flatnonzero(profile >= fraction * profile.max())
+    return above[0], above[-1] + 1
+
+
+def projection_profiles(binary_image):
+    """The number of foreground pixels in every column and in every row."""
+    columns = cv2.reduce(binary_image, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    rows = cv2.reduce(binary_image, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    return columns, rows
+
+
+def extract_projection_rect(binary_image, orient=False):
+    """
+    Estimate the main region of a binarized image from its column and row projection profiles,
+    instead of following contours. With orient, the region is first rotated to the principal axes
+    of its foreground, from the second order moments (PCA), so the width and height of a slightly
+    rotated page are its own instead of those of the rectangle around it.
+    Returns a rect like minAreaRect: center, (width, height) and angle in degrees, with the width
+    along the axis closest to horizontal.
+    """
+    columns, rows = projection_profiles(binary_image)
+    if not columns.any():
+        raise ValueError("No foreground found in the image")
+    left, right = profile_extent(columns)
+    top, bottom = profile_extent(rows)
+    if not orient:
+        return ((left + right) / 2.0, (top + bottom) / 2.0), (float(right - left), float(bottom - top)), 0.0
+
+    # The region with a margin for the corners of a rotated page
+    margin = int(0.1 * max(right - left, bottom - top))
+    x0, y0 = max(0, left - margin), max(0, top - margin)
+    region = binary_image[y0:bottom + margin, x0:right + margin]
+    moments = cv2.moments(region, binaryImage=True)
+    angle = 0.5 * np.degrees(np.arctan2(2 * moments['mu11'], moments['mu20'] - moments['mu02']))
+    # The principal axis closest to horizontal is the width
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    center = (moments['m10'] / moments['m00'], moments['m01'] / moments['m00'])
+    rotation = cv2.getRotationMatrix2D(center, angle, 1.0)
+    rotated = cv2.warpAffine(region, rotation, (region.shape[1], region.shape[0]), flags=cv2.INTER_NEAREST)
+    columns, rows = projection_profiles(rotated)
+    left, right = profile_extent(columns)
+    top, bottom = profile_extent(rows)
+    # The center of the rotated region back in the pixels of the image
+    center_x, center_y = cv2.invertAffineTransform(rotation) @ np.array([(left + right) / 2, (top + bottom) / 2, 1.0])
+    return (float(x0 + center_x), float(y0 + center_y)), (float(right - left), float(bottom - top)), float(angle)
+
+
+def extract_main_rect(binary_image, method='contour'):
+    """The main region of a binarized image, with one of METHODS."""
+    if method == 'contour':
+        return extract_bounding_rect(binary_image)
+    if method in ('projection', 'projection-pca'):
+        return extract_projection_rect(binary_image, orient=method == 'projection-pca')
+    raise ValueError(f"Unknown method {method}, expected one of {', '.join(METHODS)}")
+
+
 def load_image(image_path):
     image = Image.open(image_path)
     image = np.array(image)
@@ -35,15 +119,76 @@ def load_image(image_path):
     return image
 
 
-def process_image(image_path):
-    pbar.update(1)
-    identifier = image_path.split("/")[-1].replace('.thumbnail.jpg', '').replace(".jpg", "").replace(".jp2", "")
+# Resolution levels that JPEG 2000 encoders write by default, so reductions up to 2**5 can be decoded
+MAX_JP2_REDUCE = 5
 
+
+def decode_reduced(image_file, max_size, mode='L'):
+    """
+    Open and decode an image, a path or a file object, at the lowest resolution that still has a
+    longest side of at least about max_size pixels. JPEGs are decoded in draft mode, which scales
+    by 1/2, 1/4 or 1/8 inside the decoder and converts to mode on the way, and JPEG 2000 files at
+    a lower resolution level, so the full image is never decoded. Returns the decoded image and
+    the width and height of the original.
+    """
+    image = Image.open(image_file)
+    width, height = image.size
+    reduce = 0
+    if image.format == 'JPEG':
+        image.draft(mode, (max_size, max_size))
+    elif image.format == 'JPEG2000':
+        while reduce < MAX_JP2_REDUCE and max(width, height) >> (reduce + 1) >= max_size:
+            reduce += 1
+        image.reduce = reduce
     try:
-        image = load_image(image_path)
+        image.load()
+    except OSError:
+        # Files with fewer resolution levels than asked for are decoded in full
+        if not reduce:
+            raise
+        if hasattr(image_file, 'seek'):
+            image_file.seek(0)
+        image = Image.open(image_file)
+        image.load()
+    return image, (width, height)
+
+
+def load_image_reduced(image_path, max_size):
+    """
+    Decode an image straight to grayscale with its longest side at about max_size pixels, see
+    decode_reduced, and resize what remains. Returns the image and the horizontal and vertical
+    scale back to the original pixels.
+    """
+    image, (width, height) = decode_reduced(image_path, max_size)
+    image = image.convert('L')
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
+    return np.array(image), width / image.size[0], height / image.size[1]
+
+
+def scale_rect(rect, scale_x, scale_y):
+    """A rect from minAreaRect of a scaled image, in the pixels of the original image."""
+    if scale_x == scale_y == 1:
+        return rect
+    box = cv2.boxPoints(rect) * np.array([scale_x, scale_y], dtype=np.float32)
+    return cv2.minAreaRect(box)
+
+
+def image_identifier(file_name):
+    return file_name.split("/")[-1].replace('.thumbnail.jpg', '').replace(".jpg", "").replace(".jp2", "")
+
+
+def process_image(image_path, max_size=None, method='contour'):
+    identifier = image_identifier(image_path)
+
+    try:
+        if max_size:
+            image, scale_x, scale_y = load_image_reduced(image_path, max_size)
+        else:
+            image, scale_x, scale_y = load_image(image_path), 1, 1
         binary_image = binarize_image(image)
         # print(f"Extracting bounding box for {image_path}: {binary_image.shape}")
-        rect = extract_bounding_rect(binary_image)
+        rect = scale_rect(extract_main_rect(binary_image, method), scale_x, scale_y)
         # draw_bounding_box(image_path, rect)
 
         return f"{identifier}\t{rect[1][0]}\t{rect[1][1]}\n"
@@ -52,6 +197,11 @@ def process_image(image_path):
         return f"{identifier}\t0\t0\n"
 
 
+def process_images(image_paths, max_size=None, method='contour'):
+    """The output lines of a chunk of images, one task for the process pool."""
+    return [process_image(image_path, max_size, method) for image_path in image_paths]
+
+
 def read_cache(output_file):
     cache = {}
     if output_file is None:
@@ -64,6 +214,74 @@ def read_cache(output_file):
     return cache
 
 
+def resume_output(output_file):
+    """
+    The results already in output_file, by identifier, to continue a run that stopped. A last line
+    that was cut off halfway is removed from the file, so its image is processed again.
+    """
+    if not os.path.exists(output_file):
+        return {}
+    with open(output_file, 'rb+') as f:
+        content = f.read()
+        complete = content.rfind(b'\n') + 1
+        if complete < len(content):
+            f.truncate(complete)
+    return read_cache(output_file)
+
+
+IMAGE_EXTENSIONS = ('.jp2', '.jpg')
+
+
+def iter_image_paths(input_path):
+    """The .jpg and .jp2 files in a directory tree, or listed in a file, one path per line."""
+    if os.path.isdir(input_path):
+        for image_path, _, _ in scan_files(input_path, IMAGE_EXTENSIONS, follow_links=True):
+            yield image_path
+    elif os.path.isfile(input_path):
+        # read lines from a file
+        with open(input_path, 'r') as infile:
+            for line in infile:
+                line = line.strip()
+                file = os.path.basename(line)
+                if file.endswith('.jp2') or file.endswith('.jpg'):
+                    yield line
+
+
+def write_results(image_paths, f, num_processes, max_size=None, chunk_size=16, max_in_flight=None, on_results=None,
+                  method='contour'):
+    """
+    Process the images on a pool of num_processes and append their lines to the open file f as
+    they complete, flushed after every chunk, so a run that stops halfway keeps what it did. The
+    images are submitted in chunks of chunk_size, with at most max_in_flight chunks (by default two
+    per process) submitted at a time, so memory does not grow with the number of images. on_results
+    is called with every chunk of image paths and their lines, after they are written.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * num_processes
+    chunks = (image_paths[i:i + chunk_size] for i in range(0, len(image_paths), chunk_size))
+    with ProcessPoolExecutor(max_workers=num_processes) as executor, tqdm(total=len(image_paths)) as progress:
+        in_flight = {}
+
+        def write(future):
+            chunk = in_flight.pop(future)
+            lines = future.result()
+            f.writelines(lines)
+            f.flush()
+            if on_results is not None:
+                on_results(chunk, lines)
+            progress.update(len(lines))
+
+        for chunk in chunks:
+            in_flight[executor.submit(process_images, chunk, max_size, method)] = chunk
+            if len(in_flight) < max_in_flight:
+                continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                write(future)
+        for future in as_completed(list(in_flight)):
+            write(future)
+
+
 def draw_bounding_box(image_path, box):
     # Read the original image
     print("box-orig", box)
@@ -83,97 +301,107 @@ def draw_bounding_box(image_path, box):
     # cv2.destroyAllWindows()
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Extract main bounding box from images')
     parser.add_argument('--input', help='Directory containing input images or a file with image paths')
     parser.add_argument('--output_file', help='File to save the output')
     parser.add_argument('--cache_file', help='File containing existing cache')
+    parser.add_argument('--cache_db', help='SQLite cache of the results of earlier runs, an image that changed since is processed again')
+    parser.add_argument('--export_cache', help='Write all results in --cache_db of --method and --max_size to this file, in the format '
+                                               'of the output file, and stop')
     parser.add_argument('--threads', type=int, help='Number of threads to use', default=20)
-    parser.add_argument('--overwrite_results', action='store_true', help='Overwrite existing results in the output file')
+    parser.add_argument('--overwrite_results', action='store_true', help='Overwrite existing results in the output file, by default a run continues where the last one stopped')
     parser.add_argument('--limit', type=int, help='Limit the number of images to process', default=None)
-    args = parser.parse_args()
+    parser.add_argument('--max_size', type=int, default=None,
+                        help='Decode images in grayscale at reduced resolution, with the longest side at about this many pixels. '
+                             'The dimensions are still reported in original pixels (default: full resolution)')
+    parser.add_argument('--method', choices=METHODS, default='contour',
+                        help='Find the main region as the minimum area rectangle of the largest contour, or from the row and column '
+                             'projection profiles, along the principal axes with projection-pca. The projection methods are faster '
+                             'on noisy scans with many contours (default: contour)')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Number of images per task for the process pool (default: 16)')
+    parser.add_argument('--max_in_flight', type=int, default=None,
+                        help='Maximum number of tasks submitted at a time (default: two per thread)')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.export_cache:
+        if not args.cache_db:
+            parser.error('--export_cache needs --cache_db')
+        with BoundingBoxCache(args.cache_db, args.method, args.max_size) as cache_db:
+            print(f'exported {cache_db.export_tsv(args.export_cache)} cached results to {args.export_cache}')
+        return
 
     print('starting main bounding box extraction')
+    if args.metrics:
+        run_metrics.start('extract_main_bounding_box', profile_stage=args.profile_stage)
 
     output_file = args.output_file
-    cache_file = args.cache_file
-
-    global pbar
-    pbar = tqdm()
+    cache_db = BoundingBoxCache(args.cache_db, args.method, args.max_size) if args.cache_db else None
+    image_stats = {}
 
-    image_paths = set()
-    inventory_number_int_last = 0
     if args.overwrite_results:
         print('overwriting results')
+        done = {}
         cache = {}
+        open(output_file, 'w').close()
     else:
         print('reading cache')
-        cache = read_cache(cache_file)
-    counter =0
-    with open(output_file, 'w') as f:
+        # Results of an earlier run that stopped are kept, that run continues where it was
+        with run_metrics.stage('resume') as stage:
+            done = resume_output(output_file)
+            cache = read_cache(args.cache_file)
+            stage.add(len(done) + len(cache))
+
+    with open(output_file, 'a') as f:
+        # The cached results go to the output file first, as those of this run come in later
+        f.writelines(line if line.endswith('\n') else line + '\n' for identifier, line in cache.items() if identifier not in done)
+        f.flush()
+
         print('reading images')
-        if os.path.isdir(args.input):
-            for dir_path, dir_names, file_names in os.walk(args.input, followlinks=True):
-
-                for file in file_names:
-                    # if file.startswith('NL-HaNA') and (file.endswith('.jp2') or file.endswith('.jpg')):
-                    if file.endswith('.jp2') or file.endswith('.jpg'):
-                        pbar.update(1)
-                        # inventory_number = file.split('_')[2]
-                        identifier = file.replace('.thumbnail.jpg', '').replace(".jpg", "").replace(".jp2", "")
-                        if identifier in cache.keys():
-                            continue
-                        counter += 1
-                        if counter > args.limit:
-                            print(f'Limit of {args.limit} reached, stopping processing.')
-                            break
-                        # try:
-                        #     inventory_number_int = int(inventory_number)
-                        #     if 99202 <= inventory_number_int <= 100041:
-                        #         if inventory_number_int_last != inventory_number_int:
-                        #             print('skipping due to index-kaartje', file)
-                        #             inventory_number_int_last = inventory_number_int
-                        #         continue
-                        # except:
-                        #     # do nothing
-                        #     # print('not skipping', inventory_number)
-                        #     pass
-                        image_path = os.path.join(dir_path, file)
-                        # print (image_path)
-                        image_paths.add(image_path)
-        elif os.path.isfile(args.input):
-                            # read lines from a file
-            with open(args.input, 'r') as infile:
-                for line in infile:
-                    line = line.strip()
-                    file = os.path.basename(line)
-                    # if file.startswith('NL-HaNA') and (file.endswith('.jp2') or file.endswith('.jpg')):
-                    if file.endswith('.jp2') or file.endswith('.jpg'):
-                        # inventory_number = file.split('_')[2]
-                        identifier = file.replace('.thumbnail.jpg', '').replace(".jpg", "").replace(".jp2", "")
-                        if identifier in cache.keys():
-                            continue
-                        counter += 1
-                        if counter > args.limit:
-                            print(f'Limit of {args.limit} reached, stopping processing.')
-                            break
-
-                        pbar.update(1)
-                        image_paths.add(line)
+        image_paths = []
+        seen = set()
+        lookup_stage = run_metrics.stage('cache_lookup')
+        for image_path in tqdm(run_metrics.iter_stage('walk', iter_image_paths(args.input)), desc='images found'):
+            identifier = image_identifier(image_path)
+            if identifier in done or identifier in cache or image_path in seen:
+                continue
+            if cache_db is not None:
+                with lookup_stage:
+                    try:
+                        image_stats[image_path] = image_stat(image_path)
+                    except OSError:
+                        line = None
+                    else:
+                        line = cache_db.get(identifier, *image_stats[image_path][1:])
+                    lookup_stage.add(1)
+                if line is not None:
+                    del image_stats[image_path]
+                    done[identifier] = line
+                    f.write(line)
+                    continue
+            if args.limit is not None and len(image_paths) >= args.limit:
+                print(f'Limit of {args.limit} reached, stopping processing.')
+                break
+            seen.add(image_path)
+            image_paths.append(image_path)
 
         print('processing images: ', len(image_paths))
-        boxes = []
-        with ProcessPoolExecutor(max_workers=args.threads) as executor:
-            future_to_path = {executor.submit(process_image, path): path for path in image_paths}
-            for future in tqdm(as_completed(future_to_path), total=len(image_paths)):
-                box = future.result()
-                boxes.append(box)
+        def store_results(chunk, lines):
+            stored = [(image_stats[image_path], line) for image_path, line in zip(chunk, lines) if image_path in image_stats]
+            cache_db.put_lines([stat for stat, _ in stored], [line for _, line in stored])
 
-        for box in boxes:
-            f.write(box)
-        for box in cache.values():
-            f.write(box)
+        try:
+            with run_metrics.stage('process', workers=args.threads) as stage:
+                write_results(image_paths, f, args.threads, args.max_size, args.chunk_size, args.max_in_flight,
+                              store_results if cache_db is not None else None, args.method)
+                stage.add(len(image_paths), sum(image_stats[image_path][1] for image_path in image_paths if image_path in image_stats))
+        finally:
+            if cache_db is not None:
+                cache_db.close()
+    if args.metrics:
+        run_metrics.current().write(args.metrics)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import importlib.util
+import io
+import os
+import sys
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from extract_main_bounding_box import (IMAGE_EXTENSIONS, METHODS, binarize_image, decode_reduced, extract_main_rect,
+                                       iter_image_paths, scale_rect)
+from file_manifest import scan_files
+import run_metrics
+
+CHECK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'check')
+
+
+def load_checker():
+    """check/find-corrupted-jpg.py, which is a script rather than a module."""
+    checker = sys.modules.get('find_corrupted_jpg')
+    if checker is None:
+        spec = importlib.util.spec_from_file_location('find_corrupted_jpg', os.path.join(CHECK_DIR, 'find-corrupted-jpg.py'))
+        checker = importlib.util.module_from_spec(spec)
+        sys.modules['find_corrupted_jpg'] = checker
+        spec.loader.exec_module(checker)
+    return checker
+
+
+checker = load_checker()
+
+
+def thumbnail_path(image_path, input_dir, thumbnail_dir):
+    """Where create-image-cache.sh would put the thumbnail: the path of the image in thumbnail_dir, plus .thumbnail.jpg."""
+    if os.path.isdir(input_dir):
+        relative_path = os.path.relpath(image_path, input_dir)
+    else:
+        relative_path = image_path.lstrip(os.sep)
+    return os.path.join(thumbnail_dir, relative_path) + '.thumbnail.jpg'
+
+
+def result_line(image_path, size, mtime_ns, exitcode, width=0, height=0):
+    return f"{image_path}\t{size}\t{mtime_ns}\t{exitcode}\t{width}\t{height}\n"
+
+
+def save_thumbnail(image, path):
+    """Save like convert -resize 1000x1000 -strip -interlace Plane -quality 85%, under a temporary name first."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, 'JPEG', quality=85, progressive=True)
+    os.replace(tmp_path, path)
+
+
+def process_image(image_path, thumbnail_file=None, size=1000, method='contour'):
+    """
+    Read and decode an image once, and from that decode write its thumbnail, check its integrity
+    and find its main bounding box. Returns the result line: path, size, mtime_ns, the exit code of
+    find-corrupted-jpg.py, and the width and height of the main region in original pixels, 0 when
+    the image is not valid or no region was found.
+    """
+    try:
+        stat = os.stat(image_path)
+        with open(image_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return result_line(image_path, 0, 0, checker.UNREADABLE)
+    if image_path.endswith('.jpg') and not checker.check_jpeg_structure(data):
+        return result_line(image_path, stat.st_size, stat.st_mtime_ns, checker.CORRUPTED)
+    try:
+        with warnings.catch_warnings():
+            # Like identify -regard-warnings, a warning while decoding means the image is corrupted
+            warnings.simplefilter('error')
+            image, (width, height) = decode_reduced(io.BytesIO(data), size, 'RGB')
+            image = image.convert('RGB')
+    except Exception:
+        return result_line(image_path, stat.st_size, stat.st_mtime_ns, checker.CORRUPTED)
+    del data
+    if max(image.size) > size:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    if thumbnail_file is not None:
+        save_thumbnail(image, thumbnail_file)
+
+    try:
+        gray = np.array(image.convert('L'))
+        rect = scale_rect(extract_main_rect(binarize_image(gray), method), width / image.size[0], height / image.size[1])
+    except Exception as e:
+        print(f"Returning 0,0 Error processing {image_path}: {e}")
+        return result_line(image_path, stat.st_size, stat.st_mtime_ns, checker.VALID)
+    return result_line(image_path, stat.st_size, stat.st_mtime_ns, checker.VALID, rect[1][0], rect[1][1])
+
+
+def process_images(tasks, size=1000, method='contour'):
+    """The result lines of a chunk of (image path, thumbnail path) tasks, one task for the process pool."""
+    return [process_image(image_path, thumbnail_file, size, method) for image_path, thumbnail_file in tasks]
+
+
+def read_results(results_file):
+    """
+    The results of earlier runs by path, the last line of a path wins. A last line that was cut off
+    is removed from the file, so its image is processed again.
+    """
+    results = {}
+    if not os.path.exists(results_file):
+        return results
+    with open(results_file, 'rb+') as f:
+        content = f.read()
+        complete = content.rfind(b'\n') + 1
+        if complete < len(content):
+            f.truncate(complete)
+    for line in content[:complete].decode('utf-8').splitlines():
+        path, size, mtime_ns, exitcode, width, height = line.rsplit('\t', 5)
+        results[path] = (int(size), int(mtime_ns), int(exitcode))
+    return results
+
+
+def iter_image_files(input_path):
+    """
+    The images of iter_image_paths as (path, size, mtime_ns). The stat of a directory tree comes
+    from the scan, that of the images in a list is None, None.
+    """
+    if os.path.isdir(input_path):
+        yield from scan_files(input_path, IMAGE_EXTENSIONS, follow_links=True)
+    else:
+        for image_path in iter_image_paths(input_path):
+            yield image_path, None, None
+
+
+def is_up_to_date(image_path, thumbnail_file, previous, size=None, mtime_ns=None):
+    """
+    Whether the result of an earlier run is for the image as it is now, and its thumbnail, if it is
+    valid, is not older than the image. The image is stat'ed when size and mtime_ns are not given.
+    """
+    if previous is None:
+        return False
+    try:
+        if size is None:
+            stat = os.stat(image_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        if previous[:2] != (size, mtime_ns):
+            return False
+        if thumbnail_file is None or previous[2] != checker.VALID:
+            return True
+        return os.stat(thumbnail_file).st_mtime_ns >= mtime_ns
+    except OSError:
+        return False
+
+
+def main(input_path, results_file, thumbnail_dir=None, size=1000, method='contour', num_processes=None, chunk_size=16,
+         max_in_flight=None):
+    """
+    Walk input_path once and process every image that changed since the last run: one decode gives
+    its thumbnail in thumbnail_dir, its integrity and its main bounding box. The result lines are
+    appended to results_file as they come in, so an interrupted run continues where it stopped.
+    Returns the number of images processed.
+    """
+    with run_metrics.stage('read_results') as read_stage:
+        previous_results = read_results(results_file)
+        read_stage.add(len(previous_results))
+    num_processes = num_processes or os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * num_processes
+
+    process_stage = run_metrics.stage('process', workers=num_processes)
+
+    def tasks():
+        for image_path, size, mtime_ns in run_metrics.iter_stage('walk', iter_image_files(input_path), lambda image_file: image_file[1] or 0):
+            thumbnail_file = thumbnail_path(image_path, input_path, thumbnail_dir) if thumbnail_dir else None
+            if not is_up_to_date(image_path, thumbnail_file, previous_results.get(image_path), size, mtime_ns):
+                process_stage.add(0, size or 0)
+                yield image_path, thumbnail_file
+
+    num_processed = 0
+    with process_stage, open(results_file, 'a') as f, ProcessPoolExecutor(max_workers=num_processes) as executor, \
+            tqdm(desc='images processed') as progress:
+        in_flight = set()
+
+        def write(futures):
+            nonlocal num_processed
+            for future in futures:
+                lines = future.result()
+                f.writelines(lines)
+                num_processed += len(lines)
+                process_stage.add(len(lines))
+                progress.update(len(lines))
+            f.flush()
+
+        chunk = []
+        for task in tasks():
+            chunk.append(task)
+            if len(chunk) < chunk_size:
+                continue
+            in_flight.add(executor.submit(process_images, chunk, size, method))
+            chunk = []
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                write(done)
+        if chunk:
+            in_flight.add(executor.submit(process_images, chunk, size, method))
+        write(wait(in_flight).done)
+    print(f"Processed {num_processed} images, results written to {results_file}")
+    return num_processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode every image once to create its thumbnail, check its integrity and extract its main bounding box')
+    parser.add_argument('--input', required=True, help='Directory containing input images or a file with image paths')
+    parser.add_argument('--results_file', required=True,
+                        help='TSV file the results are appended to: path, size, mtime_ns, exit code (0 valid, 1 corrupted, 2 unreadable), width and height')
+    parser.add_argument('--thumbnail_dir', default=None, help='Directory to write thumbnails to, with the directory structure of the input (default: no thumbnails)')
+    parser.add_argument('--size', type=int, default=1000, help='Longest side of the thumbnails, and of the image the bounding box is found in (default: 1000)')
+    parser.add_argument('--method', choices=METHODS, default='contour', help='Method to find the main bounding box with, see extract_main_bounding_box.py (default: contour)')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes (default: one per CPU)')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Number of images per task for the process pool (default: 16)')
+    parser.add_argument('--max_in_flight', type=int, default=None, help='Maximum number of tasks submitted at a time (default: two per process)')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.metrics:
+        run_metrics.start('image_pipeline', profile_stage=args.profile_stage)
+    main(args.input, args.results_file, args.thumbnail_dir, args.size, args.method, args.processes, args.chunk_size,
+         args.max_in_flight)
+    if args.metrics:
+        run_metrics.current().write(args.metrics)
@@ -0,0 +1,259 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+
+REPORT_FORMATS = ('json', 'prometheus')
+METRIC_PREFIX = 'aelin'
+
+
+def _peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """The peak resident set size, ru_maxrss is in KB on Linux and in bytes on macOS."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageMetrics:
+    """
+    The metrics of one named stage of a run, summed over every time the stage was entered: wall
+    time, CPU time of this process and of the worker processes that finished in it, the number of
+    items and bytes handled, and the peak RSS of this process and of its workers when it was left.
+    """
+
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.worker_cpu_seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.workers = None
+        self.peak_rss_bytes = 0
+        self.worker_peak_rss_bytes = 0
+        self._depth = 0
+
+    def add(self, items=0, num_bytes=0):
+        """Count items and bytes handled by the stage, also outside of its with block."""
+        self.items += items
+        self.bytes += num_bytes
+
+    def __enter__(self):
+        self._depth += 1
+        if self._depth == 1:
+            self.calls += 1
+            self.run._start_profile(self.name)
+            self._start_cpu = _cpu_seconds(resource.RUSAGE_SELF)
+            self._start_worker_cpu = _cpu_seconds(resource.RUSAGE_CHILDREN)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth:
+            return
+        self.seconds += time.perf_counter() - self._start
+        self.cpu_seconds += _cpu_seconds(resource.RUSAGE_SELF) - self._start_cpu
+        self.worker_cpu_seconds += _cpu_seconds(resource.RUSAGE_CHILDREN) - self._start_worker_cpu
+        self.peak_rss_bytes = _peak_rss_bytes()
+        self.worker_peak_rss_bytes = _peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        self.run._stop_profile(self.name)
+
+    def report(self):
+        report = dict(calls=self.calls, seconds=round(self.seconds, 6), cpu_seconds=round(self.cpu_seconds, 6),
+                      worker_cpu_seconds=round(self.worker_cpu_seconds, 6), items=self.items, bytes=self.bytes,
+                      items_per_second=round(self.items / self.seconds, 3) if self.seconds and self.items else None,
+                      bytes_per_second=round(self.bytes / self.seconds, 3) if self.seconds and self.bytes else None,
+                      peak_rss_bytes=self.peak_rss_bytes, worker_peak_rss_bytes=self.worker_peak_rss_bytes,
+                      workers=self.workers, worker_utilization=None)
+        if self.workers and self.seconds:
+            # Threads show up in the CPU time of this process, worker processes once they finished
+            report['worker_utilization'] = round((self.cpu_seconds + self.worker_cpu_seconds) / (self.seconds * self.workers), 4)
+        return report
+
+
+class _NullStage:
+    """The stage of a run without metrics, which records nothing."""
+
+    def add(self, items=0, num_bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class RunMetrics:
+    """
+    Opt-in metrics of the stages of one run of a tool, written as a report at its end.
+
+    A tool wraps its stages, such as walking, reading, tokenizing and writing, in stage(name), and
+    counts what they handle with add(). A stage can be entered many times, for example once per
+    file, its metrics are summed. With workers, a stage also reports the utilization of its thread
+    or process pool: the CPU time it used divided by its wall time times workers. Worker processes
+    only count once they exited, so the pool has to be shut down inside the stage.
+
+    With profile_stage, cProfile runs whenever that stage does, in the thread that enters it, and its
+    statistics are written next to the report for pstats or snakeviz. Without enabled, stage()
+    returns a stage that records nothing, so instrumented code costs next to nothing by default.
+    """
+
+    def __init__(self, tool, enabled=True, profile_stage=None):
+        self.tool = tool
+        self.enabled = enabled
+        self.profile_stage = profile_stage
+        self.stages = {}
+        self.started = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self._profiler = cProfile.Profile() if enabled and profile_stage else None
+
+    def stage(self, name, workers=None):
+        if not self.enabled:
+            return _NULL_STAGE
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics(self, name)
+        if workers is not None:
+            stage.workers = workers
+        return stage
+
+    def iter_stage(self, name, iterable, item_bytes=None):
+        """
+        Yield from iterable, timing the time spent waiting for its items as stage name, such as a
+        lazy directory walk, and counting them, with their size by item_bytes when given.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        stage = self.stage(name)
+        iterator = iter(iterable)
+        while True:
+            with stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                stage.add(1, item_bytes(item) if item_bytes is not None else 0)
+            yield item
+
+    def _start_profile(self, name):
+        if name == self.profile_stage:
+            self._profiler.enable()
+
+    def _stop_profile(self, name):
+        if name == self.profile_stage:
+            self._profiler.disable()
+
+    def report(self):
+        return dict(tool=self.tool, started=self.started.isoformat(timespec='seconds'),
+                    seconds=round(time.perf_counter() - self._start, 6), peak_rss_bytes=_peak_rss_bytes(),
+                    worker_peak_rss_bytes=_peak_rss_bytes(resource.RUSAGE_CHILDREN), pid=os.getpid(),
+                    stages={name: stage.report() for name, stage in self.stages.items()})
+
+    def write(self, path, report_format=None):
+        """
+        Write the report to path, as JSON or, by default for a .prom path, in the Prometheus
+        textfile format. Both are written under a temporary name first, as the node exporter's
+        textfile collector needs. With profile_stage, the profile goes to path + '.<stage>.prof'.
+        """
+        if not self.enabled:
+            return
+        if report_format is None:
+            report_format = 'prometheus' if path.endswith('.prom') else 'json'
+        if report_format not in REPORT_FORMATS:
+            raise ValueError(f"unknown report format {report_format}, expected one of {', '.join(REPORT_FORMATS)}")
+        report = self.report()
+        if self._profiler is not None:
+            report['profile'] = f"{path}.{self.profile_stage}.prof"
+            self._profiler.dump_stats(report['profile'])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if report_format == 'prometheus':
+                f.write(prometheus_text(report))
+            else:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+        os.replace(tmp_path, path)
+
+
+# Metrics of the Prometheus report: the key in the stage report, the metric name, its type and help
+PROMETHEUS_STAGE_METRICS = (
+    ('seconds', 'stage_seconds_total', 'counter', 'Wall time spent in the stage'),
+    ('cpu_seconds', 'stage_cpu_seconds_total', 'counter', 'CPU time of the tool process in the stage'),
+    ('worker_cpu_seconds', 'stage_worker_cpu_seconds_total', 'counter', 'CPU time of worker processes that finished in the stage'),
+    ('items', 'stage_items_total', 'counter', 'Items handled by the stage'),
+    ('bytes', 'stage_bytes_total', 'counter', 'Bytes handled by the stage'),
+    ('items_per_second', 'stage_items_per_second', 'gauge', 'Items handled per second of wall time'),
+    ('bytes_per_second', 'stage_bytes_per_second', 'gauge', 'Bytes handled per second of wall time'),
+    ('peak_rss_bytes', 'stage_peak_rss_bytes', 'gauge', 'Peak RSS of the tool process when the stage was last left'),
+    ('worker_peak_rss_bytes', 'stage_worker_peak_rss_bytes', 'gauge', 'Peak RSS of the largest finished worker process when the stage was last left'),
+    ('worker_utilization', 'stage_worker_utilization', 'gauge', 'CPU time over wall time times the number of workers'),
+)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(report):
+    """A report of RunMetrics in the Prometheus text exposition format."""
+    tool = _label(report['tool'])
+    lines = []
+    for key, name, metric_type, help_text in (('seconds', 'run_seconds', 'gauge', 'Wall time of the run'),
+                                              ('peak_rss_bytes', 'run_peak_rss_bytes', 'gauge', 'Peak RSS of the tool process')):
+        lines += [f"# HELP {METRIC_PREFIX}_{name} {help_text}", f"# TYPE {METRIC_PREFIX}_{name} {metric_type}",
+                  f'{METRIC_PREFIX}_{name}{{tool="{tool}"}} {report[key]}']
+    for key, name, metric_type, help_text in PROMETHEUS_STAGE_METRICS:
+        samples = [f'{METRIC_PREFIX}_{name}{{tool="{tool}",stage="{_label(stage)}"}} {stage_report[key]}'
+                   for stage, stage_report in report['stages'].items() if stage_report[key] is not None]
+        if samples:
+            lines += [f"# HELP {METRIC_PREFIX}_{name} {help_text}", f"# TYPE {METRIC_PREFIX}_{name} {metric_type}"] + samples
+    return '\n'.join(lines) + '\n'
+
+
+# The metrics of the current run, which records nothing until a tool calls start()
+_current = RunMetrics(None, enabled=False)
+
+
+def start(tool, profile_stage=None):
+    """Record the metrics of this run of tool, for the stages all modules enter with stage()."""
+    global _current
+    _current = RunMetrics(tool, profile_stage=profile_stage)
+    return _current
+
+
+def current():
+    return _current
+
+
+def stage(name, workers=None):
+    """A stage of the current run, see RunMetrics.stage."""
+    return _current.stage(name, workers)
+
+
+def iter_stage(name, iterable, item_bytes=None):
+    return _current.iter_stage(name, iterable, item_bytes)
+
+
+def add_metrics_arguments(parser):
+    """The options of every instrumented tool."""
+    parser.add_argument('--metrics', default=None,
+                        help='Write per stage wall time, item and byte counts, throughput, peak RSS and worker utilization '
+                             'to this file at the end of the run, as JSON or, for a .prom file, in the Prometheus textfile format')
+    parser.add_argument('--profile_stage', default=None,
+                        help='Run cProfile during this stage and write its statistics next to the --metrics file, as METRICS.STAGE.prof')
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+PENDING_SUFFIX = '.pending'
+
+
+def default_identifier(path):
+    """The file name without its extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def scan_directory(directory, extensions=None, follow_links=False):
+    """
+    The files in one directory that end with one of extensions, as (path, size, mtime_ns), and its
+    subdirectories, both sorted by name. Symbolic links to files are included like os.walk does,
+    links to directories are only followed with follow_links.
+    """
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=follow_links):
+                    subdirs.append(entry.path)
+                elif (extensions is None or entry.name.endswith(extensions)) and entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                # Broken links and files removed while scanning
+                continue
+    files.sort()
+    subdirs.sort()
+    return files, subdirs
+
+
+def scan_files(root, extensions=None, recursive=True, follow_links=False, num_threads=16):
+    """
+    Every file under root that ends with one of extensions (a string or a tuple, None for all
+    files), as (path, size, mtime_ns), in the top-down order of os.walk with every directory sorted
+    by name. The stat comes from os.scandir, so no file is stat'ed twice.
+
+    Directories are scanned on num_threads threads, which keeps many directory reads in flight on
+    network file systems. With follow_links, links to directories are followed like find -L, but
+    every directory is only scanned once. Directories that cannot be read are reported and skipped.
+    """
+    if isinstance(extensions, list):
+        extensions = tuple(extensions)
+    if not recursive:
+        return scan_directory(root, extensions, follow_links)[0]
+
+    scanned = {}
+    seen = {os.path.realpath(root)}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = {executor.submit(scan_directory, root, extensions, follow_links): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    files, subdirs = future.result()
+                except OSError as e:
+                    print(f"Could not read directory {directory}: {e}", file=sys.stderr)
+                    continue
+                if follow_links:
+                    unseen = []
+                    for subdir in subdirs:
+                        real_path = os.path.realpath(subdir)
+                        if real_path not in seen:
+                            seen.add(real_path)
+                            unseen.append(subdir)
+                    subdirs = unseen
+                scanned[directory] = (files, subdirs)
+                for subdir in subdirs:
+                    pending[executor.submit(scan_directory, subdir, extensions, follow_links)] = subdir
+
+    # Put the directories back in os.walk order
+    files = []
+    stack = [root]
+    while stack:
+        directory_files, subdirs = scanned.get(stack.pop(), ((), ()))
+        files.extend(directory_files)
+        stack.extend(reversed(subdirs))
+    return files
+
+
+class FileManifest:
+    """
+    The files seen by the last run of a tool, with their size, mtime and identifier, stored as TSV
+    (path, size, mtime_ns, identifier), to find the files that changed since.
+
+    changes() compares a new scan with the manifest and stages the scan, save() replaces the
+    manifest with it. A tool saves only once its run completed, so the files of a run that was
+    interrupted are still changed on the next one.
+    """
+
+    def __init__(self, path, identifier=default_identifier):
+        self.path = path
+        self.identifier = identifier
+        self.entries = {}
+        self.staged = None
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    file_path, size, mtime_ns, file_identifier = line.rstrip('\n').rsplit('\t', 3)
+                    self.entries[file_path] = (int(size), int(mtime_ns), file_identifier)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def by_identifier(self):
+        """The path of every identifier in the manifest."""
+        return {file_identifier: file_path for file_path, (_, _, file_identifier) in self.entries.items()}
+
+    def changes(self, files):
+        """
+        The files of a scan, as (path, size, mtime_ns), that are new or changed since the manifest was
+        saved, and the paths in the manifest that are gone. The scan is staged for save().
+        """
+        changed = [entry for entry in files if self.entries.get(entry[0], (None, None))[:2] != entry[1:]]
+        self.staged = {file_path: (size, mtime_ns) for file_path, size, mtime_ns in files}
+        removed = [file_path for file_path in self.entries if file_path not in self.staged]
+        return changed, removed
+
+    def save(self, exclude=()):
+        """
+        Replace the manifest with the staged scan, without the paths in exclude, such as files that
+        failed, so they count as changed again next time.
+        """
+        if self.staged is None:
+            raise ValueError("nothing to save, call changes() with a scan first")
+        exclude = set(exclude)
+        entries = {}
+        for file_path, (size, mtime_ns) in self.staged.items():
+            if file_path in exclude:
+                continue
+            previous = self.entries.get(file_path)
+            file_identifier = previous[2] if previous is not None else self.identifier(file_path)
+            entries[file_path] = (size, mtime_ns, file_identifier)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for file_path, (size, mtime_ns, file_identifier) in entries.items():
+                f.write(f"{file_path}\t{size}\t{mtime_ns}\t{file_identifier}\n")
+        os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.staged = None
+
+
+def changed_files(root, manifest_path, extensions=None, recursive=True, follow_links=False, num_threads=16):
+    """
+    Scan root and return the files that changed since the manifest in manifest_path was saved,
+    with the manifest, to save() once they are processed.
+    """
+    manifest = FileManifest(manifest_path)
+    changed, _ = manifest.changes(scan_files(root, extensions, recursive, follow_links, num_threads))
+    return changed, manifest
+
+
+def main(root, extensions, manifest_path=None, changed_only=False, commit=False, follow_links=False, num_threads=16,
+         output=sys.stdout, separator='\n'):
+    """
+    List the files under root, or with changed_only those that changed since manifest_path was saved.
+    The scan is written to manifest_path + '.pending', commit replaces the manifest with it, which a
+    shell script does once it processed the listed files.
+    """
+    if commit:
+        os.replace(manifest_path + PENDING_SUFFIX, manifest_path)
+        return
+    files = scan_files(root, extensions, follow_links=follow_links, num_threads=num_threads)
+    if manifest_path is not None:
+        manifest = FileManifest(manifest_path)
+        changed, _ = manifest.changes(files)
+        if changed_only:
+            files = changed
+        manifest.path = manifest_path + PENDING_SUFFIX
+        manifest.save()
+    for file_path, _, _ in files:
+        output.write(file_path + separator)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the files in a directory tree, or those that changed since the last run, scanning directories in parallel.")
+    parser.add_argument('root', help="Directory to scan")
+    parser.add_argument('--extension', action='append', default=None, help="Only list files with this extension, can be given more than once (default: all files)")
+    parser.add_argument('--manifest', default=None, help="Manifest of the last run, the new scan is written next to it with a .pending suffix")
+    parser.add_argument('--changed', action='store_true', help="Only list the files that are new or changed since the manifest was saved")
+    parser.add_argument('--commit', action='store_true', help="Replace the manifest with the pending scan, once the listed files are processed")
+    parser.add_argument('--follow_links', action='store_true', help="Follow symbolic links to directories, like find -L")
+    parser.add_argument('--threads', type=int, default=16, help="Number of directories to scan at a time (default: 16)")
+    parser.add_argument('--null', action='store_true', help="Separate the paths by NUL characters instead of newlines, for xargs -0")
+    args = parser.parse_args()
+    if (args.changed or args.commit) and args.manifest is None:
+        parser.error("--changed and --commit need --manifest")
+    main(args.root, tuple(args.extension) if args.extension else None, args.manifest, args.changed, args.commit,
+         args.follow_links, args.threads, separator='\0' if args.null else '\n')
@@ -0,0 +1,20 @@
+import importlib.util
+import os
+import sys
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The tools are scripts rather than packages, their helper modules are imported from the script directory
+for tool_dir in ('text', 'conversion', 'image-analysis', 'scan', 'benchmark', 'metrics'):
+    sys.path.insert(0, os.path.join(repo_root, tool_dir))
+
+
+def load_script(relative_path, module_name):
+    """Import a script like text/find-ngrams.py, whose name is not a valid module name."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(repo_root, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
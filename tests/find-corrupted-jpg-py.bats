@@ -0,0 +1,27 @@
+#!/usr/bin/env bats
+
+@test "python checker reports corrupted jpgs in all subdirectories" {
+    repo_root="$(cd "$BATS_TEST_DIRNAME/.." && pwd)"
+    checker_dir="$repo_root/check"
+    fixtures_dir="$repo_root/tests/fixtures"
+
+    run python3 "$checker_dir/find-corrupted-jpg.py" "$fixtures_dir" --processes 2
+    [ "$status" -eq 0 ]
+    [[ "$output" == *"tests/fixtures/corrupted.jpg 1"* ]]
+    [[ "$output" == *"tests/fixtures/subdir/corrupted.jpg 1"* ]]
+    [[ "$output" == *"tests/fixtures/valid.jpg 0"* ]]
+}
+
+@test "python checker with full decoding writes results to a file" {
+    repo_root="$(cd "$BATS_TEST_DIRNAME/.." && pwd)"
+    checker_dir="$repo_root/check"
+    fixtures_dir="$repo_root/tests/fixtures"
+
+    tmpdir="$(mktemp -d)"
+    outfile="$tmpdir/corrupted_jpgs_summary.txt"
+
+    run python3 "$checker_dir/find-corrupted-jpg.py" "$fixtures_dir" --mode decode --output "$outfile"
+    [ "$status" -eq 0 ]
+    grep -q "subdir/corrupted\.jpg[[:space:]]\+1$" "$outfile"
+    grep -q "subdir/valid\.jpg[[:space:]]\+0$" "$outfile"
+}
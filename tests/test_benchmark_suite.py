@@ -0,0 +1,70 @@
+import json
+import os
+
+import benchmark_suite
+from conftest import load_script
+from synthetic_data import CORRUPTIONS, write_pagexml_pages, write_scans, write_text_corpus
+
+pagexml_to_text = load_script('conversion/pagexml-to-text.py', 'pagexml_to_text')
+checker = load_script('check/find-corrupted-jpg.py', 'find_corrupted_jpg')
+
+
+def read_tree(directory):
+    contents = {}
+    for root, _, files in os.walk(directory):
+        for file in files:
+            with open(os.path.join(root, file), 'rb') as f:
+                contents[os.path.relpath(os.path.join(root, file), directory)] = f.read()
+    return contents
+
+
+def test_generators_are_deterministic(tmp_path):
+    for name in ('a', 'b'):
+        write_text_corpus(tmp_path / name, 120, seed=3)
+        write_pagexml_pages(tmp_path / name, 6, seed=3)
+        write_scans(tmp_path / name / 'scans', 4, seed=3, width=300, height=400)
+    assert read_tree(tmp_path / 'a') == read_tree(tmp_path / 'b')
+    assert len(read_tree(tmp_path / 'a')) == 120 + 6 + 4
+
+
+def test_pagexml_pages_of_both_namespaces_are_read(tmp_path):
+    write_pagexml_pages(tmp_path, 4)
+    versions = set()
+    for file in sorted(os.listdir(tmp_path / 'page')):
+        with open(tmp_path / 'page' / file, encoding='utf-8') as f:
+            versions.add(f.read(200).split('pagecontent/')[1][:10])
+        lines = pagexml_to_text.read_pagexml_file(str(tmp_path / 'page' / file), **benchmark_suite.PAGEXML_OPTIONS)
+        assert lines
+        assert lines == pagexml_to_text.read_pagexml_stream(str(tmp_path / 'page' / file), **benchmark_suite.PAGEXML_OPTIONS)
+    assert versions == {'2013-07-15', '2019-07-15'}
+
+
+def test_corrupted_scans(tmp_path):
+    truth = write_scans(tmp_path, 12, width=300, height=400, corrupted_fraction=0.5)
+    corruptions = [value for value in truth.values() if isinstance(value, str)]
+    assert set(corruptions) == set(CORRUPTIONS)
+    for path, value in truth.items():
+        # Garbled data keeps the structure of the image intact
+        expected = checker.CORRUPTED if value in ('truncated', 'not_an_image') else checker.VALID
+        assert checker.check_image(path) == expected
+
+
+def test_run_benchmarks_and_flag_regressions(tmp_path):
+    baseline_path = tmp_path / 'baseline.json'
+    stages = ['conversion.read_pagexml_stream', 'check.check_image']
+    assert benchmark_suite.main(stages, [1], str(tmp_path / 'data'), repeat=1, baseline=str(baseline_path),
+                                update_baseline=True) == []
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    assert [(result['stage'], result['scale'], result['items']) for result in baseline['results']] == [
+        ('conversion.read_pagexml_stream', 1, 100), ('check.check_image', 1, 20)]
+    assert all(result['items_per_second'] > 0 and result['peak_rss_mb'] > 0 for result in baseline['results'])
+
+    results = [dict(result) for result in baseline['results']]
+    assert benchmark_suite.compare_results(results, baseline) == []
+    results[0]['items_per_second'] = baseline['results'][0]['items_per_second'] * 0.5
+    results[1]['peak_rss_mb'] = baseline['results'][1]['peak_rss_mb'] * 2 + 20
+    regressions = benchmark_suite.compare_results(results, baseline)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('conversion.read_pagexml_stream at scale 1:')
+    assert 'peak RSS' in regressions[1]
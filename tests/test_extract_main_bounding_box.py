@@ -0,0 +1,134 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import extract_main_bounding_box
+from bounding_box_cache import BoundingBoxCache, image_stat
+
+# Largest relative difference allowed between the dimensions found at full and at reduced resolution
+TOLERANCE = 0.01
+
+
+def write_scan(path, width=900, height=1200, seed=0):
+    """A noisy dark background with a slightly rotated light page on it, like a photographed scan."""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), 40, np.uint8)
+    page = cv2.boxPoints(((width / 2, height / 2), (width * 0.75, height * 0.8), 3)).astype(np.int32)
+    cv2.fillPoly(image, [page], 215)
+    image = np.clip(image.astype(np.int16) + rng.integers(-25, 25, image.shape), 0, 255).astype(np.uint8)
+    Image.fromarray(image).convert('RGB').save(path)
+
+
+def main_rect_dimensions(rect):
+    return sorted(rect[1])
+
+
+@pytest.mark.parametrize('extension', ['.jpg', '.jp2'])
+@pytest.mark.parametrize('max_size', [600, 300])
+def test_reduced_resolution_matches_full_resolution(tmp_path, extension, max_size):
+    image_path = str(tmp_path / f"scan{extension}")
+    write_scan(image_path)
+    full = extract_main_bounding_box.extract_bounding_rect(
+        extract_main_bounding_box.binarize_image(extract_main_bounding_box.load_image(image_path)))
+
+    image, scale_x, scale_y = extract_main_bounding_box.load_image_reduced(image_path, max_size)
+    assert image.ndim == 2 and max(image.shape) <= max_size
+    reduced = extract_main_bounding_box.scale_rect(
+        extract_main_bounding_box.extract_bounding_rect(extract_main_bounding_box.binarize_image(image)), scale_x, scale_y)
+
+    for full_dimension, reduced_dimension in zip(main_rect_dimensions(full), main_rect_dimensions(reduced)):
+        assert reduced_dimension == pytest.approx(full_dimension, rel=TOLERANCE)
+
+
+def read_results(output_file):
+    with open(output_file, 'r') as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_results_are_written_as_they_come_and_resumed(tmp_path):
+    input_dir = tmp_path / 'images'
+    (input_dir / 'inventory').mkdir(parents=True)
+    for i in range(7):
+        write_scan(str(input_dir / 'inventory' / f"scan-{i}.jpg"), width=300, height=400, seed=i)
+    output_file = str(tmp_path / 'boxes.tsv')
+    options = ['--input', str(input_dir), '--output_file', output_file, '--threads', '2', '--chunk_size', '2',
+               '--max_in_flight', '1']
+
+    extract_main_bounding_box.main(options + ['--limit', '3'])
+    first_run = read_results(output_file)
+    assert len(first_run) == 3
+
+    # A run that stopped halfway through writing a line
+    with open(output_file, 'a') as f:
+        f.write('scan-9\t12')
+    extract_main_bounding_box.main(options)
+    results = read_results(output_file)
+    assert results[:3] == first_run
+    assert sorted(identifier for identifier, _, _ in results) == [f"scan-{i}" for i in range(7)]
+    assert all(float(width) > 0 and float(height) > 0 for _, width, height in results)
+
+    extract_main_bounding_box.main(options + ['--overwrite_results', '--limit', '2'])
+    assert len(read_results(output_file)) == 2
+
+
+def test_cache_db_skips_unchanged_images_and_exports_tsv(tmp_path):
+    input_dir = tmp_path / 'images'
+    input_dir.mkdir()
+    for i in range(4):
+        write_scan(str(input_dir / f"scan-{i}.jpg"), width=300, height=400, seed=i)
+    output_file = str(tmp_path / 'boxes.tsv')
+    cache_db = str(tmp_path / 'boxes.sqlite')
+    options = ['--input', str(input_dir), '--output_file', output_file, '--cache_db', cache_db, '--threads', '2',
+               '--overwrite_results']
+    extract_main_bounding_box.main(options)
+
+    with BoundingBoxCache(cache_db) as cache:
+        assert len(cache) == 4
+        # A result that can only come from the cache, for an unchanged image
+        cache.put_lines([image_stat(str(input_dir / 'scan-1.jpg'))], ['scan-1\t1.5\t2.5\n'])
+    write_scan(str(input_dir / 'scan-2.jpg'), width=200, height=300, seed=2)
+    extract_main_bounding_box.main(options)
+
+    results = {identifier: (width, height) for identifier, width, height in read_results(output_file)}
+    assert len(results) == 4
+    assert results['scan-1'] == ('1.5', '2.5')
+    with BoundingBoxCache(cache_db) as cache:
+        assert len(cache) == 4
+        assert cache.get('scan-2', *image_stat(str(input_dir / 'scan-2.jpg'))[1:]) == 'scan-2\t{}\t{}\n'.format(*results['scan-2'])
+        assert cache.get('scan-2', 0, 0) is None
+
+    export_file = str(tmp_path / 'export.tsv')
+    extract_main_bounding_box.main(['--cache_db', cache_db, '--export_cache', export_file])
+    assert sorted(read_results(export_file)) == sorted(read_results(output_file))
+
+    # Results of another method or max_size are not reused
+    extract_main_bounding_box.main(options + ['--max_size', '100'])
+    assert dict((identifier, (width, height)) for identifier, width, height in read_results(output_file))['scan-1'] != ('1.5', '2.5')
+    with BoundingBoxCache(cache_db, max_size=100) as cache:
+        assert len(cache) == 4
+        assert cache.get('scan-1', *image_stat(str(input_dir / 'scan-1.jpg'))[1:]) != 'scan-1\t1.5\t2.5\n'
+    with BoundingBoxCache(cache_db, method='projection') as cache:
+        assert len(cache) == 0
+        assert cache.get('scan-2', *image_stat(str(input_dir / 'scan-2.jpg'))[1:]) is None
+
+
+def test_export_cache_needs_cache_db(tmp_path):
+    with pytest.raises(SystemExit):
+        extract_main_bounding_box.main(['--export_cache', str(tmp_path / 'export.tsv')])
+
+
+@pytest.mark.parametrize('method', ['projection', 'projection-pca'])
+def test_projection_methods_match_contour_method(tmp_path, method):
+    image_path = str(tmp_path / 'scan.jpg')
+    for seed in range(3):
+        write_scan(image_path, seed=seed)
+        binary_image = extract_main_bounding_box.binarize_image(extract_main_bounding_box.load_image(image_path))
+        contour = extract_main_bounding_box.extract_main_rect(binary_image, 'contour')
+        projection = extract_main_bounding_box.extract_main_rect(binary_image, method)
+        for contour_dimension, projection_dimension in zip(main_rect_dimensions(contour), main_rect_dimensions(projection)):
+            assert projection_dimension == pytest.approx(contour_dimension, rel=TOLERANCE)
+        assert projection[0] == pytest.approx(contour[0], abs=5)
+    if method == 'projection-pca':
+        # write_scan rotates the page by 3 degrees, minAreaRect may report it as -87
+        assert projection[2] % 90 == pytest.approx(contour[2] % 90, abs=0.5)
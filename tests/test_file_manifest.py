@@ -0,0 +1,82 @@
+import io
+import os
+
+from file_manifest import FileManifest, main, scan_files
+
+
+def write_tree(root):
+    paths = ['a.txt', 'b.jpg', 'sub/c.txt', 'sub/deeper/d.txt', 'sub/e.xml', 'zz/f.txt', 'zz/g.jpg']
+    for path in paths:
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), 'w', encoding='utf-8') as f:
+            f.write(path)
+    return paths
+
+
+def walk(root, extensions):
+    """os.walk with sorted directories, what scan_files should return."""
+    files = []
+    for subdir, dirs, names in os.walk(root):
+        dirs.sort()
+        files += [os.path.join(subdir, name) for name in sorted(names) if name.endswith(extensions)]
+    return files
+
+
+def test_scan_files_matches_os_walk(tmp_path):
+    root = str(tmp_path / 'tree')
+    write_tree(root)
+    for extensions in ('.txt', ('.jpg', '.xml'), None):
+        files = scan_files(root, extensions, num_threads=4)
+        assert [path for path, _, _ in files] == walk(root, extensions or '')
+        assert all((size, mtime_ns) == (os.stat(path).st_size, os.stat(path).st_mtime_ns) for path, size, mtime_ns in files)
+    assert [path for path, _, _ in scan_files(root, '.txt', recursive=False)] == [os.path.join(root, 'a.txt')]
+
+
+def test_scan_files_follows_links_once(tmp_path):
+    root = str(tmp_path / 'tree')
+    write_tree(root)
+    os.symlink(os.path.join(root, 'sub'), os.path.join(root, 'sub', 'deeper', 'loop'))
+    os.symlink(os.path.join(root, 'zz'), os.path.join(root, 'linked'))
+    assert [path for path, _, _ in scan_files(root, '.jpg')] == [os.path.join(root, 'b.jpg'), os.path.join(root, 'zz', 'g.jpg')]
+    followed = [os.path.relpath(path, root) for path, _, _ in scan_files(root, '.jpg', follow_links=True)]
+    # zz is the same directory as linked, which comes first
+    assert followed == ['b.jpg', 'linked/g.jpg']
+    assert len(scan_files(root, '.txt', follow_links=True)) == 4
+
+
+def test_manifest_lists_changed_files_since_it_was_saved(tmp_path):
+    root = str(tmp_path / 'tree')
+    write_tree(root)
+    manifest_path = str(tmp_path / 'manifest.tsv')
+    manifest = FileManifest(manifest_path)
+    changed, removed = manifest.changes(scan_files(root, '.txt'))
+    assert len(changed) == 4 and removed == []
+    manifest.save(exclude=[os.path.join(root, 'a.txt')])
+
+    with open(os.path.join(root, 'sub', 'c.txt'), 'a', encoding='utf-8') as f:
+        f.write('changed')
+    os.remove(os.path.join(root, 'zz', 'f.txt'))
+    manifest = FileManifest(manifest_path)
+    assert manifest.by_identifier()['d'] == os.path.join(root, 'sub', 'deeper', 'd.txt')
+    changed, removed = manifest.changes(scan_files(root, '.txt'))
+    assert [path for path, _, _ in changed] == [os.path.join(root, 'a.txt'), os.path.join(root, 'sub', 'c.txt')]
+    assert removed == [os.path.join(root, 'zz', 'f.txt')]
+    # Not saved, so the same files are still changed
+    assert len(FileManifest(manifest_path).changes(scan_files(root, '.txt'))[0]) == 2
+
+
+def test_command_line_commits_the_scan_after_processing(tmp_path):
+    root = str(tmp_path / 'tree')
+    write_tree(root)
+    manifest_path = str(tmp_path / 'manifest.tsv')
+
+    def changed():
+        output = io.StringIO()
+        main(root, ('.jpg',), manifest_path, changed_only=True, output=output)
+        return output.getvalue().splitlines()
+
+    assert changed() == [os.path.join(root, 'b.jpg'), os.path.join(root, 'zz', 'g.jpg')]
+    # Until the scan is committed, the files are still changed
+    assert len(changed()) == 2
+    main(root, ('.jpg',), manifest_path, commit=True)
+    assert changed() == []
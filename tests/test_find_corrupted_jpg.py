@@ -0,0 +1,74 @@
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import load_script, repo_root
+
+find_corrupted_jpg = load_script('check/find-corrupted-jpg.py', 'find_corrupted_jpg')
+FIXTURES_DIR = os.path.join(repo_root, 'tests', 'fixtures')
+
+
+def jpeg_bytes(**options):
+    image = np.random.default_rng(0).integers(0, 255, (64, 96, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('options', [{}, {'progressive': True}, {'restart_marker_blocks': 1}])
+def test_structure_check_finds_every_truncation(options):
+    data = jpeg_bytes(**options)
+    assert find_corrupted_jpg.check_jpeg_structure(data)
+    assert not any(find_corrupted_jpg.check_jpeg_structure(data[:end]) for end in range(len(data) - 1))
+
+
+def test_structure_check_rejects_broken_segments():
+    data = jpeg_bytes()
+    assert not find_corrupted_jpg.check_jpeg_structure(b'\x89PNG' + data[4:])
+    # The length of the first segment runs past the end of the file
+    assert not find_corrupted_jpg.check_jpeg_structure(data[:4] + b'\xff\xff' + data[6:])
+    # A scan without a frame header
+    frame = data.index(b'\xff\xc0')
+    assert not find_corrupted_jpg.check_jpeg_structure(data[:frame] + b'\xff\xfe' + data[frame + 2:])
+
+
+@pytest.mark.parametrize('mode', find_corrupted_jpg.MODES)
+def test_fixtures_are_reported_like_the_shell_checker(tmp_path, mode):
+    input_dir = str(tmp_path / 'images')
+    shutil.copytree(FIXTURES_DIR, input_dir)
+    os.symlink(os.path.join(input_dir, 'subdir'), os.path.join(input_dir, 'subdir', 'loop'))
+    with open(os.path.join(input_dir, 'unreadable.jpg'), 'wb') as f:
+        f.write(jpeg_bytes())
+    os.chmod(os.path.join(input_dir, 'unreadable.jpg'), 0)
+    output_file = str(tmp_path / 'results.txt')
+    with open(output_file, 'w') as f:
+        num_invalid = find_corrupted_jpg.main(input_dir, f, num_processes=2, mode=mode, chunk_size=1)
+
+    with open(output_file, 'r') as f:
+        results = dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+    expected = {'valid.jpg': '0', 'corrupted.jpg': '1', 'subdir/valid.jpg': '0', 'subdir/corrupted.jpg': '1'}
+    # Root can read files without permissions
+    expected['unreadable.jpg'] = '0' if os.access(os.path.join(input_dir, 'unreadable.jpg'), os.R_OK) else '2'
+    assert results == {os.path.join(input_dir, path): code for path, code in expected.items()}
+    assert num_invalid == sum(code != '0' for code in expected.values())
+
+
+def test_manifest_only_checks_changed_images(tmp_path):
+    input_dir = str(tmp_path / 'images')
+    shutil.copytree(FIXTURES_DIR, input_dir)
+    manifest = str(tmp_path / 'manifest.tsv')
+
+    def check():
+        output = io.StringIO()
+        find_corrupted_jpg.main(input_dir, output, num_processes=1, manifest=manifest)
+        return output.getvalue().splitlines()
+
+    assert len(check()) == 4
+    assert check() == []
+    with open(os.path.join(input_dir, 'subdir', 'valid.jpg'), 'ab') as f:
+        f.write(b'\0')
+    assert check() == [f"{os.path.join(input_dir, 'subdir', 'valid.jpg')} 0"]
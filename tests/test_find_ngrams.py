@@ -0,0 +1,129 @@
+import json
+import os
+import random
+from array import array
+
+import numpy as np
+import pytest
+
+from conftest import load_script
+from ngram_clusters import ClusterReader, read_cluster
+from ngram_minhash import EMPTY, lsh_clusters
+
+find_ngrams_script = load_script('text/find-ngrams.py', 'find_ngrams')
+
+
+def process_ngrams_reference(most_common_ngrams, ngram_files, top_k):
+    """process_ngrams as it was on sets of file paths."""
+    seen_files = set()
+    processed_ngrams = []
+    for ngram, count in most_common_ngrams:
+        files = ngram_files[ngram]
+        unique_files = [file for file in files if file not in seen_files]
+        seen_files.update(unique_files)
+        adjusted_count = count - (len(files) - len(unique_files))
+        if adjusted_count > 0:
+            processed_ngrams.append((ngram, adjusted_count, unique_files))
+    processed_ngrams.sort(key=lambda x: x[1], reverse=True)
+    return processed_ngrams[:top_k]
+
+
+def make_candidates(seed, num_ngrams=400, num_files=300):
+    rng = random.Random(seed)
+    most_common_ngrams = []
+    ngram_files = {}
+    for i in range(num_ngrams):
+        files = sorted(rng.sample(range(num_files), rng.randint(1, 60)))
+        ngram = (f"w{i}", f"w{i + 1}")
+        ngram_files[ngram] = array('I', files)
+        # An n-gram occurs at least once in each of its files
+        most_common_ngrams.append((ngram, len(files) + rng.randint(0, 5)))
+    most_common_ngrams.sort(key=lambda x: x[1], reverse=True)
+    return most_common_ngrams, ngram_files, num_files
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+@pytest.mark.parametrize('top_k', [1, 10, 50, 1000])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_process_ngrams_matches_reference(seed, top_k, lazy):
+    most_common_ngrams, ngram_files, num_files = make_candidates(seed)
+    expected = process_ngrams_reference(most_common_ngrams, ngram_files, top_k)
+    result = find_ngrams_script.process_ngrams(most_common_ngrams, ngram_files, top_k, num_files=num_files, lazy=lazy)
+    assert result == expected
+    assert find_ngrams_script.process_ngrams(most_common_ngrams, ngram_files, top_k, lazy=lazy) == expected
+
+
+def test_jsonl_output_matches_json_files(tmp_path):
+    most_common_ngrams, ngram_files, num_files = make_candidates(4)
+    processed_ngrams = find_ngrams_script.process_ngrams(most_common_ngrams, ngram_files, 20)
+    file_paths = [f"inv/NL-test_{i:03d}.txt" for i in range(num_files)]
+    predictions_map = {file_path: (i * 7919) % 101 / 100 for i, file_path in enumerate(file_paths)}
+    options = dict(n=2, required_words=['Amsterdam'], limit_output=25, file_paths=file_paths,
+                   predictions_map=predictions_map)
+    find_ngrams_script.save_ngrams_to_json(processed_ngrams, output_dir=str(tmp_path / 'json'), **options)
+    output_path = find_ngrams_script.save_ngrams_to_json(processed_ngrams, output_dir=str(tmp_path / 'jsonl'),
+                                                         output_format='jsonl', **options)
+
+    json_files = sorted(os.listdir(tmp_path / 'json'))
+    assert os.path.basename(output_path) == '02-required-Amsterdam-clusters.jsonl'
+    with ClusterReader(output_path) as reader:
+        assert len(reader) == len(processed_ngrams) == len(json_files)
+        for rank in (len(reader), 1, 7):
+            cluster = reader.cluster(rank)
+            ngram, adjusted_count, _ = processed_ngrams[rank - 1]
+            assert (cluster['rank'], cluster['n'], cluster['ngram'], cluster['adjusted_count']) == (rank, 2, list(ngram), adjusted_count)
+            with open(tmp_path / 'json' / json_files[rank - 1], encoding='utf-8') as f:
+                assert cluster['files'] == json.load(f)
+        assert [cluster['rank'] for cluster in reader] == list(range(1, len(reader) + 1))
+    assert read_cluster(output_path, 3)['ngram'] == list(processed_ngrams[2][0])
+
+
+def write_forms(directory, seed=5, copies=15, num_other=40):
+    """Text files filled in on three printed forms, and files of running text."""
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(150)]
+    forms = [[f"form{form}line{i}" for i in range(120)] for form in range(3)]
+    expected = []
+    for form, template in enumerate(forms):
+        files = []
+        for copy in range(copies):
+            tokens = list(template)
+            # Filled in fields
+            for position in rng.sample(range(len(tokens)), 3):
+                tokens[position] = rng.choice(vocabulary)
+            path = directory / f"form{form}_{copy:02d}.txt"
+            path.write_text(' '.join(tokens) + '\n', encoding='utf-8')
+            files.append(str(path))
+        expected.append(sorted(files))
+    for other in range(num_other):
+        path = directory / f"other_{other:02d}.txt"
+        path.write_text(' '.join(rng.choice(vocabulary) for _ in range(80)) + '\n', encoding='utf-8')
+    return expected
+
+
+def test_minhash_clusters_the_files_of_each_form(tmp_path):
+    expected = write_forms(tmp_path)
+    common_ngrams, ngram_files, file_paths = find_ngrams_script.find_ngrams(str(tmp_path), None, set(), n=3,
+                                                                            tokens_to_ignore=0, minhash=True)
+    clusters = sorted(sorted(file_paths[file_id] for file_id in ngram_files[ngram]) for ngram, _ in common_ngrams)
+    assert clusters == expected
+    for ngram, count in common_ngrams:
+        assert count == len(ngram_files[ngram]) == 15
+        assert ngram[0].startswith('form')
+
+    processed_ngrams = find_ngrams_script.process_ngrams(common_ngrams, ngram_files, 10, num_files=len(file_paths))
+    find_ngrams_script.save_ngrams_to_json(processed_ngrams, output_dir=str(tmp_path / 'clusters'), n=3,
+                                           file_paths=file_paths)
+    for order, (ngram, _, files) in enumerate(processed_ngrams, start=1):
+        with open(tmp_path / 'clusters' / f"{order:03d}-03-{'-'.join(ngram)}.json", encoding='utf-8') as f:
+            assert json.load(f) == [file_paths[file_id] for file_id in files]
+
+
+def test_lsh_clusters_only_merge_similar_signatures():
+    rng = np.random.default_rng(1)
+    signatures = rng.integers(0, 1 << 32, size=(6, 64), dtype=np.uint32)
+    # 0 and 3 agree on a band and on most values, 1 and 4 on one band only
+    signatures[3, :48] = signatures[0, :48]
+    signatures[4, :4] = signatures[1, :4]
+    signatures[5] = EMPTY
+    assert lsh_clusters(signatures, bands=16, threshold=0.5) == [[0, 3], [1], [2], [4]]
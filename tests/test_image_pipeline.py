@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+import extract_main_bounding_box
+import image_pipeline
+from conftest import repo_root
+from test_extract_main_bounding_box import TOLERANCE, main_rect_dimensions, write_scan
+
+
+def read_results(results_file):
+    with open(results_file, 'r') as f:
+        return {path: (int(exitcode), float(width), float(height))
+                for path, size, mtime_ns, exitcode, width, height in (line.rstrip('\n').split('\t') for line in f)}
+
+
+def test_images_are_decoded_once_for_thumbnail_check_and_bounding_box(tmp_path):
+    input_dir = tmp_path / 'images'
+    (input_dir / 'inventory 1').mkdir(parents=True)
+    write_scan(str(input_dir / 'inventory 1' / 'scan.jpg'), seed=1)
+    write_scan(str(input_dir / 'scan.jp2'), seed=2)
+    shutil.copy(os.path.join(repo_root, 'tests', 'fixtures', 'corrupted.jpg'), input_dir / 'corrupted.jpg')
+    with open(input_dir / 'scan.jp2', 'rb') as f:
+        data = f.read()
+    with open(input_dir / 'truncated.jp2', 'wb') as f:
+        f.write(data[:len(data) // 2])
+    results_file = str(tmp_path / 'results.tsv')
+    thumbnail_dir = str(tmp_path / 'thumbnails')
+    options = dict(thumbnail_dir=thumbnail_dir, size=400, num_processes=2, chunk_size=1)
+
+    assert image_pipeline.main(str(input_dir), results_file, **options) == 4
+    results = read_results(results_file)
+    assert {os.path.relpath(path, input_dir): exitcode for path, (exitcode, _, _) in results.items()} == \
+        {'inventory 1/scan.jpg': 0, 'scan.jp2': 0, 'corrupted.jpg': 1, 'truncated.jp2': 1}
+    for name in ('inventory 1/scan.jpg', 'scan.jp2'):
+        image_path = str(input_dir / name)
+        full = extract_main_bounding_box.extract_bounding_rect(
+            extract_main_bounding_box.binarize_image(extract_main_bounding_box.load_image(image_path)))
+        found = sorted(results[image_path][1:])
+        for full_dimension, dimension in zip(main_rect_dimensions(full), found):
+            assert dimension == pytest.approx(full_dimension, rel=TOLERANCE)
+        with Image.open(os.path.join(thumbnail_dir, name + '.thumbnail.jpg')) as thumbnail:
+            assert max(thumbnail.size) == 400
+    assert not os.path.exists(os.path.join(thumbnail_dir, 'corrupted.jpg.thumbnail.jpg'))
+
+    # Only images that changed, or whose thumbnail is missing, are processed again
+    assert image_pipeline.main(str(input_dir), results_file, **options) == 0
+    os.remove(os.path.join(thumbnail_dir, 'scan.jp2.thumbnail.jpg'))
+    write_scan(str(input_dir / 'inventory 1' / 'scan.jpg'), width=600, height=800, seed=1)
+    shutil.copy(input_dir / 'scan.jp2', input_dir / 'truncated.jp2')
+    assert image_pipeline.main(str(input_dir), results_file, **options) == 3
+    results = read_results(results_file)
+    assert results[str(input_dir / 'truncated.jp2')][0] == 0
+    assert max(results[str(input_dir / 'inventory 1' / 'scan.jpg')][1:]) < 700
@@ -0,0 +1,51 @@
+import pytest
+
+from ngram_filter import WordFilter, ahocorasick
+from ngram_text import normalize_text
+
+
+def accepts_reference(text, exclude_words, required_words, exclude_words_insensitive, required_words_insensitive):
+    """The per word loops find_ngrams used before WordFilter."""
+    for word in exclude_words_insensitive:
+        if normalize_text(word).lower() in text.lower():
+            return False
+    for word in required_words_insensitive:
+        if normalize_text(word).lower() not in text.lower():
+            return False
+    for word in exclude_words:
+        if normalize_text(word) in text:
+            return False
+    for word in required_words:
+        if normalize_text(word) not in text:
+            return False
+    return True
+
+
+DOCUMENTS = [normalize_text(text) for text in [
+    "Ik verklaar hierbij dat de ondergetekende te Amsterdam woont.",
+    "In der Stadt Groß-Britannië wohnte der Herr.",
+    "AMSTERDAM, den 12 maart 1921. Verklaring van de burgemeester.",
+    "Lijst der inwoners van Den Haag",
+    "",
+]]
+
+RULES = [
+    ([], [], [], []),
+    (["de"], [], [], []),
+    ([], ["der", "de"], [], []),
+    ([], [], ["amsterdam"], []),
+    ([], [], [], ["AMSTERDAM", "verklar"]),
+    (["Groß"], ["Herr"], [], ["stadt"]),
+    (["Haag"], [], ["VERKLARING"], ["den"]),
+    (["-"], [], [], []),
+    ([], ["."], [], []),
+]
+
+
+@pytest.mark.parametrize('use_automaton', [False, pytest.param(True, marks=pytest.mark.skipif(
+    ahocorasick is None, reason="pyahocorasick is not installed"))])
+def test_word_filter_matches_per_word_loops(use_automaton):
+    for rules in RULES:
+        word_filter = WordFilter(*rules, use_automaton=use_automaton)
+        for text in DOCUMENTS:
+            assert word_filter.accepts(text) == accepts_reference(text, *rules), (rules, text)
@@ -0,0 +1,131 @@
+import os
+import random
+
+import pytest
+
+from conftest import load_script
+from ngram_index import NgramIndex, build_index
+from ngram_text import normalize_text
+
+find_ngrams_script = load_script('text/find-ngrams.py', 'find_ngrams')
+
+WORDS = ["de", "het", "een", "Amsterdam", "café", "Groß-Britannië", "verklaring", "burgemeester", "(getekend)",
+         "woonachtig", "te", "Den", "Haag", "geboren", "op", "1921", "maart", "inwoner", "gemeente", "straat"]
+
+
+def write_corpus(directory, num_files=60, seed=5):
+    rng = random.Random(seed)
+    for i in range(num_files):
+        subdir = os.path.join(directory, f"inv{i % 3}")
+        os.makedirs(subdir, exist_ok=True)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+        if i % 4 == 0:
+            words = ["Ik", "verklaar", "hierbij", "dat", "de", "ondergetekende"] + words
+        with open(os.path.join(subdir, f"NL-test_{i:03d}.txt"), 'w', encoding='utf-8') as f:
+            f.write(' '.join(words))
+
+
+QUERIES = [
+    {},
+    {'required_words': ['Amsterdam']},
+    {'required_words_insensitive': ['DEN HAAG'], 'exclude_words': ['cafe']},
+    {'exclude_words_insensitive': ['verklaar hierbij']},
+    {'required_words': ['Brit'], 'exclude_words': ['getekend']},
+]
+
+
+def as_paths(result):
+    common_ngrams, ngram_files, file_paths = result
+    return sorted(common_ngrams), {ngram: [file_paths[file_id] for file_id in files] for ngram, files in ngram_files.items()}
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query_matches_find_ngrams(tmp_path, query):
+    corpus = str(tmp_path / 'corpus')
+    write_corpus(corpus)
+    build_index(corpus, str(tmp_path / 'index'))
+    options = dict(n=3, top_k=50, tokens_to_ignore=2, **query)
+    expected = find_ngrams_script.find_ngrams(corpus, None, set(), **options)
+    result = find_ngrams_script.query_index(str(tmp_path / 'index'), None, set(), **options)
+    assert as_paths(result) == as_paths(expected)
+
+
+def test_incremental_update_matches_full_build(tmp_path):
+    corpus = str(tmp_path / 'corpus')
+    write_corpus(corpus)
+    build_index(corpus, str(tmp_path / 'index'))
+
+    os.remove(os.path.join(corpus, 'inv0', 'NL-test_000.txt'))
+    with open(os.path.join(corpus, 'inv1', 'NL-test_001.txt'), 'a', encoding='utf-8') as f:
+        f.write(' Rotterdam nieuwe woorden')
+    with open(os.path.join(corpus, 'inv2', 'NL-test_new.txt'), 'w', encoding='utf-8') as f:
+        f.write('Ik verklaar hierbij dat de ondergetekende te Rotterdam woont')
+    build_index(corpus, str(tmp_path / 'index'))
+    build_index(corpus, str(tmp_path / 'full'))
+
+    updated = NgramIndex(str(tmp_path / 'index'))
+    full = NgramIndex(str(tmp_path / 'full'))
+    assert sorted(updated.files) == sorted(full.files)
+    for term in ['Rotterdam', 'Amsterdam', 'woorden']:
+        assert ({updated.files[i][0] for i in updated.files_containing(term)} ==
+                {full.files[i][0] for i in full.files_containing(term)})
+    assert updated.cache.token_counter() == full.cache.token_counter()
+    updated.release()
+    full.release()
+
+
+def test_multi_word_filters_are_answered_from_the_index(tmp_path):
+    corpus = str(tmp_path / 'corpus')
+    write_corpus(corpus)
+    build_index(corpus, str(tmp_path / 'index'))
+    index = NgramIndex(str(tmp_path / 'index'))
+    terms = ['verklaar hierbij', 'te Den', 'Haag geboren op', 'de onder', 'aag ge', 'de het']
+    texts = []
+    for file_path, _, _ in index.files:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            texts.append(normalize_text(f.read()))
+    expected = {term: [file_id for file_id, text in enumerate(texts) if term in text] for term in terms}
+    assert all(expected.values())
+    for term in terms:
+        assert index.select_files(required_words=[term]) == expected[term]
+    # The files are not read again, so removed or edited files are answered as they were indexed
+    for file_path, _, _ in index.files[::2]:
+        os.remove(file_path)
+    for file_path, _, _ in index.files[1::2]:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('leeg')
+    for term in terms:
+        assert index.select_files(required_words=[term]) == expected[term]
+    assert index.select_files(required_words_insensitive=['VERKLAAR HIERBIJ']) == expected['verklaar hierbij']
+    index.release()
+
+
+def test_limit_selects_the_files_find_ngrams_reads_after_an_update(tmp_path):
+    corpus = str(tmp_path / 'corpus')
+    write_corpus(corpus)
+    build_index(corpus, str(tmp_path / 'index'))
+    # Files that are new or changed since the last build get the highest ids, but are read first by find_ngrams
+    with open(os.path.join(corpus, 'inv0', 'NL-test_000.txt'), 'a', encoding='utf-8') as f:
+        f.write(' Rotterdam')
+    with open(os.path.join(corpus, 'NL-test_top.txt'), 'w', encoding='utf-8') as f:
+        f.write('Ik verklaar hierbij dat de ondergetekende te Rotterdam woont')
+    build_index(corpus, str(tmp_path / 'index'))
+
+    _, _, expected = find_ngrams_script.find_ngrams(corpus, None, set(), n=3, tokens_to_ignore=2, limit=10,
+                                                    required_words=['de'])
+    index = NgramIndex(str(tmp_path / 'index'))
+    assert sorted(index.files[i][0] for i in index.select_files(required_words=['de'], limit=10)) == sorted(expected)
+    index.release()
+
+
+def test_multiple_orders_match_single_order_runs(tmp_path):
+    corpus = str(tmp_path / 'corpus')
+    write_corpus(corpus)
+    options = dict(top_k=50, tokens_to_ignore=2, required_words=['Amsterdam'])
+    results = find_ngrams_script.find_ngrams(corpus, None, set(), n=[2, 3, 4], **options)
+    assert sorted(results) == [2, 3, 4]
+    for n, result in results.items():
+        assert as_paths(result) == as_paths(find_ngrams_script.find_ngrams(corpus, None, set(), n=n, **options))
+    assert find_ngrams_script.parse_ngram_sizes('3-8') == [3, 4, 5, 6, 7, 8]
+    assert find_ngrams_script.parse_ngram_sizes('3,5') == [3, 5]
+    assert find_ngrams_script.parse_ngram_sizes('5') == 5
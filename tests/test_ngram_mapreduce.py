@@ -0,0 +1,58 @@
+import random
+from collections import Counter
+
+import pytest
+
+from ngram_mapreduce import count_ngrams_sharded
+
+
+class BigramCounter:
+    """Count the bigrams and trigrams of made up files, by file id, like CachedNgramCounter."""
+    orders = (2, 3)
+
+    def __init__(self, files):
+        self.files = files
+
+    def __call__(self, file_id):
+        tokens = self.files[file_id]
+        return [Counter(' '.join(tokens[i:i + n]).encode() for i in range(len(tokens) - n + 1)) for n in self.orders]
+
+
+def make_files(seed=6, num_files=200, vocabulary_size=30):
+    rng = random.Random(seed)
+    return [[f"w{rng.randint(0, vocabulary_size)}" for _ in range(rng.randint(0, 50))] for _ in range(num_files)]
+
+
+def test_sharded_counts_match_a_single_counter():
+    files = make_files()
+    count_file = BigramCounter(files)
+    expected = [Counter() for _ in count_file.orders]
+    for file_id in range(len(files)):
+        for counter, file_counter in zip(expected, count_file(file_id)):
+            counter.update(file_counter)
+
+    # One task in flight at a time, so batches and shards are submitted as earlier ones complete
+    most_common, ngram_files = count_ngrams_sharded(list(range(len(files))), count_file, 20, num_processes=2,
+                                                    num_shards=3, batch_size=16, max_in_flight=1)
+    for order, counter in enumerate(expected):
+        assert sorted(count for _, count in most_common[order]) == sorted(count for _, count in counter.most_common(20))
+        for key, count in most_common[order]:
+            assert counter[key] == count
+            assert list(ngram_files.get(key)) == [file_id for file_id in range(len(files)) if key in count_file(file_id)[order]]
+
+
+@pytest.mark.parametrize('top_k', [7, 50])
+def test_ties_at_the_cutoff_do_not_depend_on_the_workers(top_k):
+    # Many n-grams occur once or twice, so the cutoff falls in a run of equal counts
+    files = make_files(seed=8, num_files=120, vocabulary_size=200)
+    count_file = BigramCounter(files)
+    file_ids = list(range(len(files)))
+    results = []
+    for num_processes, num_shards, batch_size in [(1, 1, 120), (2, 3, 8), (3, 5, 4), (4, 16, 1)]:
+        most_common, ngram_files = count_ngrams_sharded(file_ids, count_file, top_k, num_processes,
+                                                        num_shards=num_shards, batch_size=batch_size)
+        results.append((most_common, {key: list(ngram_files.get(key)) for order in most_common for key, _ in order}))
+    assert all(result == results[0] for result in results[1:])
+    for order_most_common in results[0][0]:
+        assert len(order_most_common) == top_k
+        assert order_most_common == sorted(order_most_common, key=lambda x: (-x[1], x[0]))
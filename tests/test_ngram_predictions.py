@@ -0,0 +1,61 @@
+import glob
+import json
+import os
+import random
+
+from ngram_predictions import PredictionsMap, load_predictions_map
+
+
+def load_predictions_map_reference(predictions_dir):
+    """load_predictions_map as it was, one json.load after another."""
+    predictions_map = {}
+    for json_file in glob.glob(os.path.join(predictions_dir, "*.json")):
+        try:
+            with open(json_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                for result in data.get("results", []):
+                    identifier = result.get("identifier").replace('thumbnails/data/', '').replace('.jp2.thumbnail.jpg', '.txt').replace('NL-HaNA_2.09.09', 'page/NL-HaNA_2.09.09')
+                    combined = result.get("predictions", {}).get("combined", {})
+                    if identifier and isinstance(combined, dict) and combined:
+                        predictions_map[identifier] = max(combined.values())
+        except Exception:
+            pass
+    return predictions_map
+
+
+def write_predictions(directory, num_files=4, seed=11):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(num_files):
+        results = []
+        for _ in range(50):
+            scan = rng.randint(0, 120)
+            results.append({
+                'identifier': f"thumbnails/data/NL-HaNA_2.09.09/{scan // 10}/NL-HaNA_2.09.09_{scan:04d}.jp2.thumbnail.jpg",
+                'predictions': {'combined': {label: rng.random() for label in rng.sample('abcdef', rng.randint(0, 3))}},
+            })
+        if i == num_files - 1:
+            results.insert(10, {'predictions': {}})  # no identifier, stops reading this file
+        with open(os.path.join(directory, f"predictions-{i}.json"), 'w', encoding='utf-8') as f:
+            json.dump({'results': results}, f)
+
+
+def test_load_predictions_map_matches_reference_and_is_cached(tmp_path):
+    predictions_dir = str(tmp_path / 'predictions')
+    write_predictions(predictions_dir)
+    expected = load_predictions_map_reference(predictions_dir)
+
+    predictions_map = load_predictions_map(predictions_dir, num_processes=2)
+    assert isinstance(predictions_map, PredictionsMap)
+    assert dict(predictions_map.items()) == expected
+    for identifier, prediction in expected.items():
+        assert predictions_map.get(identifier) == prediction
+    assert predictions_map.get('page/NL-HaNA_2.09.09/missing.txt', float('inf')) == float('inf')
+
+    cache_dir = os.path.join(predictions_dir, '.predictions_cache')
+    cache_mtime = os.stat(os.path.join(cache_dir, 'meta.json')).st_mtime_ns
+    assert dict(load_predictions_map(predictions_dir).items()) == expected
+    assert os.stat(os.path.join(cache_dir, 'meta.json')).st_mtime_ns == cache_mtime
+
+    os.remove(os.path.join(predictions_dir, 'predictions-0.json'))
+    assert dict(load_predictions_map(predictions_dir).items()) == load_predictions_map_reference(predictions_dir)
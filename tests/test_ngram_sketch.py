@@ -0,0 +1,45 @@
+import random
+from collections import Counter
+
+from ngram_sketch import CountMinSketch, count_heavy_hitters
+
+
+def make_files(seed=3, num_files=200):
+    rng = random.Random(seed)
+    common = [f"common-{i}".encode() for i in range(20)]
+    rare = [f"rare-{i}".encode() for i in range(5000)]
+    files = []
+    for _ in range(num_files):
+        keys = rng.sample(common, 5) + rng.sample(rare, 50)
+        files.append([Counter(keys)])
+    return files
+
+
+def test_count_min_sketch_never_underestimates():
+    sketch = CountMinSketch(width=64, depth=3)
+    exact = Counter()
+    for file_counters in make_files():
+        for key, count in file_counters[0].items():
+            sketch.add(key, count)
+            exact[key] += count
+    for key, count in exact.items():
+        assert count <= sketch.estimate(key) <= count + sketch.error_bound() * 2
+
+
+def test_heavy_hitters_are_exact_and_independent_of_file_order():
+    files = make_files()
+    exact = Counter()
+    for file_counters in files:
+        exact.update(file_counters[0])
+    expected = sorted(exact.items(), key=lambda x: (-x[1], x[0]))[:10]
+
+    results = []
+    for order_seed in range(3):
+        file_ids = list(range(len(files)))
+        random.Random(order_seed).shuffle(file_ids)
+        most_common, postings = count_heavy_hitters(file_ids, files.__getitem__, 10, width=1024, depth=4)
+        results.append(most_common[0])
+        for key, count in most_common[0]:
+            assert list(postings.get(key)) == [i for i, f in enumerate(files) if key in f[0]]
+    assert results[0] == expected
+    assert results[1] == results[0] and results[2] == results[0]
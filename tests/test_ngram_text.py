@@ -0,0 +1,100 @@
+import random
+
+import pytest
+from nltk.tokenize import word_tokenize
+from unidecode import unidecode
+
+from ngram_text import normalize_text, token_text, tokenize_fast, tokenize_nltk
+
+
+def clean_text_reference(text):
+    """clean_text as it was before normalize_text replaced it."""
+    text = ((text.replace('-', '').replace(',', '').replace('.', '').replace('!', '').replace('?', '').replace(';','')
+            .replace(':', '').replace('/', '').replace('\\', '')).replace(',', '').replace('„', '').replace('\'', '')
+            .replace('(', '').replace(')', '').replace('=',''))
+    text = unidecode(text)
+    return text.strip()
+
+
+def token_text_reference(text):
+    text = clean_text_reference(text)
+    text = text.replace('-', '').replace(',', '').replace('.', '')
+    return unidecode(text)
+
+
+SAMPLES = [
+    "Ik verklaar hierbij, dat de ondergetekende – woonachtig te 's-Gravenhage – geboren is.",
+    "Naam: Jansen, Pieter (geb. 12-03-1921)\nBeroep: arbeider/landbouwer\nAdres: Kerkstraat 5 [achter]",
+    "„Aan den Heer Burgemeester” van Groß-Britannië; café «Le Déjà-vu» €3,50 & 10% korting!",
+    "He said \"we cannot go\" and `gonna` wanna gotta lemme gimme d'ye more'n 'tis",
+    "  tabs\tand\nnewlines  *stars* <tags> {braces} @home #1 $5 ~tilde~ ^caret^ _under_ |pipe| +plus+ ",
+    "Ζεύς, Москва, 東京, ﬁnance, Ø, æ, œ, ß, ĳ",
+    "",
+]
+# unidecode turns these into '?' and '!', which normalize_text removed before
+TERMINATOR_SAMPLES = [
+    '¿Qué? ¡Sí! ‼',
+    '"¿Qué pasa?" ¡Nada! "‼" dijo hij',
+    'Hij riep ‼"Brand"‼ en ging ¿"waarom"? weg',
+    '¡"Hola"! ¿"Adiós"‼ "¿" "¡" ‼"',
+    '«¿Verklaring?» “¡Ja!” ‘‼’ einde',
+]
+
+
+def punkt_available():
+    try:
+        word_tokenize('Een zin. Nog een zin.')
+    except LookupError:
+        return False
+    return True
+
+
+def random_samples(count=500, seed=42):
+    alphabet = ("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789     \n\t"
+                "-,.!?;:/\\„'()=\"`[]{}<>@#$%&*+^_|~–—«»“”‘’éëïöüçñßØæ€")
+    words = ['cannot', 'gonna', 'wanna', 'gotta', 'lemme', 'gimme', "'t", "is", "was", "more'n", "d'ye"]
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(0, 40)):
+            if rng.random() < 0.1:
+                parts.append(rng.choice(words))
+            else:
+                parts.append(rng.choice(alphabet))
+        samples.append(''.join(parts))
+    return samples
+
+
+def test_normalize_text_matches_clean_text():
+    for text in SAMPLES + random_samples():
+        assert normalize_text(text) == clean_text_reference(text)
+
+
+def test_token_text_matches_first_pass():
+    for text in SAMPLES + random_samples():
+        assert token_text(text, normalize_text(text)) == token_text_reference(text)
+
+
+def test_tokenizers_match_word_tokenize_on_cleaned_text():
+    for text in SAMPLES + TERMINATOR_SAMPLES + random_samples():
+        cleaned = token_text_reference(text)
+        expected = word_tokenize(cleaned, preserve_line=True)
+        assert tokenize_nltk(cleaned) == expected
+        assert tokenize_fast(cleaned) == expected
+
+
+@pytest.mark.skipif(not punkt_available(), reason='the nltk Punkt models are not installed')
+def test_tokenizers_match_word_tokenize_with_sentence_splitting():
+    # The tokens of the former first pass, which split the cleaned text into sentences with Punkt first
+    for text in SAMPLES + TERMINATOR_SAMPLES + random_samples():
+        cleaned = token_text_reference(text)
+        expected = word_tokenize(cleaned)
+        assert tokenize_nltk(cleaned) == expected
+        assert tokenize_fast(cleaned) == expected
+
+
+def test_fast_tokenizer_matches_nltk_on_raw_text():
+    # Not what find_ngrams feeds it, but the context dependent fallback has to hold up as well
+    for text in SAMPLES + random_samples(seed=7):
+        assert tokenize_fast(text) == tokenize_nltk(text)
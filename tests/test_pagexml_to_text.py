@@ -0,0 +1,236 @@
+import itertools
+import json
+import os
+import random
+import tarfile
+import zipfile
+from xml.sax.saxutils import escape
+
+from conftest import load_script
+from file_manifest import FileManifest
+from ngram_pagexml import tokenize_pagexml
+from page_shards import PageStore, shard_paths
+
+pagexml_to_text = load_script('conversion/pagexml-to-text.py', 'pagexml_to_text')
+
+NAMESPACES = {
+    2013: 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15',
+    2019: 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15',
+}
+LINES = ["Ik verklaar hierbij dat", "de ondergetekende", "Amsterdam", "woonachtig te Den Haag.", "Geboren op 1921",
+         "burge-", "meester van de gemeente", "Naam:", "  ", "Groß-Britannië en café", "(getekend)", "de straat -"]
+
+
+def make_text_region(rng, region_id, depth=0):
+    parts = ['<Coords points="0,0 10,10"/>']
+    for i in range(rng.randint(0, 8)):
+        x = rng.randint(0, 2000)
+        coords = f'<Coords points="{x},{10 * i} {x + 300},{10 * i} {x + 300},{10 * i + 8} {x + rng.randint(-50, 5)},{10 * i + 8}"/>'
+        if rng.random() < 0.1:
+            coords = ''
+        text = escape(rng.choice(LINES))
+        equivs = f'<TextEquiv><PlainText>{text}</PlainText><Unicode>{text}</Unicode></TextEquiv>'
+        if rng.random() < 0.1:
+            equivs += f'<TextEquiv index="1"><!-- alternative --><PlainText>{escape(rng.choice(LINES))}</PlainText></TextEquiv>'
+        if rng.random() < 0.05:
+            equivs = '<TextEquiv><PlainText/></TextEquiv>'
+        parts.append(f'<TextLine id="{region_id}l{i}">{coords}{equivs}</TextLine>')
+        if depth == 0 and rng.random() < 0.05:
+            # Nested regions come after the lines of the outer region in document order
+            parts.insert(rng.randint(1, len(parts)), make_text_region(rng, f"{region_id}n{i}", depth + 1))
+    return f'<TextRegion id="{region_id}">{"".join(parts)}</TextRegion>'
+
+
+def make_pagexml(rng, version=2019, num_regions=4):
+    regions = []
+    for r in range(num_regions):
+        region = make_text_region(rng, f"r{r}")
+        if rng.random() < 0.2:
+            region = f'<TableRegion id="t{r}"><Coords points="0,0 5,5"/>{region}</TableRegion>'
+        regions.append(region)
+        if rng.random() < 0.2:
+            regions.append(f'<ImageRegion id="i{r}"><Coords points="1,1 2,2"/></ImageRegion>')
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n<PcGts xmlns="{NAMESPACES[version]}"><Metadata/>'
+            f'<Page imageFilename="scan.jpg" imageWidth="3000" imageHeight="4000">{"".join(regions)}</Page></PcGts>')
+
+
+def write_pagexml_tree(directory, num_files=30, seed=7):
+    rng = random.Random(seed)
+    for i in range(num_files):
+        subdir = os.path.join(directory, f"inv{i % 3}", "page") if i % 2 else directory
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"NL-test_{i:04d}.xml"), 'w', encoding='utf-8') as f:
+            f.write(make_pagexml(rng, version=2013 if i % 4 == 0 else 2019))
+    with open(os.path.join(directory, "broken.xml"), 'w', encoding='utf-8') as f:
+        f.write('<PcGts><Page>')
+
+
+FLAGS = dict(separate_single_words=True, merge_dashes=True, split_periods=False, merge_quotes=False, separate_colons=True)
+
+
+def read_outputs(output_dir):
+    outputs = {}
+    for subdir, _, files in os.walk(output_dir):
+        for file in files:
+            with open(os.path.join(subdir, file), 'r', encoding='utf-8') as f:
+                outputs[os.path.relpath(os.path.join(subdir, file), output_dir)] = f.read()
+    return outputs
+
+
+def test_recursive_parallel_conversion_matches_single_files(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    write_pagexml_tree(input_dir)
+    failed_list = str(tmp_path / 'failed.json')
+    failed = pagexml_to_text.main(input_dir, str(tmp_path / 'text'), recursive=True, num_processes=2,
+                                  failed_list=failed_list, **FLAGS)
+
+    outputs = read_outputs(str(tmp_path / 'text'))
+    assert len(outputs) == 30
+    for relative_path, text in outputs.items():
+        lines = pagexml_to_text.read_pagexml_file(os.path.join(input_dir, relative_path.replace('.txt', '.xml')), **FLAGS)
+        assert text == ''.join(line + '\n' for line in lines)
+    with open(failed_list, 'r', encoding='utf-8') as f:
+        assert [failure['input'] for failure in json.load(f)] == [os.path.join(input_dir, 'broken.xml')]
+    assert len(failed) == 1
+
+    flat = pagexml_to_text.main(input_dir, str(tmp_path / 'flat'), **FLAGS)
+    assert len(flat) == 1
+    assert sorted(read_outputs(str(tmp_path / 'flat'))) == sorted(path for path in outputs if os.sep not in path)
+
+
+def test_incremental_conversion_only_converts_changed_files(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    output_dir = str(tmp_path / 'text')
+    write_pagexml_tree(input_dir)
+    pagexml_to_text.main(input_dir, output_dir, recursive=True, incremental=True, **FLAGS)
+    unchanged_path = os.path.join(output_dir, 'NL-test_0000.txt')
+    unchanged_mtime = os.stat(unchanged_path).st_mtime_ns
+
+    changed_path = os.path.join(input_dir, 'NL-test_0002.xml')
+    with open(changed_path, 'w', encoding='utf-8') as f:
+        f.write(make_pagexml(random.Random(1)))
+    os.utime(changed_path, ns=(unchanged_mtime + 10**9, unchanged_mtime + 10**9))
+    failed = pagexml_to_text.main(input_dir, output_dir, recursive=True, incremental=True, **FLAGS)
+
+    assert os.stat(unchanged_path).st_mtime_ns == unchanged_mtime
+    with open(os.path.join(output_dir, 'NL-test_0002.txt'), 'r', encoding='utf-8') as f:
+        assert f.read() == ''.join(line + '\n' for line in pagexml_to_text.read_pagexml_file(changed_path, **FLAGS))
+    # Failed files have no output, so they are retried
+    assert [failure['input'] for failure in failed] == [os.path.join(input_dir, 'broken.xml')]
+    assert not any(name.endswith('.tmp') for name in os.listdir(output_dir))
+
+
+def test_manifest_conversion_only_converts_changed_files(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    output_dir = str(tmp_path / 'text')
+    manifest = str(tmp_path / 'manifest.tsv')
+    write_pagexml_tree(input_dir)
+    pagexml_to_text.main(input_dir, output_dir, recursive=True, manifest=manifest, **FLAGS)
+    unchanged_path = os.path.join(output_dir, 'NL-test_0000.txt')
+    # Outputs are not looked at, only the PageXML files, so even an output older than its input stays as it is
+    os.utime(unchanged_path, ns=(0, 0))
+
+    changed_path = os.path.join(input_dir, 'NL-test_0002.xml')
+    with open(changed_path, 'w', encoding='utf-8') as f:
+        f.write(make_pagexml(random.Random(1)))
+    failed = pagexml_to_text.main(input_dir, output_dir, recursive=True, manifest=manifest, **FLAGS)
+
+    assert os.stat(unchanged_path).st_mtime_ns == 0
+    with open(os.path.join(output_dir, 'NL-test_0002.txt'), 'r', encoding='utf-8') as f:
+        assert f.read() == ''.join(line + '\n' for line in pagexml_to_text.read_pagexml_file(changed_path, **FLAGS))
+    # Failed files stay out of the manifest, so they are retried
+    assert [failure['input'] for failure in failed] == [os.path.join(input_dir, 'broken.xml')]
+    assert len(pagexml_to_text.list_pagexml_files(input_dir, output_dir, recursive=True, manifest=FileManifest(manifest))) == 1
+
+
+def test_streaming_parser_matches_tree_parser(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    write_pagexml_tree(input_dir, num_files=40)
+    with open(os.path.join(input_dir, "bad-coords.xml"), 'w', encoding='utf-8') as f:
+        f.write(make_pagexml(random.Random(3)).replace('<TextLine id="r0l0"><Coords points="', '<TextLine id="r0l0"><Coords points=",', 1))
+    pagexml_files = [input_path for input_path, _ in pagexml_to_text.list_pagexml_files(input_dir, '', recursive=True)]
+    parsers = [False, True] if pagexml_to_text.lxml_etree is not None else [False]
+
+    for flags in itertools.product([False, True], repeat=5):
+        options = dict(zip(['separate_single_words', 'merge_dashes', 'split_periods', 'merge_quotes', 'separate_colons'], flags))
+        for input_path in pagexml_files:
+            expected = pagexml_to_text.read_pagexml_file(input_path, **options)
+            for use_lxml in parsers:
+                assert pagexml_to_text.read_pagexml_stream(input_path, use_lxml=use_lxml, **options) == expected, input_path
+
+
+def test_archives_and_shards_match_text_files(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    write_pagexml_tree(input_dir)
+    pagexml_to_text.main(input_dir, str(tmp_path / 'text'), recursive=True, **FLAGS)
+    expected = read_outputs(str(tmp_path / 'text'))
+
+    archive_dir = tmp_path / 'archives'
+    os.makedirs(archive_dir / 'nested')
+    pagexml_files = [(input_path, output_path) for input_path, output_path in pagexml_to_text.list_pagexml_files(input_dir, '', recursive=True)
+                     if not input_path.endswith('broken.xml')]
+    with zipfile.ZipFile(archive_dir / 'inv-a.zip', 'w') as archive:
+        for input_path, _ in pagexml_files[:15]:
+            archive.write(input_path, os.path.relpath(input_path, input_dir))
+        archive.writestr('../escape.xml', make_pagexml(random.Random(2)))
+    with tarfile.open(archive_dir / 'nested' / 'inv-b.tar.gz', 'w:gz') as archive:
+        for input_path, _ in pagexml_files[15:]:
+            archive.add(input_path, os.path.relpath(input_path, input_dir))
+    archive_pages = {}
+    for input_path, _ in pagexml_files:
+        archive = 'inv-a' if len(archive_pages) < 15 else os.path.join('nested', 'inv-b')
+        archive_pages[os.path.join(archive, os.path.relpath(input_path, input_dir)).replace('.xml', '.txt')] = \
+            expected[os.path.relpath(input_path, input_dir).replace('.xml', '.txt')]
+
+    failed = pagexml_to_text.main(str(archive_dir), str(tmp_path / 'from-archives'), recursive=True, archives=True,
+                                  num_processes=2, **FLAGS)
+    assert read_outputs(str(tmp_path / 'from-archives')) == archive_pages
+    assert [failure['input'] for failure in failed] == [f"{archive_dir / 'inv-a.zip'}:../escape.xml"]
+
+    for output_format in ('jsonl', 'packed'):
+        output_dir = str(tmp_path / output_format)
+        pagexml_to_text.main(str(archive_dir), output_dir, recursive=True, archives=True, output_format=output_format, **FLAGS)
+        pagexml_to_text.main(input_dir, output_dir + '-files', recursive=True, output_format=output_format,
+                             pages_per_shard=7, **FLAGS)
+        store = PageStore(output_dir)
+        assert {page + '.txt': store.text(page) for page in store} == archive_pages
+        store = PageStore(output_dir + '-files')
+        assert len(shard_paths(output_dir + '-files')) == 5
+        assert {page + '.txt': store.text(page) for page in store} == expected
+        assert store.lines('NL-test_0000') == pagexml_to_text.read_pagexml_file(os.path.join(input_dir, 'NL-test_0000.xml'), **FLAGS)
+
+
+def test_pagexml_ngrams_match_ngrams_of_converted_text(tmp_path):
+    find_ngrams_script = load_script('text/find-ngrams.py', 'find_ngrams')
+    input_dir = str(tmp_path / 'pagexml')
+    write_pagexml_tree(input_dir, num_files=60)
+    pagexml_to_text.main(input_dir, str(tmp_path / 'text'), recursive=True, **FLAGS)
+    options = dict(n=[2, 3], top_k=40, tokens_to_ignore=2, required_words_insensitive=['ik verklaar'], exclude_words=['cafe'])
+    expected = find_ngrams_script.find_ngrams(str(tmp_path / 'text'), 'NL-test_00', {'NL-test_0003'}, **options)
+
+    for num_processes in (0, 2):
+        results = find_ngrams_script.find_pagexml_ngrams(input_dir, 'NL-test_00', {'NL-test_0003'}, recursive=True,
+                                                         merge_options=FLAGS, num_processes=num_processes, **options)
+        for n in (2, 3):
+            common_ngrams, ngram_files, file_paths = results[n]
+            expected_ngrams, expected_files, expected_paths = expected[n]
+            # Ties at the cutoff may be broken differently, files are counted in another order
+            assert sorted(count for _, count in common_ngrams) == sorted(count for _, count in expected_ngrams)
+            lowest = min(count for _, count in expected_ngrams)
+            assert {ngram: count for ngram, count in common_ngrams if count > lowest} == \
+                {ngram: count for ngram, count in expected_ngrams if count > lowest}
+            for ngram, files in ngram_files.items():
+                if ngram not in expected_files:
+                    continue
+                assert sorted(os.path.relpath(file_paths[i], input_dir).replace('.xml', '.txt') for i in files) == \
+                    sorted(os.path.relpath(expected_paths[i], str(tmp_path / 'text')) for i in expected_files[ngram])
+
+
+def test_pagexml_tokens_keep_the_task_order_with_a_bounded_window(tmp_path):
+    input_dir = str(tmp_path / 'pagexml')
+    write_pagexml_tree(input_dir, num_files=30)
+    expected = list(tokenize_pagexml(input_dir, recursive=True, merge_options=FLAGS, files_per_task=2))
+    assert len(expected) == 30
+    for max_in_flight in (1, 3):
+        assert list(tokenize_pagexml(input_dir, recursive=True, merge_options=FLAGS, files_per_task=2, num_processes=2,
+                                     max_in_flight=max_in_flight)) == expected
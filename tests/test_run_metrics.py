@@ -0,0 +1,98 @@
+import io
+import json
+import pstats
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import run_metrics
+from conftest import load_script, repo_root
+
+checker = load_script('check/find-corrupted-jpg.py', 'find_corrupted_jpg')
+
+
+def busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+    return seconds
+
+
+@pytest.fixture
+def metrics():
+    yield run_metrics.start('test')
+    run_metrics._current = run_metrics.RunMetrics(None, enabled=False)
+
+
+def test_stages_sum_every_call(metrics):
+    for size in (10, 20, 30):
+        with run_metrics.stage('read') as stage:
+            stage.add(1, size)
+            with run_metrics.stage('read'):
+                # Entering a stage again inside itself counts once
+                busy(0.01)
+    words = list(run_metrics.iter_stage('walk', iter(['a', 'bb', 'ccc']), len))
+    assert words == ['a', 'bb', 'ccc']
+
+    report = metrics.report()
+    read = report['stages']['read']
+    assert (read['calls'], read['items'], read['bytes']) == (3, 3, 60)
+    assert read['seconds'] >= 0.03 and read['cpu_seconds'] >= 0.03
+    assert read['items_per_second'] == pytest.approx(3 / read['seconds'], rel=1e-3)
+    assert read['peak_rss_bytes'] > 0 and read['worker_utilization'] is None
+    walk = report['stages']['walk']
+    assert (walk['calls'], walk['items'], walk['bytes']) == (4, 3, 6)
+
+
+def test_worker_utilization_of_a_process_pool(metrics):
+    with run_metrics.stage('pool', workers=2) as stage, ProcessPoolExecutor(max_workers=2) as executor:
+        stage.add(sum(executor.map(busy, [0.2, 0.2])))
+    pool = metrics.report()['stages']['pool']
+    assert pool['worker_cpu_seconds'] >= 0.4
+    assert pool['worker_utilization'] == pytest.approx((pool['cpu_seconds'] + pool['worker_cpu_seconds']) / (2 * pool['seconds']), rel=1e-3)
+    assert pool['worker_utilization'] > 0.2
+
+
+def test_disabled_metrics_record_nothing(tmp_path):
+    with run_metrics.stage('read') as stage:
+        stage.add(1, 10)
+    assert list(run_metrics.iter_stage('walk', [1, 2])) == [1, 2]
+    assert run_metrics.current().stages == {}
+    run_metrics.current().write(str(tmp_path / 'metrics.json'))
+    assert not (tmp_path / 'metrics.json').exists()
+
+
+def test_reports_and_profile(tmp_path):
+    metrics = run_metrics.RunMetrics('tool "x"', profile_stage='work')
+    with metrics.stage('work') as stage:
+        busy(0.01)
+        stage.add(2, 100)
+    with metrics.stage('other'):
+        pass
+    metrics.write(str(tmp_path / 'metrics.json'))
+    metrics.write(str(tmp_path / 'metrics.prom'))
+
+    with open(tmp_path / 'metrics.json', encoding='utf-8') as f:
+        report = json.load(f)
+    assert list(report['stages']) == ['work', 'other']
+    assert report['profile'] == str(tmp_path / 'metrics.json.work.prof')
+    stats = io.StringIO()
+    pstats.Stats(report['profile'], stream=stats).print_stats('busy')
+    assert 'busy' in stats.getvalue()
+
+    prometheus = (tmp_path / 'metrics.prom').read_text(encoding='utf-8')
+    assert '# TYPE aelin_stage_items_total counter' in prometheus
+    assert 'aelin_stage_items_total{tool="tool \\"x\\"",stage="work"} 2' in prometheus
+    assert 'aelin_stage_bytes_per_second{tool="tool \\"x\\"",stage="other"}' not in prometheus
+    for line in prometheus.splitlines():
+        assert line.startswith('#') or line.startswith('aelin_')
+
+
+def test_checker_stages(metrics):
+    output = io.StringIO()
+    checker.main(f"{repo_root}/tests/fixtures", output, num_processes=2)
+    stages = metrics.report()['stages']
+    assert stages['walk']['items'] == stages['check']['items'] == len(output.getvalue().splitlines())
+    assert stages['walk']['bytes'] > 0
+    assert stages['check']['workers'] == 2
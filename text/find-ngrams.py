@@ -1,18 +1,35 @@
 import os
+import sys
 import argparse
-import nltk
+import heapq
 import csv
 import json
 from collections import Counter
-from nltk.util import ngrams
-from nltk.tokenize import word_tokenize
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from unidecode import unidecode
-import glob
-
-nltk.download('punkt')
-nltk.download('punkt_tab')
+import numpy as np
+import shutil
+import tempfile
+from contextlib import nullcontext
+
+from ngram_cache import CachedNgramCounter, TokenCache, cache_fingerprint, ngram_ids
+from ngram_clusters import ClusterWriter
+from ngram_filter import WordFilter
+from ngram_index import NgramIndex, build_index, list_text_files
+from ngram_mapreduce import count_ngrams_sharded
+from ngram_minhash import find_minhash_clusters
+from ngram_pagexml import load_converter, tokenize_pagexml
+from ngram_postings import NgramPostings
+from ngram_predictions import load_predictions_map
+from ngram_sketch import count_heavy_hitters
+from ngram_text import TOKENIZERS, get_tokenizer, normalize_text, token_text
+
+# The opt-in metrics shared by all tools
+METRICS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metrics')
+if METRICS_DIR not in sys.path:
+    sys.path.append(METRICS_DIR)
+import run_metrics  # noqa: E402
 
 
 def load_excluded_files(json_path):
@@ -33,239 +50,401 @@ def load_excluded_files(json_path):
     return excluded_files
 
 
-def process_ngrams(most_common_ngrams, ngram_files, top_k):
-    """Process n-grams to remove files linked to higher-ranked n-grams."""
-    seen_files = set()  # Track files linked to higher-ranked n-grams
+def process_ngrams(most_common_ngrams, ngram_files, top_k, num_files=None, lazy=True):
+    """
+    Process n-grams to remove files linked to higher-ranked n-grams.
+
+    ngram_files holds the file ids of every n-gram, the files already linked to a higher-ranked
+    n-gram are tracked in one boolean array over all file ids, so every n-gram is handled with a few
+    array operations however many files it occurs in. num_files is the number of file ids, by
+    default the highest id in ngram_files plus one.
+
+    An n-gram never keeps more files than its count, and the n-grams come in descending count. So
+    with lazy, processing stops as soon as top_k n-grams have an adjusted count at least as high as
+    the count of the next n-gram, the result is the same as processing all of them.
+    """
+    if num_files is None:
+        num_files = max((max(files) for files in ngram_files.values() if len(files)), default=-1) + 1
+    seen_files = np.zeros(num_files, dtype=bool)  # Track files linked to higher-ranked n-grams
     processed_ngrams = []
+    top_counts = []  # Min-heap of the top_k adjusted counts so far
 
-    # Iterate through n-grams in reverse order
     for ngram, count in most_common_ngrams:
-        files = ngram_files[ngram]
+        if lazy and 0 < top_k <= len(top_counts) and count <= top_counts[0]:
+            break
+        files = np.asarray(ngram_files[ngram], dtype=np.intp)
         # Remove files already seen
-        unique_files = [file for file in files if file not in seen_files]
-        # Update the seen files set
-        seen_files.update(unique_files)
+        unique_files = files[~seen_files[files]]
+        # Update the seen files
+        seen_files[unique_files] = True
         # Adjust the count
         adjusted_count = count - (len(files) - len(unique_files))
         # Store the processed n-gram
         if adjusted_count > 0:
-            processed_ngrams.append((ngram, adjusted_count, unique_files))
+            processed_ngrams.append((ngram, adjusted_count, unique_files.tolist()))
+            if len(top_counts) < top_k:
+                heapq.heappush(top_counts, adjusted_count)
+            elif top_k > 0:
+                heapq.heappushpop(top_counts, adjusted_count)
 
     # reorder processed_ngrams by adjusted_count in descending order
     processed_ngrams.sort(key=lambda x: x[1], reverse=True)
-    # Limit the number of processed n-grams to top_k
-    processed_ngrams = processed_ngrams[:top_k]
-
+    # Keep only the top_k n-grams
+    return processed_ngrams[:top_k]
+
+
+def list_candidate_files(directory, prefix, excluded_files):
+    """
+    List the .txt files under directory that pass the filename filters, as (path, size, mtime_ns),
+    in the order of list_text_files.
+    """
+    candidate_files = []
+    with run_metrics.stage('walk') as stage:
+        for file_path, size, mtime_ns in list_text_files(directory):
+            file = os.path.basename(file_path)
+            if (prefix is None or file.startswith(prefix)) and os.path.splitext(file)[0] not in excluded_files:
+                candidate_files.append((file_path, size, mtime_ns))
+                stage.add(1, size)
+    return candidate_files
+
+
+def tokenize_files(candidate_files, cache, limit, word_filter, tokenizer='fast'):
+    """First pass: filter and tokenize the candidate files into the token cache."""
+    tokenize = get_tokenizer(tokenizer)
+    read_stage, clean_stage, tokenize_stage = (run_metrics.stage(name) for name in ('read', 'clean', 'tokenize'))
+    pbar = tqdm(total=0, desc="Total files processed")
+    for file_path in candidate_files:
+        with read_stage, open(file_path, 'r', encoding='utf-8') as f:
+            raw_text = f.read()
+            read_stage.add(1, os.fstat(f.fileno()).st_size)
+        with clean_stage:
+            text = normalize_text(raw_text)  # Clean the text
+            clean_stage.add(1)
+            # Skip this file if it contains exclude words or misses required words
+            if word_filter and not word_filter.accepts(text):
+                continue
+
+        with tokenize_stage:
+            tokens = tokenize(token_text(raw_text, text))
+            cache.add(file_path, tokens)
+            tokenize_stage.add(1)
+        pbar.update(1)
+        if pbar.n >= limit:
+            break
+    pbar.close()
 
 
-    # Keep only the top_k n-grams
-    if len(processed_ngrams) > top_k:
-        processed_ngrams = processed_ngrams[:top_k]
+def count_cached_ngrams(cache, file_ids, token_counter, n=5, top_k=1000, limit_ngrams=100000, num_threads=20,
+                        tokens_to_ignore=1, num_processes=0, num_shards=None, heavy_hitters=False,
+                        sketch_width=1 << 20, sketch_depth=4, minhash=False, num_perm=128, bands=32,
+                        minhash_threshold=0.5):
+    """
+    Second pass: count the n-grams of the given files in the token cache, leaving out the
+    tokens_to_ignore most common tokens and every token occurring 10 times or less in
+    token_counter. Returns the same as find_ngrams, with file ids into cache.files.
 
-    return processed_ngrams
+    n is an n-gram size, or a list of sizes to count all of them in the same pass, sharing the
+    filtered token sequences and the file postings. For a list, a dict from every size to its
+    result is returned.
 
+    By default n-grams are counted exactly, and trimmed to the most common limit_ngrams // 2 whenever
+    there are more than limit_ngrams, so late but common n-grams can be lost. With heavy_hitters,
+    they are counted in fixed memory with a Count-Min sketch instead, see count_heavy_hitters.
 
-def clean_text(text):
-    text = ((text.replace('-', '').replace(',', '').replace('.', '').replace('!', '').replace('?', '').replace(';','')
-            .replace(':', '').replace('/', '').replace('\\', '')).replace(',', '').replace('„', '').replace('\'', '')
-            .replace('(', '').replace(')', '').replace('=',''))
+    With minhash, no n-grams are counted at all: the files are clustered into near duplicates by
+    MinHash signatures of their n-grams, see find_minhash_clusters. Every cluster is returned as the
+    n-gram most of its files share, with the number of files as its count and the files as its
+    postings, so the results are written the same way. Memory grows with the number of files only.
+    """
+    orders = [n] if isinstance(n, int) else list(n)
 
-    text = unidecode(text)  # Normalize all diacritics
-    return text.strip()
+    # Identify the top n most common tokens
+    tokens_to_ignore = {token for token, _ in token_counter.most_common(tokens_to_ignore)}
+    print(f"Top {len(tokens_to_ignore)} tokens to ignore: {', '.join(list(tokens_to_ignore)[:10])}...")
+    # Remove tokens that occur less than 10 times
+    print(f"Total tokens counted: {len(token_counter)}")
+    # tokens_to_ignore = {token for token, count in token_counter.items() if count <= 10 and token not in tokens_to_ignore}
+    tokens_to_ignore = {token for token, count in token_counter.items() if count <= 10 or token in tokens_to_ignore}
+    print(f"Tokens to ignore: {len(tokens_to_ignore)}")
 
-def process_file_for_ngrams(file_path, tokens_to_ignore, n):
-    """Process a single file to extract n-grams."""
-    ngram_counter = Counter()
-    ngram_files = {}
-    # print(file_path)
-    with open(file_path, 'r', encoding='utf-8') as f:
-        text = f.read()
-        text = clean_text(text)  # Clean the text
-        tokens = [token for token in word_tokenize(text) if token not in tokens_to_ignore]
-        # print(tokens)
-        n_grams = ngrams(tokens, n)
-        for ngram in n_grams:
-            ngram_counter[ngram] += 1
-            if ngram not in ngram_files:
-                ngram_files[ngram] = set()
-            ngram_files[ngram].add(file_path)
+    # Generate n-grams from the cached token ids, excluding the ignored tokens
+    count_file = CachedNgramCounter(cache, cache.token_ids(tokens_to_ignore), orders)
+    with run_metrics.stage('count', workers=num_processes or (1 if heavy_hitters else num_threads)) as count_stage:
+        count_stage.add(len(file_ids))
+        if minhash:
+            # Near duplicate clusters, without global n-gram counts or postings
+            most_common_ngrams, ngram_files = find_minhash_clusters(cache, file_ids, count_file.ignore_ids, orders,
+                                                                    top_k=top_k, num_perm=num_perm, bands=bands,
+                                                                    threshold=minhash_threshold, num_threads=num_threads,
+                                                                    num_processes=num_processes)
+        elif heavy_hitters:
+            # In fixed memory, exact counts for the heavy hitters of a Count-Min sketch
+            most_common_ngrams, ngram_files = count_heavy_hitters(file_ids, count_file, top_k,
+                                                                  width=sketch_width, depth=sketch_depth)
+        elif num_processes:
+            # On a process pool, sharded by n-gram so the merge runs in parallel too
+            most_common_ngrams, ngram_files = count_ngrams_sharded(list(file_ids), count_file, top_k,
+                                                                   num_processes, num_shards=num_shards)
+        else:
+            ngram_counters = [Counter() for _ in orders]
+            ngram_files = NgramPostings()
+            merge_stage, trim_stage = run_metrics.stage('merge'), run_metrics.stage('trim')
+            pbar = tqdm(total=len(file_ids), desc="Processing files for n-grams")
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                for file_id, file_ngram_counters in zip(file_ids, executor.map(count_file, file_ids)):
+                    trimmed = False
+                    for order, file_ngram_counter in enumerate(file_ngram_counters):
+                        with merge_stage:
+                            ngram_counters[order].update(file_ngram_counter)
+                            ngram_files.add_file(file_ngram_counter, file_id)
+                            merge_stage.add(len(file_ngram_counter))
+
+                        # Trim ngram_counter to top `limit_ngrams` n-grams, and the postings along with it
+                        if len(ngram_counters[order]) > limit_ngrams:
+                            with trim_stage:
+                                ngram_counters[order] = Counter(dict(ngram_counters[order].most_common(limit_ngrams // 2)))
+                                trim_stage.add(1)
+                            trimmed = True
+                    if trimmed:
+                        with trim_stage:
+                            ngram_files.retain(key for ngram_counter in ngram_counters for key in ngram_counter)
+                    pbar.update(1)
+            pbar.close()
 
-    return ngram_counter, ngram_files
+            print("Get the most common n-grams")
+            most_common_ngrams = [ngram_counter.most_common(top_k) for ngram_counter in ngram_counters]
+    if not most_common_ngrams:
+        most_common_ngrams = [[] for _ in orders]
+
+    # Resolve the n-gram keys of the results back to tokens, files stay ids into cache.files
+    tokens = cache.tokens
+    results = {}
+    for order, order_most_common in zip(orders, most_common_ngrams):
+        resolved_ngrams = []
+        resolved_files = {}
+        for key, count in order_most_common:
+            ngram = tuple(tokens[token_id] for token_id in ngram_ids(key))
+            resolved_ngrams.append((ngram, count))
+            resolved_files[ngram] = ngram_files.get(key)
+        results[order] = resolved_ngrams, resolved_files, cache.files
+    return results[n] if isinstance(n, int) else results
+
+
+def parse_ngram_sizes(value):
+    """Parse --n: a single size such as 5, a range such as 3-8, or a list such as 3,5,8."""
+    if '-' in value:
+        start, end = value.split('-', 1)
+        sizes = list(range(int(start), int(end) + 1))
+    elif ',' in value:
+        sizes = [int(size) for size in value.split(',')]
+    else:
+        return int(value)
+    if not sizes or min(sizes) < 1:
+        raise argparse.ArgumentTypeError(f"invalid n-gram sizes: {value}")
+    return sizes
 
 
 def find_ngrams(directory, prefix, excluded_files, n=5, top_k=1000, limit=500000, limit_ngrams=100000, num_threads=20,
                 exclude_words=None, required_words=None, tokens_to_ignore=1, exclude_words_insensitive=None,
-                required_words_insensitive=None):
+                required_words_insensitive=None, num_processes=0, num_shards=None, token_cache=None, tokenizer='fast',
+                heavy_hitters=False, sketch_width=1 << 20, sketch_depth=4, minhash=False, num_perm=128, bands=32,
+                minhash_threshold=0.5):
+    """
+    Find the top_k most common n-grams in the .txt files under directory and the files they occur in.
+    Returns the n-grams with their counts, the sorted file ids of every n-gram, and the file paths
+    those ids refer to.
+
+    The first pass tokenizes every file that passes the filters once, into a TokenCache of integer
+    token ids. The second pass, count_cached_ngrams, counts n-grams from those ids without reading
+    the files again. With token_cache, the cache is kept in that directory and reused by later runs
+    over the same files and filters, so changing n or tokens_to_ignore does not re-tokenize the corpus.
+    n can also be a list of sizes, counted in the same second pass, see count_cached_ngrams.
+    """
     if exclude_words is None:
         exclude_words = set()
     if required_words is None:
         required_words = set()
+    if exclude_words_insensitive is None:
+        exclude_words_insensitive = set()
+    if required_words_insensitive is None:
+        required_words_insensitive = set()
     for word in exclude_words:
         print(f"Excluding word: {word}")
     for word in required_words:
         print(f"Required word: {word}")
 
+    candidate_files = list_candidate_files(directory, prefix, excluded_files)
+    temporary_cache_dir = None
+    cache = None
+    if token_cache:
+        fingerprint = cache_fingerprint(candidate_files, limit=limit, exclude_words=exclude_words,
+                                        required_words=required_words,
+                                        exclude_words_insensitive=exclude_words_insensitive,
+                                        required_words_insensitive=required_words_insensitive, tokenizer=tokenizer)
+        cache = TokenCache.open(token_cache, fingerprint)
+        if cache is not None:
+            print(f"Reusing token cache in {token_cache} with {len(cache)} files")
+    else:
+        fingerprint = None
+        temporary_cache_dir = tempfile.mkdtemp(prefix='ngram-tokens-')
+
+    try:
+        if cache is None:
+            # First pass: Tokenize all files once and count all tokens
+            cache = TokenCache.create(token_cache or temporary_cache_dir)
+            word_filter = WordFilter(exclude_words, required_words, exclude_words_insensitive,
+                                     required_words_insensitive)
+            tokenize_files([file_path for file_path, _, _ in candidate_files], cache, limit, word_filter, tokenizer)
+            cache.close(fingerprint)
+        token_counter = cache.token_counter()
+        print(f"Total files seen: {len(cache)}")
+        return count_cached_ngrams(cache, range(len(cache)), token_counter, n=n, top_k=top_k,
+                                   limit_ngrams=limit_ngrams, num_threads=num_threads,
+                                   tokens_to_ignore=tokens_to_ignore, num_processes=num_processes,
+                                   num_shards=num_shards, heavy_hitters=heavy_hitters,
+                                   sketch_width=sketch_width, sketch_depth=sketch_depth, minhash=minhash,
+                                   num_perm=num_perm, bands=bands, minhash_threshold=minhash_threshold)
+    finally:
+        if cache is not None:
+            cache.release()
+        if temporary_cache_dir is not None:
+            shutil.rmtree(temporary_cache_dir, ignore_errors=True)
+
+
+def query_index(index_dir, prefix, excluded_files, n=5, top_k=1000, limit=500000, limit_ngrams=100000,
+                num_threads=20, exclude_words=None, required_words=None, tokens_to_ignore=1,
+                exclude_words_insensitive=None, required_words_insensitive=None, num_processes=0, num_shards=None,
+                heavy_hitters=False, sketch_width=1 << 20, sketch_depth=4, minhash=False, num_perm=128, bands=32,
+                minhash_threshold=0.5):
+    """Answer the same question as find_ngrams from an index written by build_index."""
+    for word in exclude_words or []:
+        print(f"Excluding word: {word}")
+    for word in required_words or []:
+        print(f"Required word: {word}")
 
-    ngram_counter = Counter()
-    ngram_files = {}
-    token_counter = Counter()
-    pbar = tqdm(total=0, desc="Total files processed")
-
-    # First pass: Count all tokens
-    files_to_include = []
-    for subdir, _, files in os.walk(directory):
-        for file in files:
-            filename_without_ext = os.path.splitext(file)[0]
-            if file.endswith('.txt') and (prefix is None or file.startswith(prefix)) and filename_without_ext not in excluded_files:
-                file_path = os.path.join(subdir, file)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                    text = clean_text(text)  # Clean the text
-                    stop_processing = False
-                    # Check for exclude words
-                    for exclude_word_insensitive in exclude_words_insensitive:
-                        if clean_text(exclude_word_insensitive).lower() in text.lower():
-                            stop_processing = True
-                            break
-                    # Check for required words insensitive
-                    for req_word_insensitive in required_words_insensitive:
-                        if clean_text(req_word_insensitive).lower() not in text.lower():
-                            stop_processing = True
-                            break
-                    for exclude_word in exclude_words:
-                        if clean_text(exclude_word) in text:
-                            stop_processing = True
-                            break  # Skip this file
-                    # Check for required words
-                    for req_word in required_words:
-                        if clean_text(req_word) not in text:
-                            stop_processing = True
-                            break  # Skip this file if required words are not present
-                    if stop_processing:
-                        continue
-
-                    text = text.replace('-', '').replace(',', '').replace('.', '')
-                    # Normalize all diacritics
-                    text = unidecode(text)
-                    tokens = word_tokenize(text)
-                    token_counter.update(tokens)
-                    files_to_include.append(file_path)
-                    pbar.update(1)
-                if pbar.n >= limit:
-                    pbar.close()
-                    break
-        if pbar.n >= limit:
-            pbar.close()
-            break
-    # Identify the top n most common tokens
-    tokens_to_ignore = {token for token, _ in token_counter.most_common(tokens_to_ignore)}
-    print(f"Top {len(tokens_to_ignore)} tokens to ignore: {', '.join(list(tokens_to_ignore)[:10])}...")
-    # Remove tokens that occur less than 10 times
-    print(f"Total tokens counted: {len(token_counter)}")
-    # tokens_to_ignore = {token for token, count in token_counter.items() if count <= 10 and token not in tokens_to_ignore}
-    tokens_to_ignore = {token for token, count in token_counter.items() if count <= 10 or token in tokens_to_ignore}
-    print(f"Tokens to ignore: {len(tokens_to_ignore)}")
+    index = NgramIndex(index_dir)
+    try:
+        file_ids = index.select_files(prefix, excluded_files, exclude_words or (), required_words or (),
+                                      exclude_words_insensitive or (), required_words_insensitive or (), limit)
+        print(f"Total files seen: {len(file_ids)}")
+        token_counter = index.cache.token_counter(file_ids)
+        return count_cached_ngrams(index.cache, file_ids, token_counter, n=n, top_k=top_k,
+                                   limit_ngrams=limit_ngrams, num_threads=num_threads,
+                                   tokens_to_ignore=tokens_to_ignore, num_processes=num_processes,
+                                   num_shards=num_shards, heavy_hitters=heavy_hitters,
+                                   sketch_width=sketch_width, sketch_depth=sketch_depth, minhash=minhash,
+                                   num_perm=num_perm, bands=bands, minhash_threshold=minhash_threshold)
+    finally:
+        index.release()
+
+
+def find_pagexml_ngrams(input_dir, prefix, excluded_files, n=5, top_k=1000, limit=500000, limit_ngrams=100000,
+                        num_threads=20, exclude_words=None, required_words=None, tokens_to_ignore=1,
+                        exclude_words_insensitive=None, required_words_insensitive=None, num_processes=0,
+                        num_shards=None, tokenizer='fast', heavy_hitters=False, sketch_width=1 << 20, sketch_depth=4,
+                        recursive=False, archives=False, merge_options=None, parser='stream', minhash=False,
+                        num_perm=128, bands=32, minhash_threshold=0.5):
+    """
+    Answer the same question as find_ngrams on the text files that pagexml-to-text.py would write
+    for input_dir, without writing or reading them. Pages go from the PageXML parser straight into
+    the token cache, see tokenize_pagexml, and the files of the n-grams are the PageXML files.
+    """
+    for word in exclude_words or []:
+        print(f"Excluding word: {word}")
+    for word in required_words or []:
+        print(f"Required word: {word}")
 
-    files_seen = 0
-    # Second pass: Generate n-grams excluding top 10 tokens
-    pbar = tqdm(total=0, desc="Processing files for n-grams")
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = []
-        for file in files_to_include:
-            filename_without_ext = os.path.splitext(file)[0]
-            # print(file, prefix, file.startswith(prefix), filename_without_ext not in excluded_files)
-            if file.endswith('.txt') and (prefix is None or file.split('/')[-1].startswith(prefix)) and filename_without_ext not in excluded_files:
-                # print(file)
-                files_seen += 1
-                file_path = os.path.join(subdir, file)
-                # with open(file_path, 'r', encoding='utf-8') as f:
-                #     text = f.read()
-                #     text = clean_text(text)  # Clean the text
-                # print(f"Processing file: {file_path}")
-                futures.append(executor.submit(process_file_for_ngrams, file_path, tokens_to_ignore, n))
-                pbar.update(1)
-            if pbar.n >= limit:
+    temporary_cache_dir = tempfile.mkdtemp(prefix='ngram-tokens-')
+    cache = None
+    try:
+        # First pass: Parse and tokenize all pages once and count all tokens
+        cache = TokenCache.create(temporary_cache_dir)
+        filter_words = (exclude_words or (), required_words or (), exclude_words_insensitive or (),
+                        required_words_insensitive or ())
+        pages = tokenize_pagexml(input_dir, filter_words, tokenizer, prefix, excluded_files, recursive=recursive,
+                                 archives=archives, merge_options=merge_options, parser=parser,
+                                 num_processes=num_processes)
+        for page_name, tokens in tqdm(run_metrics.iter_stage('parse', pages), desc="Total files processed"):
+            cache.add(page_name, tokens)
+            if len(cache) >= limit:
+                pages.close()
                 break
-        print(f"Total files seen: {files_seen}")
-
-        for future in as_completed(futures):
-            file_ngram_counter, file_ngram_files = future.result()
-            ngram_counter.update(file_ngram_counter)
-            for ngram, files in file_ngram_files.items():
-                if ngram not in ngram_files:
-                    ngram_files[ngram] = set()
-                ngram_files[ngram].update(files)
-
-            # Trim ngram_counter to top `limit_ngrams` n-grams
-            if len(ngram_counter) > limit_ngrams:
-                ngram_counter = Counter(dict(ngram_counter.most_common(limit_ngrams // 2)))
-
-    pbar.close()
-
-    print("Get the most common n-grams")
-    most_common_ngrams = ngram_counter.most_common(top_k)
-    return most_common_ngrams, ngram_files
-
-
-def load_predictions_map(predictions_dir):
-    predictions_map = {}
-    for json_file in glob.glob(os.path.expanduser(os.path.join(predictions_dir, "*.json"))):
-        try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                print(f"Loading predictions from {json_file}")
-                data = json.load(f)
-                for result in data.get("results", []):
-                    identifier = result.get("identifier").replace('thumbnails/data/','').replace('.jp2.thumbnail.jpg','.txt').replace('NL-HaNA_2.09.09','page/NL-HaNA_2.09.09')
-                    combined = result.get("predictions", {}).get("combined", {})
-                    if identifier and isinstance(combined, dict) and combined:
-                        top_prediction = max(combined.values())
-                        predictions_map[identifier] = top_prediction
-        except Exception as e:
-            print(f"Error loading {json_file}: {e}")
-    return predictions_map
-
-
-def save_ngrams_to_json(common_ngrams, output_dir="clusters", required_words=None, exclude_words=None, n=5, prefix_output=None, limit_output=None, predictions_dir=None, exclude_words_insensitive=None, required_words_insensitive=None):
-    predictions_map = None
-    if predictions_dir is not None:
+        cache.close()
+        token_counter = cache.token_counter()
+        print(f"Total files seen: {len(cache)}")
+        return count_cached_ngrams(cache, range(len(cache)), token_counter, n=n, top_k=top_k,
+                                   limit_ngrams=limit_ngrams, num_threads=num_threads,
+                                   tokens_to_ignore=tokens_to_ignore, num_processes=num_processes,
+                                   num_shards=num_shards, heavy_hitters=heavy_hitters,
+                                   sketch_width=sketch_width, sketch_depth=sketch_depth, minhash=minhash,
+                                   num_perm=num_perm, bands=bands, minhash_threshold=minhash_threshold)
+    finally:
+        if cache is not None:
+            cache.release()
+        shutil.rmtree(temporary_cache_dir, ignore_errors=True)
+
+
+def save_ngrams_to_json(common_ngrams, output_dir="clusters", required_words=None, exclude_words=None, n=5, prefix_output=None, limit_output=None, predictions_dir=None, exclude_words_insensitive=None, required_words_insensitive=None, file_paths=None, output_format='json', predictions_map=None):
+    """
+    Write the files of each n-gram to a JSON file. With file_paths, the files are ids into file_paths.
+
+    With output_format 'jsonl', all n-grams are written to a single JSONL file with an offset index
+    instead, see ClusterWriter, and its path is returned. predictions_map can be passed in when
+    it was already loaded from predictions_dir.
+    """
+    if predictions_map is None and predictions_dir is not None:
         predictions_map = load_predictions_map(predictions_dir)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for order, (ngram, adjusted_count, unique_files) in enumerate(common_ngrams, start=1):
-        ngram_str = '-'.join(ngram)
-        ngram_str = unidecode(ngram_str)
-        if exclude_words:
-            ngram_str = 'exclude-' + '-'.join(exclude_words) + '-' + ngram_str
-        if required_words:
-            ngram_str = 'required-'+ '-'.join(required_words) + '-' + ngram_str
-        if exclude_words_insensitive:
-            ngram_str = 'exclude-insensitive-' + '-'.join(exclude_words_insensitive) + '-' + ngram_str
-        if required_words_insensitive:
-            ngram_str = 'required-insensitive-' + '-'.join(required_words_insensitive) + '-' + ngram_str
-        if prefix_output:
-            output_path = os.path.join(output_dir, f"{prefix_output}-{str(order).zfill(3)}-{str(n).zfill(2)}-{ngram_str}.json")
-        else:
-            output_path = os.path.join(output_dir, f"{str(order).zfill(3)}-{str(n).zfill(2)}-{ngram_str}.json")
-
-        if predictions_map is not None:
-            print("Sorting files by prediction value")
-            # Sort unique_files by prediction value (ascending)
-            def get_prediction(file_path):
-                return predictions_map.get(file_path, float('inf'))
-            sorted_files = sorted(unique_files, key=get_prediction)
-        else:
-            sorted_files = unique_files
-        if limit_output:
-            sorted_files = sorted_files[:limit_output]
-        with open(output_path, 'w', encoding='utf-8') as json_file:
-            json.dump(sorted_files, json_file, ensure_ascii=False, indent=4)
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Find the most common n-grams in text files.')
-    parser.add_argument('--directory', type=str, required=True, help='Root directory to search for files')
+    # The filter words are part of every output filename
+    filters = ''
+    if required_words_insensitive:
+        filters += 'required-insensitive-' + '-'.join(required_words_insensitive) + '-'
+    if exclude_words_insensitive:
+        filters += 'exclude-insensitive-' + '-'.join(exclude_words_insensitive) + '-'
+    if required_words:
+        filters += 'required-' + '-'.join(required_words) + '-'
+    if exclude_words:
+        filters += 'exclude-' + '-'.join(exclude_words) + '-'
+    prefix = f"{prefix_output}-" if prefix_output else ''
+    if predictions_map is not None:
+        print("Sorting files by prediction value")
+
+        # Sort unique_files by prediction value (ascending)
+        def get_prediction(file_path):
+            return predictions_map.get(file_path, float('inf'))
+
+    cluster_writer = nullcontext()
+    if output_format == 'jsonl':
+        cluster_writer = ClusterWriter(os.path.join(output_dir, f"{prefix}{str(n).zfill(2)}-{filters}clusters.jsonl"))
+
+    with cluster_writer:
+        for order, (ngram, adjusted_count, unique_files) in enumerate(common_ngrams, start=1):
+            if file_paths is not None:
+                unique_files = [file_paths[file_id] for file_id in unique_files]
+            if predictions_map is not None:
+                sorted_files = sorted(unique_files, key=get_prediction)
+            else:
+                sorted_files = unique_files
+            if limit_output:
+                sorted_files = sorted_files[:limit_output]
+
+            if output_format == 'jsonl':
+                cluster_writer.write(n, ngram, adjusted_count, sorted_files)
+                continue
+            ngram_str = filters + unidecode('-'.join(ngram))
+            output_path = os.path.join(output_dir, f"{prefix}{str(order).zfill(3)}-{str(n).zfill(2)}-{ngram_str}.json")
+            with open(output_path, 'w', encoding='utf-8') as json_file:
+                json.dump(sorted_files, json_file, ensure_ascii=False, indent=4)
+    if output_format == 'jsonl':
+        return cluster_writer.path
+
+
+def add_ngram_arguments(parser):
+    """Options shared by a direct run and by the query subcommand."""
     parser.add_argument('--exclude', type=str, help='Path to the JSON file containing excluded filenames', default=None)
-    parser.add_argument('--n', type=int, default=5, help='Size of the n-grams (default: 5)')
+    parser.add_argument('--n', type=parse_ngram_sizes, default=5, help='Size of the n-grams, or a range such as 3-8 or a list such as 3,5,8 to find all of them in one pass (default: 5)')
     parser.add_argument('--top_k', type=int, default=1000, help='Number of top n-grams to return (default: 1000)')
     parser.add_argument('--limit', type=int, default=100000000, help='Limit the number of files to process (default: 100000000)')
     parser.add_argument('--limit_output', type=int, default=10000, help='Limit the number of files to include in the output (default: 10000)')
@@ -276,18 +455,59 @@ if __name__ == '__main__':
     parser.add_argument('--tokens_to_ignore', type=int, default=10, help='Number of top tokens to ignore (default: 10)')
     parser.add_argument('--prefix_output', type=str, default=None, help='Prefix the output files with this string')
     parser.add_argument('--predictions_dir', type=str, default=None, help='Directory containing predictions JSON files')
+    parser.add_argument('--predictions_cache', type=str, default=None, help='Directory to cache the merged predictions in, reused until the predictions files change (default: .predictions_cache in the predictions directory)')
+    parser.add_argument('--output_format', type=str, default='json', choices=('json', 'jsonl'), help='Write one JSON file per n-gram, or all n-grams of a size to one JSONL file with an offset index (default: json)')
     parser.add_argument('--input_file_prefix', type=str, default=None, help='Only process files starting with this prefix')
+    parser.add_argument('--processes', type=int, default=0, help='Count n-grams with this many processes instead of threads (default: 0, use threads)')
+    parser.add_argument('--heavy_hitters', action='store_true', help='Count n-grams in fixed memory with a Count-Min sketch, independent of file order, instead of trimming exact counts')
+    parser.add_argument('--sketch_width', type=int, default=1 << 20, help='Counters per row of the Count-Min sketch, the error bound is e / width times the number of n-grams (default: 1048576)')
+    parser.add_argument('--sketch_depth', type=int, default=4, help='Rows of the Count-Min sketch, the error bound holds with probability 1 - exp(-depth) (default: 4)')
+    parser.add_argument('--minhash', action='store_true', help='Cluster near duplicate files by MinHash signatures of their n-grams instead of counting n-grams, in memory linear in the number of files')
+    parser.add_argument('--num_perm', type=int, default=128, help='Number of hash functions of a MinHash signature (default: 128)')
+    parser.add_argument('--bands', type=int, default=32, help='Number of LSH bands a MinHash signature is cut into, more bands find less similar files (default: 32)')
+    parser.add_argument('--minhash_threshold', type=float, default=0.5, help='Estimated Jaccard similarity of their n-grams above which two files in an LSH bucket are clustered (default: 0.5)')
+    parser.add_argument('--shards', type=int, default=None, help='Number of n-gram shards to merge in parallel when using --processes (default: 4 per process)')
+    run_metrics.add_metrics_arguments(parser)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('index', 'query', 'pagexml'):
+        parser = argparse.ArgumentParser(description='Build a persistent n-gram index once, then query it many times, or find n-grams in PageXML directly.')
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        index_parser = subparsers.add_parser('index', help='Build or incrementally update the index of a directory')
+        index_parser.add_argument('--directory', type=str, required=True, help='Root directory to search for files')
+        index_parser.add_argument('--index_dir', type=str, required=True, help='Directory to write the index to')
+        index_parser.add_argument('--tokenizer', type=str, default='fast', choices=TOKENIZERS, help='Tokenizer to use, fast gives the same tokens as nltk on cleaned text (default: fast)')
+        query_parser = subparsers.add_parser('query', help='Find the most common n-grams using the index. The files are selected '
+                                                      'with the index and their n-grams are recounted from their cached token ids')
+        query_parser.add_argument('--index_dir', type=str, required=True, help='Directory containing the index')
+        add_ngram_arguments(query_parser)
+        pagexml_parser = subparsers.add_parser('pagexml', help='Find the most common n-grams in PageXML files, without converting them to text files first')
+        pagexml_parser.add_argument('--input_dir', type=str, required=True, help='Directory containing PageXML files, or a zip or tar archive of them')
+        add_ngram_arguments(pagexml_parser)
+        pagexml_parser.add_argument('--tokenizer', type=str, default='fast', choices=TOKENIZERS, help='Tokenizer to use, fast gives the same tokens as nltk on cleaned text (default: fast)')
+        load_converter().add_conversion_arguments(pagexml_parser)
+    else:
+        parser = argparse.ArgumentParser(description='Find the most common n-grams in text files. Use the index and query subcommands to build an index once and query it many times.')
+        parser.add_argument('--directory', type=str, required=True, help='Root directory to search for files')
+        add_ngram_arguments(parser)
+        parser.add_argument('--tokenizer', type=str, default='fast', choices=TOKENIZERS, help='Tokenizer to use, fast gives the same tokens as nltk on cleaned text (default: fast)')
+        parser.add_argument('--token_cache', type=str, default=None, help='Directory to keep the tokenized corpus in, reused by later runs on the same files and filters')
 
     args = parser.parse_args()
+    command = getattr(args, 'command', None)
+
+    if command == 'index':
+        build_index(args.directory, args.index_dir, tokenizer=args.tokenizer)
+        sys.exit(0)
+    if args.metrics:
+        run_metrics.start('find-ngrams', profile_stage=args.profile_stage)
 
     # Load excluded filenames from the JSON file
     excluded_files = load_excluded_files(args.exclude)
 
     # Find the most common n-grams
-    common_ngrams, ngram_files = find_ngrams(
-        args.directory,
-        args.input_file_prefix,
-        excluded_files,
+    ngram_options = dict(
         n=args.n,
         top_k=args.top_k * 100,
         limit=args.limit,
@@ -295,20 +515,58 @@ if __name__ == '__main__':
         required_words=args.required_words,
         tokens_to_ignore=args.tokens_to_ignore,
         exclude_words_insensitive=args.exclude_words_insensitive,
-        required_words_insensitive=args.required_words_insensitive
+        required_words_insensitive=args.required_words_insensitive,
+        num_processes=args.processes,
+        num_shards=args.shards,
+        heavy_hitters=args.heavy_hitters,
+        sketch_width=args.sketch_width,
+        sketch_depth=args.sketch_depth,
+        minhash=args.minhash,
+        num_perm=args.num_perm,
+        bands=args.bands,
+        minhash_threshold=args.minhash_threshold
     )
-    print(f"Found {len(common_ngrams)} common n-grams before processing.")
-    processed_ngrams = process_ngrams(common_ngrams, ngram_files, top_k=args.top_k)
-    print(f"Found {len(processed_ngrams)} n-grams after processing.")
-
-    print("Saving the results to JSON files")
-    save_ngrams_to_json(processed_ngrams, required_words=args.required_words, exclude_words=args.exclude_words,
-                        n=args.n, prefix_output=args.prefix_output, limit_output=args.limit_output,
-                        predictions_dir=args.predictions_dir, exclude_words_insensitive=args.exclude_words_insensitive,
-                        required_words_insensitive=args.required_words_insensitive)
-
-    # Print the results
-    for ngram, adjusted_count, unique_files in processed_ngrams:
-        files = ', '.join(ngram_files[ngram])
-        # print(f"{' '.join(ngram)}: {adjusted_count} (Files: {unique_files})")
-        print(f"{' '.join(ngram)}: {adjusted_count}")
+    if command == 'query':
+        results = query_index(args.index_dir, args.input_file_prefix, excluded_files, **ngram_options)
+    elif command == 'pagexml':
+        merge_options = dict(separate_single_words=args.separate_single_words, merge_dashes=args.merge_dashes,
+                             split_periods=args.split_periods, merge_quotes=args.merge_quotes,
+                             separate_colons=args.separate_colons)
+        results = find_pagexml_ngrams(args.input_dir, args.input_file_prefix, excluded_files, tokenizer=args.tokenizer,
+                                      recursive=args.recursive, archives=args.archives, merge_options=merge_options,
+                                      parser=args.parser, **ngram_options)
+    else:
+        results = find_ngrams(args.directory, args.input_file_prefix, excluded_files,
+                              token_cache=args.token_cache, tokenizer=args.tokenizer, **ngram_options)
+    if isinstance(args.n, int):
+        results = {args.n: results}
+
+    predictions_map = None
+    if args.predictions_dir is not None:
+        with run_metrics.stage('predictions', workers=args.processes or None):
+            predictions_map = load_predictions_map(args.predictions_dir, cache_dir=args.predictions_cache,
+                                                   num_processes=args.processes or None)
+
+    for n, (common_ngrams, ngram_files, file_paths) in results.items():
+        print(f"Found {len(common_ngrams)} common {n}-grams before processing.")
+        with run_metrics.stage('process') as stage:
+            processed_ngrams = process_ngrams(common_ngrams, ngram_files, top_k=args.top_k, num_files=len(file_paths))
+            stage.add(len(common_ngrams))
+        print(f"Found {len(processed_ngrams)} {n}-grams after processing.")
+
+        print("Saving the results to JSON files")
+        with run_metrics.stage('write') as stage:
+            save_ngrams_to_json(processed_ngrams, required_words=args.required_words, exclude_words=args.exclude_words,
+                                n=n, prefix_output=args.prefix_output, limit_output=args.limit_output,
+                                predictions_dir=args.predictions_dir, exclude_words_insensitive=args.exclude_words_insensitive,
+                                required_words_insensitive=args.required_words_insensitive, file_paths=file_paths,
+                                output_format=args.output_format, predictions_map=predictions_map)
+            stage.add(len(processed_ngrams))
+
+        # Print the results
+        for ngram, adjusted_count, unique_files in processed_ngrams:
+            # print(f"{' '.join(ngram)}: {adjusted_count} (Files: {unique_files})")
+            print(f"{' '.join(ngram)}: {adjusted_count}")
+
+    if args.metrics:
+        run_metrics.current().write(args.metrics)
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import mmap
+import os
+from array import array
+from collections import Counter
+
+# Token ids are stored as unsigned 32 bit integers, offsets and counts as unsigned 64 bit integers
+TOKEN_ID_TYPE = 'I'
+OFFSET_TYPE = 'Q'
+CACHE_VERSION = 1
+
+
+def cache_fingerprint(candidate_files, **params):
+    """
+    Fingerprint the inputs of a first pass: the candidate files with their size and mtime, plus
+    every option that decides which files end up in the cache (filters, limit, tokenizer). The
+    candidate files are paths, or (path, size, mtime_ns) from a scan, which are not stat'ed again.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps({'version': CACHE_VERSION, **params}, sort_keys=True, default=sorted).encode('utf-8'))
+    for candidate in candidate_files:
+        if isinstance(candidate, tuple):
+            file_path, size, mtime_ns = candidate
+        else:
+            file_path = candidate
+            stat = os.stat(file_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        digest.update(f"{file_path}\0{size}\0{mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_array(path, typecode):
+    values = array(typecode)
+    with open(path, 'rb') as f:
+        values.frombytes(f.read())
+    return values
+
+
+class TokenCache:
+    """
+    Tokenized form of a corpus: one flat array of integer token ids for all files, with an
+    offset per file, and a vocabulary with the total count of every token.
+
+    While writing, ids are buffered in memory and spilled to tokens.bin once the buffer holds
+    spill_tokens ids. Once closed, tokens.bin is memory-mapped so reading a file's ids does not
+    copy anything. A cache_dir that was closed with a fingerprint can be reopened by later runs.
+    """
+
+    def __init__(self, cache_dir, spill_tokens=1 << 22):
+        self.cache_dir = cache_dir
+        self.spill_tokens = spill_tokens
+        self.vocab = {}
+        self.tokens = []
+        self.counts = array(OFFSET_TYPE)
+        self.files = []
+        self.offsets = array(OFFSET_TYPE, [0])
+        self._buffer = array(TOKEN_ID_TYPE)
+        self._out = None
+        self._mmap = None
+        self._ids = None
+
+    @classmethod
+    def create(cls, cache_dir, spill_tokens=1 << 22, tokens=None):
+        """
+        Start writing a cache in cache_dir. With tokens, the vocabulary starts out as that list, so
+        ids copied from another cache with add_ids keep their meaning.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        # Invalidate whatever was cached here before, the metadata is only written on close
+        if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            os.remove(os.path.join(cache_dir, 'meta.json'))
+        cache = cls(cache_dir, spill_tokens)
+        if tokens:
+            cache.tokens = list(tokens)
+            cache.vocab = {token: token_id for token_id, token in enumerate(cache.tokens)}
+            cache.counts = array(OFFSET_TYPE, bytes(cache.counts.itemsize * len(cache.tokens)))
+        cache._out = open(os.path.join(cache_dir, 'tokens.bin'), 'wb')
+        return cache
+
+    @classmethod
+    def open(cls, cache_dir, fingerprint=None, ids_only=False):
+        """
+        Open a closed cache, or return None if there is none or it was built from other inputs.
+        With ids_only, the vocabulary and file list are not loaded, which is all workers need.
+        """
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION or (fingerprint is not None and meta.get('fingerprint') != fingerprint):
+            return None
+
+        cache = cls(cache_dir)
+        if not ids_only:
+            with open(os.path.join(cache_dir, 'vocab.json'), 'r', encoding='utf-8') as f:
+                cache.tokens = json.load(f)
+            cache.vocab = {token: token_id for token_id, token in enumerate(cache.tokens)}
+            with open(os.path.join(cache_dir, 'files.json'), 'r', encoding='utf-8') as f:
+                cache.files = json.load(f)
+            cache.counts = read_array(os.path.join(cache_dir, 'counts.bin'), OFFSET_TYPE)
+        cache.offsets = read_array(os.path.join(cache_dir, 'offsets.bin'), OFFSET_TYPE)
+        cache._map()
+        return cache
+
+    def add(self, file_path, tokens):
+        """Append the tokens of one file."""
+        vocab = self.vocab
+        counts = self.counts
+        buffer = self._buffer
+        for token in tokens:
+            token_id = vocab.get(token)
+            if token_id is None:
+                token_id = vocab[token] = len(self.tokens)
+                self.tokens.append(token)
+                counts.append(0)
+            counts[token_id] += 1
+            buffer.append(token_id)
+        self.files.append(file_path)
+        self.offsets.append(self.offsets[-1] + len(tokens))
+        if len(buffer) >= self.spill_tokens:
+            self._spill()
+
+    def add_ids(self, file_path, ids):
+        """Append the token ids of one file, e.g. copied from a cache sharing this vocabulary."""
+        counts = self.counts
+        for token_id, count in Counter(ids).items():
+            counts[token_id] += count
+        self._buffer.extend(ids)
+        self.files.append(file_path)
+        self.offsets.append(self.offsets[-1] + len(ids))
+        if len(self._buffer) >= self.spill_tokens:
+            self._spill()
+
+    def _spill(self):
+        self._buffer.tofile(self._out)
+        self._buffer = array(TOKEN_ID_TYPE)
+
+    def close(self, fingerprint=None):
+        """Flush the ids to disk, write the metadata and memory-map the ids for reading."""
+        self._spill()
+        self._out.close()
+        self._out = None
+        with open(os.path.join(self.cache_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.tokens, f, ensure_ascii=False)
+        with open(os.path.join(self.cache_dir, 'files.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, ensure_ascii=False)
+        with open(os.path.join(self.cache_dir, 'counts.bin'), 'wb') as f:
+            self.counts.tofile(f)
+        with open(os.path.join(self.cache_dir, 'offsets.bin'), 'wb') as f:
+            self.offsets.tofile(f)
+        # meta.json is written last, so a cache that was interrupted halfway is never reopened
+        with open(os.path.join(self.cache_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'fingerprint': fingerprint}, f)
+        self._map()
+
+    def _map(self):
+        tokens_path = os.path.join(self.cache_dir, 'tokens.bin')
+        if os.path.getsize(tokens_path) == 0:
+            self._ids = memoryview(array(TOKEN_ID_TYPE))
+            return
+        with open(tokens_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._ids = memoryview(self._mmap).cast(TOKEN_ID_TYPE)
+
+    def release(self):
+        if self._ids is not None:
+            self._ids.release()
+            self._ids = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def ids(self, index):
+        """Token ids of the file at index, as a read-only view on the memory-mapped cache."""
+        return self._ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def token_counter(self, file_ids=None):
+        """Count every token, over all files or only over the files with the given ids."""
+        if file_ids is None:
+            return Counter({token: count for token, count in zip(self.tokens, self.counts) if count})
+        id_counter = Counter()
+        for file_id in file_ids:
+            id_counter.update(self.ids(file_id))
+        tokens = self.tokens
+        return Counter({tokens[token_id]: count for token_id, count in id_counter.items()})
+
+    def token_ids(self, tokens):
+        return frozenset(self.vocab[token] for token in tokens if token in self.vocab)
+
+
+def ngram_ids(key):
+    """The token ids of an n-gram key, see CachedNgramCounter."""
+    ids = array(TOKEN_ID_TYPE)
+    ids.frombytes(key)
+    return tuple(ids)
+
+
+class CachedNgramCounter:
+    """
+    Count the n-grams of one cached file, by file index, for every n in orders. Returns one Counter
+    per order, all made from the same filtered token sequence.
+
+    N-grams are counted by compact keys: the bytes of their token ids, 4 bytes per token, which take
+    far less memory than tuples of token strings or of int objects and are cheap to hash. As the
+    length of a key gives its order, keys of all orders can share one NgramPostings. Use ngram_ids
+    and TokenCache.tokens to resolve a key to its tokens, and TokenCache.files to resolve a file
+    index to its path.
+
+    Instances are picklable without the memory map, so each worker process maps the cache itself.
+    """
+
+    def __init__(self, cache, ignore_ids, orders):
+        self.cache_dir = cache.cache_dir
+        self.ignore_ids = ignore_ids
+        self.orders = tuple(orders)
+        self._cache = cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def __call__(self, index):
+        if self._cache is None:
+            self._cache = TokenCache.open(self.cache_dir, ids_only=True)
+        ignore_ids = self.ignore_ids
+        ids = array(TOKEN_ID_TYPE, [token_id for token_id in self._cache.ids(index) if token_id not in ignore_ids])
+        data = ids.tobytes()
+        itemsize = ids.itemsize
+        counters = []
+        for n in self.orders:
+            width = itemsize * n
+            counters.append(Counter([data[i:i + width] for i in range(0, len(data) - width + 1, itemsize)]))
+        return counters
@@ -0,0 +1,89 @@
+import json
+import os
+from array import array
+
+from ngram_cache import OFFSET_TYPE, read_array
+
+INDEX_SUFFIX = '.idx'
+
+
+class ClusterWriter:
+    """
+    Write the n-gram clusters of a run to one JSONL file, one cluster per line, as they come.
+
+    Every line is a JSON object with rank (starting at 1), n, ngram, adjusted_count and files. The
+    byte offset of every line is kept, and written to path + '.idx' on close as unsigned 64 bit
+    integers, one more than the number of clusters, so ClusterReader can seek to any cluster. The
+    index is written last, so a file without one was not completely written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array(OFFSET_TYPE, [0])
+        # An index left by an earlier run would not match the new file until it is complete
+        if os.path.exists(path + INDEX_SUFFIX):
+            os.remove(path + INDEX_SUFFIX)
+        self._file = open(path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def write(self, n, ngram, adjusted_count, files):
+        record = {'rank': len(self.offsets), 'n': n, 'ngram': list(ngram), 'adjusted_count': adjusted_count,
+                  'files': list(files)}
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        self._file.write(line)
+        self.offsets.append(self.offsets[-1] + len(line))
+
+    def close(self, complete=True):
+        """Close the file, and write the index unless complete is False."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if not complete:
+            return
+        with open(self.path + INDEX_SUFFIX, 'wb') as f:
+            self.offsets.tofile(f)
+
+
+class ClusterReader:
+    """Read single clusters from a file written by ClusterWriter, without loading the whole file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = read_array(path + INDEX_SUFFIX, OFFSET_TYPE)
+        self._file = open(path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for rank in range(1, len(self) + 1):
+            yield self.cluster(rank)
+
+    def cluster(self, rank):
+        """The cluster with the given rank, starting at 1, as a dict."""
+        if not 1 <= rank <= len(self):
+            raise IndexError(f"no cluster with rank {rank} in {self.path}")
+        start = self.offsets[rank - 1]
+        self._file.seek(start)
+        return json.loads(self._file.read(self.offsets[rank] - start))
+
+
+def read_cluster(path, rank):
+    """Read the cluster with the given rank from a file written by ClusterWriter."""
+    with ClusterReader(path) as reader:
+        return reader.cluster(rank)
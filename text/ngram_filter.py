@@ -0,0 +1,90 @@
+from ngram_text import normalize_text
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, without it every term is searched for separately
+    ahocorasick = None
+
+
+def _build_automaton(terms):
+    automaton = ahocorasick.Automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+    return automaton
+
+
+class WordFilter:
+    """
+    The exclude and required word rules of find_ngrams, compiled once for all documents.
+
+    Filter words are normalized like the documents once, here, instead of once per document.
+    When pyahocorasick is installed, the case sensitive terms and the lowercased case insensitive
+    terms each go into one Aho-Corasick automaton, so a document is scanned once (and lowercased
+    once) to answer every rule at the same time. A document is accepted when it contains none of
+    the exclude words and all of the required words.
+    """
+
+    def __init__(self, exclude_words=(), required_words=(), exclude_words_insensitive=(),
+                 required_words_insensitive=(), use_automaton=None):
+        if use_automaton is None:
+            use_automaton = ahocorasick is not None
+        self.exclude = frozenset(normalize_text(word) for word in exclude_words)
+        self.required = frozenset(normalize_text(word) for word in required_words)
+        self.exclude_insensitive = frozenset(normalize_text(word).lower() for word in exclude_words_insensitive)
+        self.required_insensitive = frozenset(normalize_text(word).lower() for word in required_words_insensitive)
+
+        # An empty word is a substring of every document
+        self.reject_all = '' in self.exclude or '' in self.exclude_insensitive
+        self.required = self.required - {''}
+        self.required_insensitive = self.required_insensitive - {''}
+
+        self.automaton = None
+        self.automaton_insensitive = None
+        if use_automaton:
+            terms = (self.exclude | self.required) - {''}
+            if terms:
+                self.automaton = _build_automaton(terms)
+            terms = (self.exclude_insensitive | self.required_insensitive) - {''}
+            if terms:
+                self.automaton_insensitive = _build_automaton(terms)
+
+    def __bool__(self):
+        return bool(self.exclude or self.required or self.exclude_insensitive or self.required_insensitive)
+
+    @staticmethod
+    def _scan(automaton, text, exclude, required):
+        """Return whether text contains no exclude term and every required term, in one pass."""
+        found = set()
+        for _, term in automaton.iter(text):
+            if term in exclude:
+                return False
+            if term in required:
+                found.add(term)
+                if not exclude and len(found) == len(required):
+                    return True
+        return len(found) == len(required)
+
+    @staticmethod
+    def _search(text, exclude, required):
+        return not any(term in text for term in exclude) and all(term in text for term in required)
+
+    def accepts(self, text):
+        """Whether a normalized document passes all exclude and required word rules."""
+        if self.reject_all:
+            return False
+        if self.exclude or self.required:
+            if self.automaton is not None:
+                if not self._scan(self.automaton, text, self.exclude, self.required):
+                    return False
+            elif not self._search(text, self.exclude, self.required):
+                return False
+        if self.exclude_insensitive or self.required_insensitive:
+            text = text.lower()
+            if self.automaton_insensitive is not None:
+                if not self._scan(self.automaton_insensitive, text, self.exclude_insensitive,
+                                  self.required_insensitive):
+                    return False
+            elif not self._search(text, self.exclude_insensitive, self.required_insensitive):
+                return False
+        return True
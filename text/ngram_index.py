@@ -0,0 +1,287 @@
+import json
+import os
+import shutil
+import sys
+from array import array
+
+from tqdm import tqdm
+
+from ngram_cache import OFFSET_TYPE, TokenCache, read_array
+from ngram_postings import FILE_ID_TYPE
+from ngram_text import get_tokenizer, normalize_text, token_text
+
+# The directory scanner shared by all tools
+SCAN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scan')
+if SCAN_DIR not in sys.path:
+    sys.path.append(SCAN_DIR)
+from file_manifest import scan_files  # noqa: E402
+
+INDEX_VERSION = 1
+
+
+def list_text_files(directory):
+    """Every .txt file under directory with its size and mtime, in os.walk order with sorted directories, see scan_files."""
+    return scan_files(directory, '.txt')
+
+
+class NgramIndex:
+    """
+    Persistent index of the .txt files under a directory, built once and queried many times by
+    find-ngrams.py query.
+
+    index_dir holds:
+    - files.json: path, size and mtime of every indexed file, by file id
+    - tokens/: a TokenCache with the token dictionary and the token ids (and so the token counts)
+      of every file, from which the n-grams of any selection of files are counted
+    - words.json, word_offsets.bin, word_postings.bin: an inverted index from every distinct
+      whitespace separated word of the cleaned text to the sorted ids of the files it occurs in
+
+    Filter words are matched as substrings of the cleaned text, like in find_ngrams. A filter word
+    without whitespace occurs in a file exactly when it is a substring of one of the file's words,
+    so those are answered from the inverted index alone. Filter words with whitespace are narrowed
+    down with the index and then matched as a run of consecutive tokens in the cached token ids of
+    the remaining files: the first word as the end of a token, the last as the start of one and
+    those in between as whole tokens. The source files are never read again, so a query answers
+    for the files as they were indexed. Unlike a substring, such a run does not depend on how
+    many spaces or newlines separate the words.
+
+    The index holds no n-gram counts or postings: a query counts the n-grams of the files it selects
+    from their cached token ids, which is what lets every query use other filters.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, 'files.json'), 'r', encoding='utf-8') as f:
+            self.files = json.load(f)
+        with open(os.path.join(index_dir, 'words.json'), 'r', encoding='utf-8') as f:
+            self.words = json.load(f)
+        self.word_offsets = read_array(os.path.join(index_dir, 'word_offsets.bin'), OFFSET_TYPE)
+        self.word_postings = read_array(os.path.join(index_dir, 'word_postings.bin'), FILE_ID_TYPE)
+        self.cache = TokenCache.open(os.path.join(index_dir, 'tokens'))
+        self._words_lower = None
+        self._tokens_lower = None
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, 'meta.json'))
+
+    def release(self):
+        self.cache.release()
+
+    def __len__(self):
+        return len(self.files)
+
+    def _files_with_words(self, terms, insensitive):
+        """Ids of the files with a word containing term, for every term in terms, in one pass over the vocabulary."""
+        words = self.words
+        if insensitive:
+            if self._words_lower is None:
+                self._words_lower = [word.lower() for word in words]
+            words = self._words_lower
+        word_files = {term: set() for term in terms}
+        if not word_files:
+            return word_files
+        offsets = self.word_offsets
+        postings = self.word_postings
+        for word_id, word in enumerate(words):
+            matches = [term for term in word_files if term in word]
+            if matches:
+                file_ids = postings[offsets[word_id]:offsets[word_id + 1]]
+                for term in matches:
+                    word_files[term].update(file_ids)
+        return word_files
+
+    def files_containing(self, term, insensitive=False, word_files=None):
+        """
+        Ids of the files whose cleaned text contains term, or None for all files. term must be
+        normalized with normalize_text already, and lowercased if insensitive. word_files are the
+        results of _files_with_words for the words of term, looked up when not given.
+        """
+        parts = term.split()
+        if not parts:
+            return None
+        if word_files is None:
+            word_files = self._files_with_words(parts, insensitive)
+        file_ids = set(word_files[parts[0]])
+        for part in parts[1:]:
+            file_ids &= word_files[part]
+        if len(parts) == 1:
+            return file_ids
+
+        run = self._token_run(parts, insensitive)
+        return {file_id for file_id in file_ids if _contains_run(self.cache.ids(file_id), run)}
+
+    def _token_run(self, parts, insensitive):
+        """
+        For the words of a filter term, the sets of token ids that can stand for them in a run of
+        consecutive tokens: tokens ending with the first word, equal to the words in between, and
+        starting with the last.
+        """
+        tokens = self.cache.tokens
+        if insensitive:
+            if self._tokens_lower is None:
+                self._tokens_lower = [token.lower() for token in tokens]
+            tokens = self._tokens_lower
+        run = [set() for _ in parts]
+        first, middle, last = parts[0], parts[1:-1], parts[-1]
+        for token_id, token in enumerate(tokens):
+            if token.endswith(first):
+                run[0].add(token_id)
+            if token.startswith(last):
+                run[-1].add(token_id)
+            if token in middle:
+                for position, part in enumerate(middle, start=1):
+                    if token == part:
+                        run[position].add(token_id)
+        return run
+
+    def select_files(self, prefix=None, excluded_files=(), exclude_words=(), required_words=(),
+                     exclude_words_insensitive=(), required_words_insensitive=(), limit=None):
+        """
+        The sorted ids of the files that pass the same filters as in find_ngrams. With limit, those
+        are the first limit of them, as file ids follow the order in which find_ngrams reads files.
+        """
+        selected = set()
+        for file_id, (file_path, _, _) in enumerate(self.files):
+            file = os.path.basename(file_path)
+            if (prefix is None or file.startswith(prefix)) and os.path.splitext(file)[0] not in excluded_files:
+                selected.add(file_id)
+
+        rules = [(word, False, True) for word in required_words]
+        rules += [(word, True, True) for word in required_words_insensitive]
+        rules += [(word, False, False) for word in exclude_words]
+        rules += [(word, True, False) for word in exclude_words_insensitive]
+        terms = []
+        for word, insensitive, required in rules:
+            term = normalize_text(word)
+            terms.append((term.lower() if insensitive else term, insensitive, required))
+        # The files of every word of every term, looked up in one pass over the vocabulary per case
+        word_files = {insensitive: self._files_with_words({part for term, term_insensitive, _ in terms
+                                                          if term_insensitive == insensitive for part in term.split()},
+                                                         insensitive)
+                      for insensitive in (False, True)}
+        for term, insensitive, required in terms:
+            file_ids = self.files_containing(term, insensitive, word_files[insensitive])
+            if required:
+                if file_ids is not None:
+                    selected &= file_ids
+            elif file_ids is None:
+                selected = set()
+            else:
+                selected -= file_ids
+
+        selected = sorted(selected)
+        if limit is not None:
+            selected = selected[:limit]
+        return selected
+
+
+def _contains_run(ids, run):
+    """Whether a sequence of token ids has a run of consecutive ids in the sets of run, see NgramIndex._token_run."""
+    first, rest = run[0], run[1:]
+    for start in range(len(ids) - len(run) + 1):
+        if ids[start] in first and all(ids[start + offset] in ids_of for offset, ids_of in enumerate(rest, start=1)):
+            return True
+    return False
+
+
+def _write_index(index_dir, meta, files, words, word_postings):
+    word_offsets = array(OFFSET_TYPE, [0])
+    flat_postings = array(FILE_ID_TYPE)
+    kept_words = []
+    for word, posting in zip(words, word_postings):
+        if posting:
+            kept_words.append(word)
+            flat_postings.extend(posting)
+            word_offsets.append(len(flat_postings))
+    with open(os.path.join(index_dir, 'files.json'), 'w', encoding='utf-8') as f:
+        json.dump(files, f, ensure_ascii=False)
+    with open(os.path.join(index_dir, 'words.json'), 'w', encoding='utf-8') as f:
+        json.dump(kept_words, f, ensure_ascii=False)
+    with open(os.path.join(index_dir, 'word_offsets.bin'), 'wb') as f:
+        word_offsets.tofile(f)
+    with open(os.path.join(index_dir, 'word_postings.bin'), 'wb') as f:
+        flat_postings.tofile(f)
+    # meta.json is written last, so an index that was interrupted halfway is never opened
+    with open(os.path.join(index_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def build_index(directory, index_dir, tokenizer='fast'):
+    """
+    Build or update the index of the .txt files under directory in index_dir.
+
+    An existing index built with the same tokenizer is updated incrementally: files whose size and
+    mtime did not change are copied over from it without being read, files that were added or
+    changed are tokenized, and files that were removed are dropped. The new index is written next
+    to the old one and only replaces it once complete.
+    """
+    old_index = None
+    if NgramIndex.exists(index_dir):
+        old_index = NgramIndex(index_dir)
+        if old_index.meta.get('version') != INDEX_VERSION or old_index.meta.get('tokenizer') != tokenizer:
+            print(f"Index in {index_dir} was built with other settings, rebuilding it")
+            old_index.release()
+            old_index = None
+
+    text_files = list_text_files(directory)
+    old_files = {}
+    if old_index is not None:
+        old_files = {file_path: (file_id, size, mtime) for file_id, (file_path, size, mtime) in enumerate(old_index.files)}
+    kept = {file_path: old_files[file_path][0] for file_path, size, mtime in text_files
+            if old_files.get(file_path, (None, None, None))[1:] == (size, mtime)}
+    print(f"Indexing {len(text_files)} files: {len(kept)} unchanged, {len(text_files) - len(kept)} new or changed, "
+          f"{len(old_files) - len(kept)} changed or removed since the last build")
+
+    build_dir = index_dir.rstrip(os.sep) + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    cache = TokenCache.create(os.path.join(build_dir, 'tokens'), tokens=old_index.cache.tokens if old_index else None)
+    files = []
+    words = list(old_index.words) if old_index is not None else []
+    word_ids = {word: word_id for word_id, word in enumerate(words)}
+    word_postings = [array(FILE_ID_TYPE) for _ in words]
+    old_to_new = {}
+
+    # File ids follow the order of list_text_files, also after an update, so the first ids are the
+    # files find_ngrams reads first
+    tokenize = get_tokenizer(tokenizer)
+    for file_path, size, mtime in tqdm(text_files, desc="Indexing files"):
+        file_id = len(files)
+        files.append([file_path, size, mtime])
+        old_file_id = kept.get(file_path)
+        if old_file_id is not None:
+            old_to_new[old_file_id] = file_id
+            cache.add_ids(file_path, old_index.cache.ids(old_file_id))
+            continue
+        with open(file_path, 'r', encoding='utf-8') as f:
+            raw_text = f.read()
+        text = normalize_text(raw_text)
+        cache.add(file_path, tokenize(token_text(raw_text, text)))
+        for word in set(text.split()):
+            word_id = word_ids.get(word)
+            if word_id is None:
+                word_id = word_ids[word] = len(words)
+                words.append(word)
+                word_postings.append(array(FILE_ID_TYPE))
+            word_postings[word_id].append(file_id)
+
+    if old_index is not None:
+        # The unchanged files of every word of the old index, under their new ids
+        offsets = old_index.word_offsets
+        postings = old_index.word_postings
+        for word_id in range(len(old_index.words)):
+            kept_ids = [old_to_new[file_id] for file_id in postings[offsets[word_id]:offsets[word_id + 1]] if file_id in old_to_new]
+            if kept_ids:
+                word_postings[word_id] = array(FILE_ID_TYPE, sorted(kept_ids + word_postings[word_id].tolist()))
+        old_index.release()
+    cache.close()
+    cache.release()
+
+    meta = {'version': INDEX_VERSION, 'directory': os.path.abspath(directory), 'tokenizer': tokenizer}
+    _write_index(build_dir, meta, files, words, word_postings)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.rename(build_dir, index_dir)
+    print(f"Index with {len(files)} files written to {index_dir}")
@@ -0,0 +1,162 @@
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import zlib
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from tqdm import tqdm
+
+from ngram_postings import NgramPostings
+
+# Worker side state, set once per process by _init_worker so that large arguments such as
+# tokens_to_ignore are only pickled once per worker instead of once per batch.
+_count_file = None
+_num_shards = 1
+_spill_dir = None
+
+
+def shard_of(key, num_shards):
+    """Return a stable shard number for an n-gram key.
+
+    Python's builtin hash() of bytes is salted per process, so it cannot be used to agree on a
+    shard between worker processes. crc32 is stable and cheap enough for the hot path.
+    """
+    return zlib.crc32(key) % num_shards
+
+
+def _init_worker(count_file, num_shards, spill_dir):
+    global _count_file, _num_shards, _spill_dir
+    _count_file = count_file
+    _num_shards = num_shards
+    _spill_dir = spill_dir
+
+
+def _map_batch(batch_id, file_ids):
+    """Count n-grams for a batch of files and spill the partial counts to one file per shard."""
+    shard_counters = None
+    shard_postings = [NgramPostings() for _ in range(_num_shards)]
+    for file_id in file_ids:
+        file_ngram_counters = _count_file(file_id)
+        if shard_counters is None:
+            shard_counters = [[Counter() for _ in file_ngram_counters] for _ in range(_num_shards)]
+        shard_keys = [[] for _ in range(_num_shards)]
+        for order, file_ngram_counter in enumerate(file_ngram_counters):
+            for key, count in file_ngram_counter.items():
+                shard = shard_of(key, _num_shards)
+                shard_counters[shard][order][key] += count
+                shard_keys[shard].append(key)
+        for shard, keys in enumerate(shard_keys):
+            shard_postings[shard].add_file(keys, file_id)
+
+    spill_paths = []
+    for shard in range(_num_shards):
+        if shard_counters is None or not any(shard_counters[shard]):
+            spill_paths.append(None)
+            continue
+        spill_path = os.path.join(_spill_dir, f"shard-{shard:04d}-batch-{batch_id:06d}.pkl")
+        with open(spill_path, 'wb') as f:
+            pickle.dump((shard_counters[shard], shard_postings[shard]), f, protocol=pickle.HIGHEST_PROTOCOL)
+        spill_paths.append(spill_path)
+    return batch_id, spill_paths, len(file_ids)
+
+
+def _top_k(ngram_counts, top_k):
+    """
+    The top_k of (key, count) pairs by descending count, with ties broken by key, so the n-grams
+    kept at the cutoff do not depend on the order in which batches and shards finished.
+    """
+    return heapq.nsmallest(top_k, ngram_counts, key=lambda x: (-x[1], x[0]))
+
+
+def _reduce_shard(spill_paths, top_k):
+    """Merge all partial counts of one shard and return its top_k n-grams per order with their postings."""
+    ngram_counters = None
+    ngram_postings = NgramPostings()
+    for spill_path in spill_paths:
+        with open(spill_path, 'rb') as f:
+            partial_counters, partial_postings = pickle.load(f)
+        os.remove(spill_path)
+        if ngram_counters is None:
+            ngram_counters = [Counter() for _ in partial_counters]
+        for ngram_counter, partial_counter in zip(ngram_counters, partial_counters):
+            ngram_counter.update(partial_counter)
+        ngram_postings.update(partial_postings)
+
+    most_common = [_top_k(ngram_counter.items(), top_k) for ngram_counter in ngram_counters]
+    return most_common, ngram_postings.subset(key for order in most_common for key, _ in order)
+
+
+def _completed(executor, fn, tasks, max_in_flight):
+    """
+    Submit fn(*task) for every task to executor and yield the results as they complete, with at
+    most max_in_flight tasks submitted at a time, so finished results do not pile up in memory.
+    """
+    in_flight = set()
+    for task in tasks:
+        in_flight.add(executor.submit(fn, *task))
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in wait(in_flight).done:
+        yield future.result()
+
+
+def count_ngrams_sharded(file_ids, count_file, top_k, num_processes, num_shards=None, batch_size=256,
+                         spill_dir=None, max_in_flight=None):
+    """
+    Count n-grams over files with a process pool, map-reduce style.
+
+    Map tasks take batches of file ids, count them with count_file (a picklable callable with an
+    orders attribute, returning one Counter of n-gram keys per order for a file id, like
+    CachedNgramCounter) and partition the partial counts and postings by a stable hash of the
+    key, which they spill to disk. Reduce tasks each own one shard of the key space and merge its
+    partials in parallel. As shards are disjoint, the global top_k is the top_k of the union of
+    every shard's top_k, so only those are sent back to the parent. N-grams with equal counts are
+    ordered by key, so the result does not depend on the number of processes or shards.
+
+    Counting is exact: no intermediate trimming is applied, so a reduce task holds the full counts
+    and postings of its shard, about 1 / num_shards of all distinct n-grams. Raise num_shards to
+    lower the memory of a worker. At most max_in_flight tasks (by default two per process) are
+    submitted at a time. Returns the top_k n-grams as (key, count) for each order, and one
+    NgramPostings for all of them.
+    """
+    if num_shards is None:
+        num_shards = num_processes * 4
+    if max_in_flight is None:
+        max_in_flight = 2 * num_processes
+    batches = ((batch_id, file_ids[i:i + batch_size]) for batch_id, i in enumerate(range(0, len(file_ids), batch_size)))
+
+    spill_dir = tempfile.mkdtemp(prefix='ngram-shards-', dir=spill_dir)
+    try:
+        shard_spills = [[] for _ in range(num_shards)]
+        with ProcessPoolExecutor(max_workers=num_processes, initializer=_init_worker,
+                                 initargs=(count_file, num_shards, spill_dir)) as executor:
+            pbar = tqdm(total=len(file_ids), desc="Processing files for n-grams")
+            for _, spill_paths, files_done in _completed(executor, _map_batch, batches, max_in_flight):
+                for shard, spill_path in enumerate(spill_paths):
+                    if spill_path is not None:
+                        shard_spills[shard].append(spill_path)
+                pbar.update(files_done)
+            pbar.close()
+
+            most_common = None
+            ngram_postings = NgramPostings()
+            reduce_tasks = [(spills, top_k) for spills in shard_spills if spills]
+            for shard_most_common, shard_postings in tqdm(_completed(executor, _reduce_shard, reduce_tasks, max_in_flight),
+                                                          total=len(reduce_tasks), desc="Merging n-gram shards"):
+                if most_common is None:
+                    most_common = [[] for _ in shard_most_common]
+                for order, order_most_common in enumerate(shard_most_common):
+                    most_common[order].extend(order_most_common)
+                ngram_postings.update(shard_postings)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    if most_common is None:
+        most_common = [[] for _ in count_file.orders]
+    most_common = [_top_k(order_most_common, top_k) for order_most_common in most_common]
+    return most_common, ngram_postings.subset(key for order in most_common for key, _ in order)
@@ -0,0 +1,188 @@
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from ngram_cache import CachedNgramCounter, TokenCache
+from ngram_postings import FILE_ID_TYPE
+
+# Odd 64 bit multipliers for the polynomial hash of a shingle's token ids
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+SHINGLE_MIX = np.uint64(0xBF58476D1CE4E5B9)
+# Shingles hashed under all permutations at a time, bounds the memory of a long document
+SHINGLE_BLOCK = 1 << 14
+EMPTY = np.uint32(0xFFFFFFFF)
+
+
+class MinHasher:
+    """
+    The MinHash signature of one cached file, by file index, for every n in orders: for each of
+    num_perm hash functions the minimum hash over the file's distinct n-gram shingles, which are the
+    n-grams CachedNgramCounter would count, made from the same filtered token sequence. Returns a
+    (len(orders), num_perm) uint32 array, a row of EMPTY for an order the file has no n-grams of.
+
+    The fraction of equal values in two signatures estimates the Jaccard similarity of the shingle
+    sets of their files. Shingles are hashed from their token ids with a multiply-shift hash per
+    permutation, seeded with seed, so signatures are the same in every process and run.
+
+    Instances are picklable without the memory map, so each worker process maps the cache itself.
+    """
+
+    def __init__(self, cache, ignore_ids, orders, num_perm=128, seed=1):
+        self.cache_dir = cache.cache_dir
+        self.ignore_ids = np.fromiter(ignore_ids, dtype=np.uint32, count=len(ignore_ids))
+        self.orders = tuple(orders)
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.increments = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+        self._cache = cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    def shingle_hashes(self, ids, n):
+        """The distinct 32 bit hashes of the n-grams of a token id array."""
+        if len(ids) < n:
+            return np.empty(0, dtype=np.uint64)
+        hashes = np.zeros(len(ids) - n + 1, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for offset in range(n):
+                hashes = hashes * SHINGLE_MULTIPLIER + ids[offset:len(ids) - n + 1 + offset]
+            hashes ^= hashes >> np.uint64(31)
+            hashes *= SHINGLE_MIX
+        return np.unique(hashes >> np.uint64(32))
+
+    def __call__(self, index):
+        if self._cache is None:
+            self._cache = TokenCache.open(self.cache_dir, ids_only=True)
+        ids = np.frombuffer(self._cache.ids(index), dtype=np.uint32)
+        if len(self.ignore_ids):
+            ids = ids[~np.isin(ids, self.ignore_ids)]
+        ids = ids.astype(np.uint64)
+        signatures = np.full((len(self.orders), len(self.multipliers)), EMPTY, dtype=np.uint32)
+        multipliers = self.multipliers[:, None]
+        increments = self.increments[:, None]
+        for row, n in enumerate(self.orders):
+            shingles = self.shingle_hashes(ids, n)
+            with np.errstate(over='ignore'):
+                for start in range(0, len(shingles), SHINGLE_BLOCK):
+                    block = (multipliers * shingles[None, start:start + SHINGLE_BLOCK] + increments) >> np.uint64(32)
+                    np.minimum(signatures[row], block.min(axis=1).astype(np.uint32), out=signatures[row])
+        return signatures
+
+
+class DisjointSets:
+    """Union-find over the integers 0 to size - 1, with path halving."""
+
+    def __init__(self, size):
+        self.parents = list(range(size))
+
+    def find(self, item):
+        parents = self.parents
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # The lowest index becomes the root, so clusters do not depend on the order of unions
+            if root_b < root_a:
+                root_a, root_b = root_b, root_a
+            self.parents[root_b] = root_a
+
+
+def lsh_clusters(signatures, bands, threshold=0.5):
+    """
+    Group the rows of a (num_files, num_perm) signature array into clusters of near duplicates.
+
+    Every signature is cut into bands of num_perm // bands rows, and files with an equal band land
+    in the same bucket. A file joins the cluster of the first file in each of its buckets when their
+    signatures agree on at least threshold of their values, the estimated Jaccard similarity, so
+    chance collisions of a band are not merged. Files are thus compared to at most bands others,
+    and time and memory grow linearly with the number of files. Files with an EMPTY signature are
+    left out. Returns the clusters as sorted lists of row indexes, largest first.
+    """
+    num_files, num_perm = signatures.shape
+    rows = num_perm // bands
+    disjoint_sets = DisjointSets(num_files)
+    buckets = [{} for _ in range(bands)]
+    nonempty = (signatures != EMPTY).any(axis=1)
+    for index in np.flatnonzero(nonempty).tolist():
+        signature = signatures[index]
+        for band, band_buckets in enumerate(buckets):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            first = band_buckets.setdefault(key, index)
+            if first != index and np.count_nonzero(signatures[first] == signature) >= threshold * num_perm:
+                disjoint_sets.union(first, index)
+
+    clusters = {}
+    for index in np.flatnonzero(nonempty).tolist():
+        clusters.setdefault(disjoint_sets.find(index), []).append(index)
+    return sorted(clusters.values(), key=lambda cluster: (-len(cluster), cluster[0]))
+
+
+def cluster_label(count_file, order, members, used, sample_size=16):
+    """
+    The n-gram key shared by most of a sample of the cluster's members. Keys in used are skipped, so
+    every cluster gets its own label. Returns None when the sample has no n-gram that is not used yet.
+    """
+    document_frequency = Counter()
+    for file_id in members[:sample_size]:
+        document_frequency.update(count_file(file_id)[order].keys())
+    for key, _ in document_frequency.most_common():
+        if key not in used:
+            return key
+    return None
+
+
+def find_minhash_clusters(cache, file_ids, ignore_ids, orders, top_k=1000, num_perm=128, bands=32, threshold=0.5,
+                          min_cluster_size=2, num_threads=20, num_processes=0, seed=1):
+    """
+    Cluster the given files in the token cache into groups of near duplicates, such as pages of the
+    same printed form, with MinHash signatures over their n-gram shingles and locality sensitive
+    hashing, see MinHasher and lsh_clusters. Unlike counting n-grams this needs no global counts or
+    postings, only a signature of num_perm values per file.
+
+    Returns the top_k clusters of at least min_cluster_size files for each n in orders, as
+    (key, size) in descending size, and one dict with the sorted file ids of every cluster by key,
+    like count_heavy_hitters. The key of a cluster is the n-gram shared by most of its files, see
+    cluster_label.
+    """
+    if num_perm % bands:
+        raise ValueError(f"num_perm {num_perm} is not a multiple of bands {bands}")
+    file_ids = list(file_ids)
+    hasher = MinHasher(cache, ignore_ids, orders, num_perm=num_perm, seed=seed)
+    signatures = np.empty((len(orders), len(file_ids), num_perm), dtype=np.uint32)
+    if num_processes:
+        executor = ProcessPoolExecutor(max_workers=num_processes)
+        chunksize = max(1, min(256, len(file_ids) // (4 * num_processes)))
+        file_signatures = executor.map(hasher, file_ids, chunksize=chunksize)
+    else:
+        executor = ThreadPoolExecutor(max_workers=num_threads)
+        file_signatures = executor.map(hasher, file_ids)
+    with executor:
+        for row, signature in enumerate(tqdm(file_signatures, total=len(file_ids), desc="Computing MinHash signatures")):
+            signatures[:, row] = signature
+
+    count_file = CachedNgramCounter(cache, ignore_ids, orders)
+    most_common_ngrams = []
+    cluster_files = {}
+    for order in range(len(orders)):
+        clusters = [cluster for cluster in lsh_clusters(signatures[order], bands, threshold)
+                    if len(cluster) >= min_cluster_size][:top_k]
+        order_most_common = []
+        for cluster in tqdm(clusters, desc="Labelling clusters"):
+            members = sorted(file_ids[row] for row in cluster)
+            key = cluster_label(count_file, order, members, cluster_files)
+            if key is None:
+                continue
+            order_most_common.append((key, len(members)))
+            cluster_files[key] = array(FILE_ID_TYPE, members)
+        most_common_ngrams.append(order_most_common)
+    return most_common_ngrams, cluster_files
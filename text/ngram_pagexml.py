@@ -0,0 +1,130 @@
+import importlib.util
+import os
+import sys
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ngram_filter import WordFilter
+from ngram_text import get_tokenizer, normalize_text, token_text
+
+CONVERSION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conversion')
+
+# Worker side state, set once per process by _init_worker
+_settings = None
+
+
+def load_converter():
+    """conversion/pagexml-to-text.py, which is a script rather than a module."""
+    converter = sys.modules.get('pagexml_to_text')
+    if converter is None:
+        # For the helper modules of the converter
+        if CONVERSION_DIR not in sys.path:
+            sys.path.append(CONVERSION_DIR)
+        spec = importlib.util.spec_from_file_location('pagexml_to_text', os.path.join(CONVERSION_DIR, 'pagexml-to-text.py'))
+        converter = importlib.util.module_from_spec(spec)
+        sys.modules['pagexml_to_text'] = converter
+        spec.loader.exec_module(converter)
+    return converter
+
+
+def _init_worker(settings):
+    global _settings
+    _settings = dict(settings)
+    _settings['word_filter'] = WordFilter(*settings['filter_words'])
+    _settings['tokenize'] = get_tokenizer(settings['tokenizer'])
+
+
+def _tokenize_task(task):
+    """
+    Parse, filter and tokenize the pages of one task of the converter. Returns the name and tokens
+    of every accepted page, and the pages that failed.
+    """
+    converter = load_converter()
+    settings = _settings
+    read_pagexml = converter.read_pagexml_stream if settings['parser'] == 'stream' else converter.read_pagexml_file
+    prefix = settings['prefix']
+    excluded_files = settings['excluded_files']
+    word_filter = settings['word_filter']
+    tokenize = settings['tokenize']
+    pages = []
+    failed = []
+    try:
+        for input_name, output_path, source in converter.iter_task_pages(task):
+            # The same filename filters as on the .txt file the converter would write
+            file = os.path.basename(output_path)
+            if (prefix is not None and not file.startswith(prefix)) or os.path.splitext(file)[0] in excluded_files:
+                continue
+            try:
+                lines = read_pagexml(source, raise_errors=True, **settings['merge_options'])
+            except Exception as e:
+                failed.append({'input': input_name, 'error': f"{type(e).__name__}: {e}"})
+                continue
+
+            # The text of the .txt file, as find_ngrams would read it back in text mode
+            raw_text = ''.join(line + '\n' for line in lines)
+            if '\r' in raw_text:
+                raw_text = raw_text.replace('\r\n', '\n').replace('\r', '\n')
+            text = normalize_text(raw_text)
+            if word_filter and not word_filter.accepts(text):
+                continue
+            pages.append((input_name, tokenize(token_text(raw_text, text))))
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        if 'archive' not in task:
+            raise
+        failed.append({'input': task['archive'], 'error': f"{type(e).__name__}: {e}"})
+    return pages, failed
+
+
+def _pages(results):
+    for pages, failed in results:
+        for failure in failed:
+            print(f"Error reading PageXML file {failure['input']}: {failure['error']}")
+        yield from pages
+
+
+def _map_in_order(executor, fn, tasks, max_in_flight):
+    """
+    Like executor.map, the results of fn for every task in the order of tasks, but with at most
+    max_in_flight tasks submitted at a time, so the results of tasks that finished early do not
+    pile up behind a slow one.
+    """
+    in_flight = deque()
+    for task in tasks:
+        in_flight.append(executor.submit(fn, task))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def tokenize_pagexml(input_dir, filter_words=((), (), (), ()), tokenizer='fast', prefix=None, excluded_files=(),
+                     recursive=False, archives=False, merge_options=None, parser='stream', num_processes=0,
+                     files_per_task=64, max_in_flight=None):
+    """
+    Yield the name and tokens of every PageXML page under input_dir that passes the filters, in the
+    order of the converter's tasks, without writing text files.
+
+    Pages are parsed with the merge_options of pagexml-to-text.py (or archive members, as in its
+    main), and their text is filtered and tokenized the same way find_ngrams handles the .txt file
+    the converter would write. filter_words are the exclude, required, exclude insensitive and
+    required insensitive words. With num_processes, the pages are parsed and tokenized on a
+    process pool, task by task, with at most max_in_flight tasks (by default two per process)
+    submitted at a time. Stop consuming the generator to cancel the remaining tasks.
+    """
+    converter = load_converter()
+    tasks = converter.list_tasks(input_dir, '', recursive, archives, files_per_task)
+    settings = dict(filter_words=filter_words, tokenizer=tokenizer, prefix=prefix, excluded_files=frozenset(excluded_files),
+                    merge_options=merge_options or {}, parser=parser)
+    if not num_processes:
+        _init_worker(settings)
+        yield from _pages(map(_tokenize_task, tasks))
+        return
+    if max_in_flight is None:
+        max_in_flight = 2 * num_processes
+    executor = ProcessPoolExecutor(max_workers=num_processes, initializer=_init_worker, initargs=(settings,))
+    try:
+        yield from _pages(_map_in_order(executor, _tokenize_task, tasks, max_in_flight))
+    finally:
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,66 @@
+from array import array
+
+FILE_ID_TYPE = 'I'
+
+
+class NgramPostings:
+    """
+    Compact n-gram -> files postings, with files interned to integer ids.
+
+    Most n-grams occur in a single file, so their posting is stored as that file id itself. Once an
+    n-gram is seen in a second file, its posting becomes an array of unsigned 32 bit file ids,
+    4 bytes per file instead of a set entry holding a full path string.
+    """
+
+    def __init__(self, postings=None):
+        self.postings = {} if postings is None else postings
+
+    def __len__(self):
+        return len(self.postings)
+
+    def __contains__(self, key):
+        return key in self.postings
+
+    def add_file(self, keys, file_id):
+        """Add one file to the postings of all its distinct n-gram keys."""
+        postings = self.postings
+        for key in keys:
+            posting = postings.get(key)
+            if posting is None:
+                postings[key] = file_id
+            elif type(posting) is int:
+                postings[key] = array(FILE_ID_TYPE, (posting, file_id))
+            else:
+                posting.append(file_id)
+
+    def update(self, other):
+        """Merge the postings of another NgramPostings over a disjoint set of files."""
+        postings = self.postings
+        for key, other_posting in other.postings.items():
+            posting = postings.get(key)
+            if posting is None:
+                postings[key] = other_posting
+                continue
+            if type(posting) is int:
+                posting = postings[key] = array(FILE_ID_TYPE, (posting,))
+            if type(other_posting) is int:
+                posting.append(other_posting)
+            else:
+                posting.extend(other_posting)
+
+    def get(self, key):
+        """The sorted file ids of key."""
+        posting = self.postings[key]
+        if type(posting) is int:
+            return array(FILE_ID_TYPE, (posting,))
+        return array(FILE_ID_TYPE, sorted(posting))
+
+    def retain(self, keys):
+        """Drop the postings of every n-gram not in keys, e.g. after trimming the counter."""
+        postings = self.postings
+        self.postings = {key: postings[key] for key in keys if key in postings}
+
+    def subset(self, keys):
+        """A new NgramPostings with only the given keys."""
+        postings = self.postings
+        return NgramPostings({key: postings[key] for key in keys if key in postings})
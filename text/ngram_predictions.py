@@ -0,0 +1,171 @@
+import glob
+import json
+import mmap
+import os
+import shutil
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from ngram_cache import OFFSET_TYPE, cache_fingerprint, read_array
+
+try:
+    import ijson
+except ImportError:  # ijson is optional, without it every predictions file is loaded whole with json.load
+    ijson = None
+
+PREDICTIONS_CACHE_VERSION = 1
+VALUE_TYPE = 'd'
+
+
+def prediction_identifier(identifier):
+    """The text file path of the thumbnail a prediction was made for."""
+    return identifier.replace('thumbnails/data/', '').replace('.jp2.thumbnail.jpg', '.txt').replace('NL-HaNA_2.09.09', 'page/NL-HaNA_2.09.09')
+
+
+def _iter_results(f):
+    if ijson is not None:
+        return ijson.items(f, 'results.item', use_float=True)
+    return json.load(f).get("results", [])
+
+
+def load_predictions_file(json_file):
+    """
+    The identifiers and top predictions of one predictions file, in file order, and the error that
+    stopped reading it, if any. Like a partially read file, what was read before an error is kept.
+    """
+    identifiers = []
+    top_predictions = array(VALUE_TYPE)
+    error = None
+    try:
+        with open(json_file, 'rb') as f:
+            for result in _iter_results(f):
+                identifier = prediction_identifier(result.get("identifier"))
+                combined = result.get("predictions", {}).get("combined", {})
+                if identifier and isinstance(combined, dict) and combined:
+                    identifiers.append(identifier)
+                    top_predictions.append(max(combined.values()))
+    except Exception as e:
+        error = str(e)
+    return json_file, identifiers, top_predictions, error
+
+
+class PredictionsMap:
+    """
+    Read-only identifier -> top prediction map, memory-mapped from a cache written by
+    write_predictions_cache: the identifiers sorted by their UTF-8 bytes, concatenated with an offset
+    per identifier, and their predictions as an array of doubles. Lookups are binary searches.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.offsets = read_array(os.path.join(cache_dir, 'key_offsets.bin'), OFFSET_TYPE)
+        self._keys = self._map('keys.bin')
+        self._values = self._map('values.bin')
+        if self._values is not None:
+            self._values = memoryview(self._values).cast(VALUE_TYPE)
+
+    def _map(self, name):
+        path = os.path.join(self.cache_dir, name)
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _find(self, identifier):
+        key = identifier.encode('utf-8')
+        keys = self._keys
+        offsets = self.offsets
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if keys[offsets[middle]:offsets[middle + 1]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and keys[offsets[low]:offsets[low + 1]] == key:
+            return low
+        return None
+
+    def get(self, identifier, default=None):
+        index = self._find(identifier)
+        return default if index is None else self._values[index]
+
+    def __getitem__(self, identifier):
+        index = self._find(identifier)
+        if index is None:
+            raise KeyError(identifier)
+        return self._values[index]
+
+    def __contains__(self, identifier):
+        return self._find(identifier) is not None
+
+    def items(self):
+        for index in range(len(self)):
+            yield self._keys[self.offsets[index]:self.offsets[index + 1]].decode('utf-8'), self._values[index]
+
+
+def write_predictions_cache(cache_dir, predictions_map, fingerprint):
+    """Write a dict of identifier -> top prediction as a cache that PredictionsMap can open."""
+    build_dir = cache_dir.rstrip(os.sep) + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    identifiers = sorted(predictions_map, key=lambda identifier: identifier.encode('utf-8'))
+    offsets = array(OFFSET_TYPE, [0])
+    with open(os.path.join(build_dir, 'keys.bin'), 'wb') as f:
+        for identifier in identifiers:
+            key = identifier.encode('utf-8')
+            f.write(key)
+            offsets.append(offsets[-1] + len(key))
+    with open(os.path.join(build_dir, 'key_offsets.bin'), 'wb') as f:
+        offsets.tofile(f)
+    with open(os.path.join(build_dir, 'values.bin'), 'wb') as f:
+        array(VALUE_TYPE, (predictions_map[identifier] for identifier in identifiers)).tofile(f)
+    # meta.json is written last, so a cache that was interrupted halfway is never opened
+    with open(os.path.join(build_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': PREDICTIONS_CACHE_VERSION, 'fingerprint': fingerprint}, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(build_dir, cache_dir)
+
+
+def load_predictions_map(predictions_dir, cache_dir=None, num_processes=None):
+    """
+    Map the text file path of every prediction in the *.json files of predictions_dir to its top
+    combined prediction. Later files override earlier ones, in glob order.
+
+    The files are parsed on a process pool, streaming with ijson when it is installed. The merged
+    map is written to cache_dir (by default .predictions_cache in predictions_dir) and opened from
+    there as a memory-mapped PredictionsMap. Later runs open the cache right away, until a
+    predictions file is added, removed or changed. When the cache cannot be written, the merged map
+    is returned as a dict.
+    """
+    predictions_dir = os.path.expanduser(predictions_dir)
+    json_files = glob.glob(os.path.join(predictions_dir, "*.json"))
+    if cache_dir is None:
+        cache_dir = os.path.join(predictions_dir, '.predictions_cache')
+    fingerprint = cache_fingerprint(json_files, version=PREDICTIONS_CACHE_VERSION, kind='predictions')
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('fingerprint') == fingerprint:
+            print(f"Using cached predictions from {cache_dir}")
+            return PredictionsMap(cache_dir)
+
+    predictions_map = {}
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        # map keeps the results in glob order, so later files still override earlier ones
+        for json_file, identifiers, top_predictions, error in executor.map(load_predictions_file, json_files):
+            print(f"Loaded predictions from {json_file}")
+            predictions_map.update(zip(identifiers, top_predictions))
+            if error is not None:
+                print(f"Error loading {json_file}: {error}")
+
+    try:
+        write_predictions_cache(cache_dir, predictions_map, fingerprint)
+    except OSError as e:
+        print(f"Could not write the predictions cache to {cache_dir}: {e}")
+        return predictions_map
+    return PredictionsMap(cache_dir)
@@ -0,0 +1,110 @@
+import heapq
+import math
+from array import array
+from collections import Counter
+from hashlib import blake2b
+
+from tqdm import tqdm
+
+from ngram_postings import NgramPostings
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch over n-gram keys, in width * depth fixed counters.
+
+    Every estimate is at least the true count, and with probability 1 - exp(-depth) at most the
+    true count plus error_bound(): e / width times the total of all counts added. The sketch is a
+    sum of its updates, so it does not depend on the order in which they were added.
+    """
+
+    def __init__(self, width=1 << 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.counters = array('Q', bytes(8 * width * depth))
+
+    def _buckets(self, key):
+        # Double hashing on one stable 64 bit hash, the builtin hash() is salted per process
+        hash_value = int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+        h1 = hash_value & 0xffffffff
+        h2 = (hash_value >> 32) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        counters = self.counters
+        for bucket in self._buckets(key):
+            counters[bucket] += count
+        self.total += count
+
+    def estimate(self, key):
+        counters = self.counters
+        return min(counters[bucket] for bucket in self._buckets(key))
+
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+
+def count_heavy_hitters(file_ids, count_file, top_k, width=1 << 20, depth=4, candidates_factor=2):
+    """
+    Find the top_k n-grams in fixed memory, independent of the order of the files.
+
+    1. Every n-gram is added to a CountMinSketch.
+    2. The candidates_factor * top_k n-grams with the highest estimates are kept in a bounded heap,
+       ties broken on the key, so the candidates only depend on the (order independent) sketch.
+    3. The candidates are counted exactly, with their postings, and the top_k of them returned.
+
+    Counts of the returned n-grams are exact. An n-gram can only be missed when its count is within
+    the sketch's error_bound() of the count of the last candidate, which is printed after step 2.
+    Memory is the sketch plus the candidates, however many distinct n-grams the corpus holds.
+
+    count_file returns one Counter per n-gram order for a file id, like CachedNgramCounter, and
+    every order gets its own sketch and candidates. It is called for every file in each of the
+    three passes, so it should read from the token cache. Returns the top_k n-grams as (key, count)
+    for each order, and one NgramPostings for all of them.
+    """
+    sketches = None
+    for file_id in tqdm(file_ids, desc="Sketching n-gram counts"):
+        file_ngram_counters = count_file(file_id)
+        if sketches is None:
+            sketches = [CountMinSketch(width, depth) for _ in file_ngram_counters]
+        for sketch, file_ngram_counter in zip(sketches, file_ngram_counters):
+            for key, count in file_ngram_counter.items():
+                sketch.add(key, count)
+    if sketches is None:
+        return [], NgramPostings()
+
+    capacity = candidates_factor * top_k
+    heaps = [[] for _ in sketches]
+    seen = set()
+    for file_id in tqdm(file_ids, desc="Selecting heavy hitters"):
+        for sketch, heap, file_ngram_counter in zip(sketches, heaps, count_file(file_id)):
+            for key in file_ngram_counter:
+                if key in seen:
+                    continue
+                entry = (sketch.estimate(key), key)
+                if len(heap) < capacity:
+                    heapq.heappush(heap, entry)
+                    seen.add(key)
+                elif entry > heap[0]:
+                    seen.discard(heapq.heapreplace(heap, entry)[1])
+                    seen.add(key)
+    for sketch, heap in zip(sketches, heaps):
+        print(f"Count-Min sketch error bound: {sketch.error_bound():.1f} over {sketch.total} n-grams, "
+              f"lowest candidate estimate: {heap[0][0] if heap else 0}")
+
+    candidates = {key for heap in heaps for _, key in heap}
+    ngram_counters = [Counter() for _ in sketches]
+    ngram_postings = NgramPostings()
+    for file_id in tqdm(file_ids, desc="Counting heavy hitters"):
+        keys = []
+        for ngram_counter, file_ngram_counter in zip(ngram_counters, count_file(file_id)):
+            for key, count in file_ngram_counter.items():
+                if key in candidates:
+                    ngram_counter[key] += count
+                    keys.append(key)
+        ngram_postings.add_file(keys, file_id)
+
+    most_common = [sorted(ngram_counter.items(), key=lambda x: (-x[1], x[0]))[:top_k] for ngram_counter in ngram_counters]
+    return most_common, ngram_postings.subset(key for order in most_common for key, _ in order)
@@ -0,0 +1,82 @@
+import re
+
+from nltk.tokenize import NLTKWordTokenizer
+from unidecode import unidecode
+
+# Characters removed by clean_text before diacritics are normalized
+REMOVED_CHARACTERS = '-,.!?;:/\\„\'()='
+# Characters removed again before tokenizing, unidecode can produce them from non-ASCII characters
+TOKEN_REMOVED_CHARACTERS = '-,.'
+
+_REMOVE_TABLE = str.maketrans('', '', REMOVED_CHARACTERS)
+_TOKEN_REMOVE_TABLE = str.maketrans('', '', TOKEN_REMOVED_CHARACTERS)
+_NON_ASCII = re.compile(r'[^\x00-\x7f]+')
+
+_treebank_tokenizer = NLTKWordTokenizer()
+# Characters that NLTKWordTokenizer always splits off as separate tokens, regardless of context
+_PAD_TABLE = str.maketrans({c: f' {c} ' for c in '[](){}<>;@#$%&*?!‒–—―'})
+# Characters whose NLTKWordTokenizer rules depend on their context, text containing any of these
+# is handed to NLTKWordTokenizer itself
+_CONTEXT_DEPENDENT = re.compile('["`\',:.«»“”‘’„]|--')
+# Contractions that NLTKWordTokenizer splits and that do not contain an apostrophe
+_CONTRACTION_HINT = re.compile(r'(?i)cannot|gimme|gonna|gotta|lemme|wanna')
+
+TOKENIZERS = ('fast', 'nltk')
+
+
+def _unidecode_run(match):
+    return unidecode(match.group())
+
+
+def normalize_text(text):
+    """
+    Single pass equivalent of the former clean_text: remove punctuation with one translate table,
+    then normalize diacritics with unidecode, only on the runs of non-ASCII characters.
+    """
+    text = text.translate(_REMOVE_TABLE)
+    if not text.isascii():
+        text = _NON_ASCII.sub(_unidecode_run, text)
+    return text.strip()
+
+
+def token_text(text, normalized):
+    """Text to tokenize for a file, given its raw text and its normalize_text output."""
+    if text.isascii():
+        # Nothing was transliterated, so normalize_text already removed these characters
+        return normalized
+    return normalized.translate(_TOKEN_REMOVE_TABLE)
+
+
+def tokenize_nltk(text):
+    """
+    nltk's word_tokenize, without the Punkt sentence splitting. normalize_text removes '.', '!'
+    and '?', but unidecode can bring back '!' and '?', from characters such as '¡', '¿' and '‼',
+    and token_text keeps them. Those are safe: Punkt only ends a sentence at whitespace,
+    NLTKWordTokenizer splits '!' and '?' off in any context, and it treats the start and end of a
+    sentence like whitespace, so splitting into sentences first does not change the tokens.
+    """
+    return _treebank_tokenizer.tokenize(text)
+
+
+def tokenize_fast(text):
+    """
+    Table driven tokenizer giving the same tokens as NLTKWordTokenizer. Normalized text hardly
+    ever contains characters with context-dependent rules, so it usually comes down to padding a
+    fixed set of characters with spaces and splitting on whitespace.
+    """
+    if _CONTEXT_DEPENDENT.search(text):
+        return _treebank_tokenizer.tokenize(text)
+    text = text.translate(_PAD_TABLE)
+    if _CONTRACTION_HINT.search(text):
+        text = " " + text + " "
+        for regexp in _treebank_tokenizer.CONTRACTIONS2:
+            text = regexp.sub(r" \1 \2 ", text)
+    return text.split()
+
+
+def get_tokenizer(name):
+    if name == 'fast':
+        return tokenize_fast
+    if name == 'nltk':
+        return tokenize_nltk
+    raise ValueError(f"Unknown tokenizer: {name}, choose from {', '.join(TOKENIZERS)}")